@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import libvirt
+
+from virt_lightning.configuration import Configuration
+import virt_lightning.profiling as profiling
+import virt_lightning.shell as shell
+import virt_lightning.virt_lightning as vl
+
+DEFAULT_SIZES = (10, 100, 1000)
+PHASES = ("provision", "list", "inventory", "teardown")
+DISTRO = "bench-distro"
+CONTEXT = "bench"
+
+
+def prepare_environment(work_dir):
+    kvm_binary = work_dir / "kvm-dummy"
+    kvm_binary.write_text("")
+    vl.KVM_BINARIES = (str(kvm_binary),)
+    vl.QEMU_DIR = str(work_dir)
+    pool_dir = work_dir / "pool"
+    (pool_dir / "upstream").mkdir(parents=True)
+    (pool_dir / "upstream" / "{distro}.qcow2".format(distro=DISTRO)).write_bytes(b"")
+    vl.DEFAULT_STORAGE_DIR = str(pool_dir)
+    ssh_key_file = work_dir / "id_rsa.pub"
+    ssh_key_file.write_text("ssh-rsa AAAA bench@virt-lightning")
+
+    configuration = Configuration()
+    configuration.data["main"]["libvirt_uri"] = "test:///default"
+    configuration.data["main"]["network_name"] = "vl-bench"
+    configuration.data["main"]["network_cidr"] = "10.64.0.0/21"
+    configuration.data["main"]["storage_pool"] = "vl-bench"
+    configuration.data["main"]["ssh_key_file"] = str(ssh_key_file)
+    configuration.data["main"]["state_dir"] = str(work_dir / "state")
+    return configuration
+
+
+@contextlib.contextmanager
+def measure(results, phase, rpc_stats):
+    rpc_stats.command = phase
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+    results[phase] = {
+        "wall": time.perf_counter() - start,
+        "rpc": sum(count for count, _, _ in rpc_stats.by_method(phase).values()),
+    }
+
+
+def run_size(size):
+    logging.getLogger("virt_lightning").setLevel(logging.WARNING)
+    rpc_stats = profiling.enable("setup")
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        configuration = prepare_environment(pathlib.PosixPath(tmp))
+        hv = vl.LibvirtHypervisor(shell._connect(configuration))
+        hv.init_network(configuration.network_name, configuration.network_cidr)
+        hv.init_storage_pool(configuration.storage_pool)
+
+        # The test driver cannot boot a guest, the seed ISO is replaced by an
+        # empty volume so we don't depend on genisoimage.
+        def prepare_seed(domain):
+            return hv.create_disk(name="{name}-cidata".format(name=domain.name), size=1)
+
+        hv.prepare_cloud_init_openstack_iso = prepare_seed
+
+        # Older test drivers don't implement virNetworkUpdate.
+        network_update = hv.network_obj.update
+
+        def update_network(*args):
+            try:
+                return network_update(*args)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                    raise
+
+        hv.network_obj.update = update_network
+
+        hosts = [
+            {
+                "name": "bench-{i:04d}".format(i=i),
+                "distro": DISTRO,
+                "groups": ["bench", "shard{shard}".format(shard=i % 10)],
+            }
+            for i in range(size)
+        ]
+        with measure(results, "provision", rpc_stats):
+            for host in hosts:
+                shell._start_domain(hv, host, CONTEXT, configuration)
+        with measure(results, "list", rpc_stats):
+            shell.status(configuration, context=CONTEXT)
+        with measure(results, "inventory", rpc_stats):
+            shell.ansible_inventory(configuration, context=CONTEXT)
+        with measure(results, "teardown", rpc_stats):
+            shell.down(configuration, context=CONTEXT)
+
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    calls = rpc_stats.by_method("provision")
+    results["provision"]["top_rpc"] = {
+        method: calls[method][0]
+        for method in sorted(calls, key=lambda m: calls[m][0], reverse=True)[:10]
+    }
+    return results
+
+
+def run(sizes):
+    report = {}
+    for size in sizes:
+        # Each size runs in a fresh interpreter to get a clean test driver
+        # state and a meaningful peak RSS.
+        output = subprocess.check_output(
+            [sys.executable, __file__, "--single", str(size)]
+        )
+        report[str(size)] = json.loads(output.decode())
+    return report
+
+
+def print_report(report):
+    print(  # noqa: T001
+        "{size:>6} {phase:<10} {wall:>10} {rpc:>9}".format(
+            size="size", phase="phase", wall="wall (s)", rpc="RPC"
+        )
+    )
+    for size, results in report.items():
+        for phase in PHASES:
+            print(  # noqa: T001
+                "{size:>6} {phase:<10} {wall:>10.3f} {rpc:>9}".format(
+                    size=size, phase=phase, **results[phase]
+                )
+            )
+        print(  # noqa: T001
+            "{size:>6} peak RSS: {rss} KB".format(size=size, rss=results["peak_rss_kb"])
+        )
+
+
+def compare(report, baseline, wall_tolerance, rpc_tolerance, rss_tolerance):
+    regressions = []
+
+    def check(size, what, value, reference, tolerance):
+        if reference and value > reference * tolerance:
+            regressions.append(
+                "{size} {what}: {value:.3f} > {reference:.3f} x {tolerance}".format(
+                    size=size,
+                    what=what,
+                    value=value,
+                    reference=reference,
+                    tolerance=tolerance,
+                )
+            )
+
+    for size, results in report.items():
+        if size not in baseline:
+            continue
+        for phase in PHASES:
+            reference = baseline[size][phase]
+            check(
+                size,
+                phase + " wall",
+                results[phase]["wall"],
+                reference["wall"],
+                wall_tolerance,
+            )
+            check(
+                size,
+                phase + " RPC",
+                results[phase]["rpc"],
+                reference["rpc"],
+                rpc_tolerance,
+            )
+        check(
+            size,
+            "peak RSS",
+            results["peak_rss_kb"],
+            baseline[size]["peak_rss_kb"],
+            rss_tolerance,
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark virt-lightning against the libvirt test driver"
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=DEFAULT_SIZES,
+        help="number of domains to provision (default: %(default)s)",
+    )
+    parser.add_argument("--save", type=pathlib.PosixPath, help="save a baseline")
+    parser.add_argument(
+        "--compare", type=pathlib.PosixPath, help="compare with a baseline"
+    )
+    parser.add_argument("--wall-tolerance", type=float, default=2.0)
+    parser.add_argument("--rpc-tolerance", type=float, default=1.1)
+    parser.add_argument("--rss-tolerance", type=float, default=1.5)
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_size(args.single)))  # noqa: T001
+        return
+
+    report = run(args.sizes)
+    print_report(report)
+
+    if args.save:
+        args.save.write_text(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare and not args.compare.exists():
+        print(  # noqa: T001
+            "{path}: no baseline, the comparison is skipped".format(path=args.compare)
+        )
+    elif args.compare:
+        baseline = json.loads(args.compare.read_text())
+        regressions = compare(
+            report,
+            baseline,
+            args.wall_tolerance,
+            args.rpc_tolerance,
+            args.rss_tolerance,
+        )
+        for regression in regressions:
+            print("REGRESSION: " + regression)  # noqa: T001
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that must not be loaded just to parse the command line.
+HEAVY_MODULES = (
+    "asyncio",
+    "concurrent.futures",
+    "distutils",
+    "libvirt",
+    "urllib.request",
+    "urwid",
+    "virt_lightning.virt_lightning",
+    "yaml",
+)
+COMMANDS = (
+    ("--help",),
+    ("status", "--help"),
+    ("up", "--help"),
+    ("ansible_inventory", "--help"),
+)
+PROBE = """
+import contextlib, io, json, sys
+sys.argv = ["vl"] + sys.argv[1:]
+from virt_lightning.shell import main
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        main()
+    except SystemExit:
+        pass
+print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)))
+"""
+
+
+def probe(argv):
+    start = time.perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)] + list(argv)
+    )
+    return time.perf_counter() - start, json.loads(output.decode())
+
+
+def run(repeat):
+    report = {}
+    interpreter = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", "pass"])
+        interpreter.append(time.perf_counter() - start)
+    report["interpreter"] = {"wall": statistics.median(interpreter), "heavy": []}
+    for argv in COMMANDS:
+        timings = []
+        for _ in range(repeat):
+            wall, heavy = probe(argv)
+            timings.append(wall)
+        report["vl " + " ".join(argv)] = {
+            "wall": statistics.median(timings),
+            "heavy": heavy,
+        }
+    return report
+
+
+def print_report(report):
+    print(  # noqa: T001
+        "{command:<30} {wall:>10} {heavy}".format(
+            command="command", wall="wall (ms)", heavy="heavy modules"
+        )
+    )
+    for command, result in report.items():
+        print(  # noqa: T001
+            "{command:<30} {wall:>10.1f} {heavy}".format(
+                command=command,
+                wall=result["wall"] * 1000,
+                heavy=", ".join(result["heavy"]) or "-",
+            )
+        )
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for command, result in report.items():
+        if result["heavy"]:
+            regressions.append(
+                "{command} loads {heavy}".format(
+                    command=command, heavy=", ".join(result["heavy"])
+                )
+            )
+        if command == "interpreter" or command not in baseline:
+            continue
+        # Compare the time spent on top of the interpreter startup, the
+        # latter depends too much on the machine.
+        overhead = result["wall"] - report["interpreter"]["wall"]
+        reference = baseline[command]["wall"] - baseline["interpreter"]["wall"]
+        if reference > 0 and overhead > reference * tolerance:
+            regressions.append(
+                "{command}: {overhead:.1f}ms > {reference:.1f}ms x {tolerance}".format(
+                    command=command,
+                    overhead=overhead * 1000,
+                    reference=reference * 1000,
+                    tolerance=tolerance,
+                )
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vl startup time")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=10,
+        help="runs per command, the median is kept (default: %(default)s)",
+    )
+    parser.add_argument("--save", type=pathlib.PosixPath, help="save a baseline")
+    parser.add_argument(
+        "--compare", type=pathlib.PosixPath, help="compare with a baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args()
+
+    report = run(args.repeat)
+    print_report(report)
+
+    if args.save:
+        args.save.write_text(json.dumps(report, indent=2, sort_keys=True))
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else {}
+    regressions = compare(report, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION: " + regression)  # noqa: T001
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 import pytest
 
 import libvirt
+import virt_lightning.latency as latency
 import virt_lightning.virt_lightning as vl
+import os
 import pathlib
 from unittest.mock import patch
 from unittest.mock import Mock
 
+# e.g: latency+test:///default?latency=20ms&jitter=5ms&seed=1
+TEST_LIBVIRT_URI = os.environ.get("VL_TEST_LIBVIRT_URI", "test:///default")
+
 DEFAULT_INI = """
 [main]
 root_password=boby
@@ -25,7 +30,7 @@ def clean_up():
 
 @pytest.fixture
 def hv(scope="function"):
-    conn = libvirt.open("test:///default")
+    conn = latency.connect(TEST_LIBVIRT_URI)
     conn.getURI = Mock(return_value="qemu:///system")
     hv = vl.LibvirtHypervisor(conn)
     with patch.object(pathlib.Path, 'exists') as mock_exists:
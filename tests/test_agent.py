@@ -0,0 +1,75 @@
+import base64
+import json
+import sys
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import libvirt
+import pytest
+
+import virt_lightning.agent as agent
+
+
+def fake_agent(responses):
+    calls = []
+
+    def qemuAgentCommand(dom, payload, timeout, flags):
+        payload = json.loads(payload)
+        calls.append(payload)
+        response = responses[payload["execute"]]
+        if isinstance(response, Exception):
+            raise response
+        return json.dumps({"return": response})
+
+    return Mock(qemuAgentCommand=qemuAgentCommand), calls
+
+
+def test_run():
+    libvirt_qemu, calls = fake_agent(
+        {
+            "guest-exec": {"pid": 42},
+            "guest-exec-status": {
+                "exited": True,
+                "exitcode": 0,
+                "out-data": base64.b64encode(b"status: done\n").decode(),
+            },
+        }
+    )
+    with patch.dict(sys.modules, {"libvirt_qemu": libvirt_qemu}):
+        assert agent.run(Mock(), ["cloud-init", "status", "--wait"]) == (
+            0,
+            "status: done\n",
+            "",
+        )
+    assert calls[0]["arguments"] == {
+        "path": "cloud-init",
+        "arg": ["status", "--wait"],
+        "capture-output": True,
+    }
+    assert calls[1]["arguments"] == {"pid": 42}
+
+
+def test_probe():
+    libvirt_qemu, _ = fake_agent(
+        {
+            "guest-ping": {},
+            "guest-exec": libvirt.libvirtError("guest-exec has been disabled"),
+            "guest-file-open": 1000,
+            "guest-file-close": {},
+        }
+    )
+    with patch.dict(sys.modules, {"libvirt_qemu": libvirt_qemu}):
+        assert agent.probe(Mock(), "agent")
+        assert agent.probe(Mock(), "file:/etc/hostname")
+        # Without guest-exec, the boot-finished file of cloud-init.
+        assert agent.probe(Mock(), "cloud-init")
+
+
+def test_probe_no_agent():
+    libvirt_qemu, _ = fake_agent(
+        {"guest-ping": libvirt.libvirtError("Guest agent is not responding")}
+    )
+    with patch.dict(sys.modules, {"libvirt_qemu": libvirt_qemu}):
+        assert not agent.probe(Mock(), "cloud-init")
+        with pytest.raises(agent.AgentError):
+            agent.command(Mock(), "guest-ping")
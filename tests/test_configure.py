@@ -30,3 +30,29 @@ def test_load_default_config_file(monkeypatch, config_file):
             config_file)
         config = virt_lightning.configuration.Configuration()
         assert config.root_password == "boby"
+
+
+def test_libvirt_uris(monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(
+            virt_lightning.configuration,
+            "DEFAULT_CONFIGFILE",
+            Path("a"))
+        config = virt_lightning.configuration.Configuration()
+        assert config.libvirt_uris == ["qemu:///system"]
+        config.data["main"]["libvirt_uri"] = "test:///a, test:///b"
+        assert config.libvirt_uris == ["test:///a", "test:///b"]
+        assert config.libvirt_uri == "test:///a"
+
+
+def test_ssh_control_path(monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(
+            virt_lightning.configuration,
+            "DEFAULT_CONFIGFILE",
+            Path("a"))
+        config = virt_lightning.configuration.Configuration()
+        config.data["main"]["state_dir"] = "/var/lib/vl"
+        assert config.ssh_control_path == "/var/lib/vl/ssh/%C"
+        config.data["main"]["ssh_control_path"] = "/tmp/%%C"
+        assert config.ssh_control_path == "/tmp/%C"
@@ -0,0 +1,65 @@
+import asyncio
+
+import virt_lightning.console as console
+
+
+def make_capture(tmp_path, **kwargs):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    path = console.log_path(tmp_path, "vm1")
+    return console.ConsoleCapture("vm1", path, loop=loop, **kwargs), path
+
+
+def test_log_path(tmp_path):
+    assert console.log_path(tmp_path, "vm1") == tmp_path / "console" / "vm1.log"
+
+
+def test_batched_writes(tmp_path):
+    capture, path = make_capture(tmp_path)
+    capture.feed(b"Booting\r\n")
+    capture.feed(b"Starting ")
+    # Not written yet
+    assert not path.exists()
+    capture.flush()
+    assert path.read_bytes() == b"Booting\r\nStarting "
+    assert list(capture.tail) == ["Booting"]
+    capture.feed(b"x" * console.FLUSH_SIZE)
+    assert path.stat().st_size == console.FLUSH_SIZE + 18
+
+
+def test_rotation(tmp_path, monkeypatch):
+    monkeypatch.setattr(console, "MAX_LOG_SIZE", 10)
+    capture, path = make_capture(tmp_path)
+    capture.feed(b"first boot\n")
+    capture.flush()
+    capture.feed(b"second boot\n")
+    capture.flush()
+    assert path.read_bytes() == b"second boot\n"
+    assert path.with_suffix(".log.1").read_bytes() == b"first boot\n"
+
+
+def test_readiness(tmp_path):
+    echoed = []
+    capture, _ = make_capture(tmp_path, echo=echoed.append)
+    capture.feed(b"[  OK  ] Started Login Service.\r\n")
+    assert capture.matched is None
+    capture.feed(b"\r\nvm1 login: ")
+    assert capture.matched == "vm1 login:"
+    assert capture.done.is_set()
+    assert echoed[-1] == "\r\nvm1 login: "
+
+
+def test_readiness_cloud_init(tmp_path):
+    capture, _ = make_capture(tmp_path)
+    capture.feed(b"Cloud-init v. 19.4 finished at Mon, 02 Mar 2020 ")
+    capture.feed(b"10:00:00 +0000. Datasource DataSourceNoCloud.  Up 12.34 seconds\n")
+    assert capture.matched.startswith("Cloud-init v. 19.4 finished")
+
+
+def test_close(tmp_path):
+    capture, path = make_capture(tmp_path)
+    capture.feed(b"Booting\n")
+    capture.close()
+    assert capture.done.is_set()
+    assert capture.matched is None
+    assert path.read_bytes() == b"Booting\n"
@@ -0,0 +1,84 @@
+import pathlib
+import threading
+from unittest.mock import Mock
+
+import libvirt
+import pytest
+
+from virt_lightning.configuration import Configuration
+import virt_lightning.daemon as vl_daemon
+import virt_lightning.shell as shell
+
+
+@pytest.fixture
+def configuration(tmp_path):
+    configuration = Configuration()
+    configuration.data["main"]["libvirt_uri"] = "test:///default"
+    configuration.data["main"]["state_dir"] = str(tmp_path / "state")
+    return configuration
+
+
+@pytest.fixture
+def daemon(hv, configuration):
+    daemon = vl_daemon.Daemon(configuration)
+    daemon.hv = hv
+    shell._hypervisors[configuration.libvirt_uri] = hv
+    server = vl_daemon.make_server(
+        daemon, vl_daemon.socket_path(configuration.state_dir)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield daemon
+    server.shutdown()
+    server.server_close()
+    shell._hypervisors.clear()
+
+
+def test_no_daemon(configuration):
+    assert vl_daemon.call(configuration, "status", {"context": None}) is None
+
+
+def test_status(daemon, configuration, domain):
+    domain.context = "default"
+    domain.ipv4 = "1.0.0.10/24"
+    response = vl_daemon.call(configuration, "status", {"context": None})
+    assert response["status"] == 0
+    assert "@1.0.0.10" in response["stdout"]
+    # Served from the cache
+    domain.ipv4 = "1.0.0.11/24"
+    daemon.cache_ttl = 3600
+    assert vl_daemon.call(configuration, "status", {"context": None}) == response
+    daemon.invalidate()
+    response = vl_daemon.call(configuration, "status", {"context": None})
+    assert "@1.0.0.11" in response["stdout"]
+
+
+def test_path_argument(daemon, configuration):
+    response = vl_daemon.call(
+        configuration,
+        "status",
+        {"context": None, "ssh_config_file": pathlib.PosixPath("/tmp/config")},
+    )
+    assert response["status"] == 0
+
+
+def test_allocate_ipv4(daemon, configuration):
+    first = vl_daemon.call(configuration, "allocate_ipv4")["ipv4"]
+    second = vl_daemon.call(configuration, "allocate_ipv4")["ipv4"]
+    assert first != second
+
+
+def test_refused(daemon, configuration):
+    assert vl_daemon.call(configuration, "down", {"context": None}) is None
+    configuration.data["main"]["network_name"] = "another-network"
+    assert vl_daemon.call(configuration, "status", {"context": None}) is None
+
+
+def test_undefine_unregisters_seed(configuration):
+    daemon = vl_daemon.Daemon(configuration)
+    daemon.metadata_service = Mock()
+    dom = Mock()
+    dom.name.return_value = "a"
+    daemon._lifecycle_callback(None, dom, libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+    daemon.metadata_service.unregister.assert_not_called()
+    daemon._lifecycle_callback(None, dom, libvirt.VIR_DOMAIN_EVENT_UNDEFINED, 0, None)
+    daemon.metadata_service.unregister.assert_called_once_with("a")
@@ -2,7 +2,9 @@ import virt_lightning
 
 import pathlib
 from unittest.mock import patch
+import xml.etree.ElementTree as ET
 import libvirt
+import pytest
 
 IF_XML = """
 <domain>
@@ -52,3 +54,157 @@ def test_vcpus(domain):
 def test_fqdn(domain):
     domain.fqdn = "my.test"
     assert domain.fqdn == "my.test"
+
+
+def test_ssh_command(domain):
+    domain.username = "vl"
+    domain.ipv4 = "1.0.0.10/24"
+    command = domain.ssh_command("uptime")
+    assert command[0] == "ssh"
+    assert command[-2:] == ["vl@1.0.0.10", "uptime"]
+
+
+def test_get_all_metadata(domain):
+    domain.context = "default"
+    domain.ipv4 = "1.0.0.10/24"
+    metadata = domain.get_all_metadata()
+    assert metadata["context"] == "default"
+    assert metadata["ipv4"] == "1.0.0.10/24"
+    assert metadata["distro"] == "b"
+
+
+def test_get_root_disk(hv, domain):
+    disk = hv.create_disk("root-a", size=1)
+    domain.add_root_disk(disk)
+    assert domain.get_root_disk() == ("vda", disk.path())
+    assert domain.get_disk_targets() == ["vda"]
+
+
+def test_batch_metadata(domain):
+    original = domain.dom.setMetadata
+    with patch.object(domain.dom, "setMetadata", wraps=original) as set_metadata:
+        with domain.batch_metadata():
+            domain.context = "default"
+            domain.groups = ["web", "db"]
+            domain.ipv4 = "1.0.0.10/24"
+        assert set_metadata.call_count == 1
+    metadata = virt_lightning.virt_lightning.LibvirtDomain(domain.dom).metadata
+    assert metadata["groups"] == ["web", "db"]
+    assert metadata["distro"] == "b"
+    assert "created" in metadata
+
+
+def test_migrate_metadata(domain):
+    vl = virt_lightning.virt_lightning
+    domain.dom.setMetadata(
+        libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+        None,
+        None,
+        vl.METADATA_URI,
+        libvirt.VIR_DOMAIN_AFFECT_CONFIG,
+    )
+    for k, v in (("context", "default"), ("groups", "web,db"), ("distro", "b")):
+        domain.dom.setMetadata(
+            libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+            "<{k} name='{v}' />".format(k=k, v=v),
+            "vl",
+            k,
+            libvirt.VIR_DOMAIN_AFFECT_CONFIG,
+        )
+    migrated = vl.LibvirtDomain(domain.dom)
+    assert migrated.groups == ["web", "db"]
+    assert migrated.context == "default"
+    root = ET.fromstring(domain.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    assert vl.parse_legacy_metadata(root) == {}
+    assert vl.LibvirtDomain(domain.dom).distro == "b"
+
+
+def test_snapshot(domain):
+    assert domain.snapshot is None
+    domain.snapshot = {"base": "/pool/a.qcow2", "memory": None}
+    assert domain.snapshot == {"base": "/pool/a.qcow2", "memory": None}
+    domain.snapshot = None
+    assert domain.snapshot is None
+
+
+def test_get_disks(hv, domain):
+    disk = hv.create_disk("disks-a", size=1)
+    domain.add_root_disk(disk)
+    assert domain.get_disks() == [("vda", disk.path())]
+
+
+def test_memory_profile(domain):
+    assert domain.memory_profile == "default"
+    domain.memory = 1024
+    domain.memory_profile = "locked"
+    assert domain.memory_profile == "locked"
+    root = ET.fromstring(domain.dom.XMLDesc(0))
+    assert root.find("./memoryBacking/locked") is not None
+    assert root.find("./memtune/hard_limit").text == str(1024 * 1024 + 512 * 1024)
+    domain.memory_profile = "default"
+    assert ET.fromstring(domain.dom.XMLDesc(0)).find("./memoryBacking") is None
+    with pytest.raises(ValueError):
+        domain.memory_profile = "foo"
+
+
+def test_set_placement(domain):
+    domain.vcpus = 2
+    assignment = virt_lightning.placement.Assignment(
+        node=0, cpus=[2, 3], node_cpus=[0, 1, 2, 3], memory=768, mode="strict"
+    )
+    domain.set_placement(assignment)
+    root = ET.fromstring(domain.dom.XMLDesc(0))
+    assert [p.attrib["cpuset"] for p in root.findall("./cputune/vcpupin")] == [
+        "2",
+        "3",
+    ]
+    assert root.find("./numatune/memory").attrib["nodeset"] == "0"
+
+
+def test_set_smbios_serial(domain):
+    domain.set_smbios_serial("ds=nocloud-net;s=http://1.0.0.1:8775/")
+    domain.set_smbios_serial("ds=nocloud-net;s=http://1.0.0.1:8775/a/")
+    root = ET.fromstring(domain.dom.XMLDesc(0))
+    assert root.find("./os/smbios").attrib["mode"] == "sysinfo"
+    entries = root.findall("./sysinfo/system/entry[@name='serial']")
+    assert [e.text for e in entries] == ["ds=nocloud-net;s=http://1.0.0.1:8775/a/"]
+    domain.set_smbios_serial(None)
+    root = ET.fromstring(domain.dom.XMLDesc(0))
+    assert root.find("./sysinfo") is None
+    assert root.find("./os/smbios") is None
+
+
+def test_set_kernel(domain):
+    domain.set_kernel("/pool/upstream/a.vmlinuz", "/pool/upstream/a.initrd", "ro")
+    root = ET.fromstring(domain.dom.XMLDesc(0))
+    assert root.find("./os/kernel").text == "/pool/upstream/a.vmlinuz"
+    assert root.find("./os/initrd").text == "/pool/upstream/a.initrd"
+    assert root.find("./os/cmdline").text == "ro"
+
+
+def test_attach_share(domain, tmp_path):
+    tag = domain.attachShare(str(tmp_path), target="/mnt/src", readonly=True)
+    assert tag == "share0"
+    root = ET.fromstring(domain.dom.XMLDesc(0))
+    fs = root.find("./devices/filesystem")
+    assert fs.find("./source").attrib["dir"] == str(tmp_path)
+    assert fs.find("./target").attrib["dir"] == "share0"
+    assert root.find("./memoryBacking/access").attrib["mode"] == "shared"
+    assert domain.memory_profile == "memfd"
+    assert fs.find("./readonly") is not None
+    assert "share0 /mnt/src virtiofs ro,nofail 0 0" in domain.user_data["runcmd"][0]
+
+
+def test_attach_share_whitespace(domain, tmp_path):
+    domain.attachShare(str(tmp_path), target="/mnt/my src")
+    root = ET.fromstring(domain.dom.XMLDesc(0))
+    assert root.find("./devices/filesystem/readonly") is None
+    assert "share0 /mnt/my\\040src virtiofs nofail 0 0" in domain.user_data["runcmd"][0]
+
+
+def test_attach_network_prefix(hv, domain):
+    hv.create_network("prefix_network", "1.5.0.0/22", bridge="prefix-net")
+    domain.attachNetwork(network="prefix_network", ipv4="1.5.0.10")
+    assert str(domain.ipv4) == "1.5.0.10/22"
+    domain.attachNetwork(network="prefix_network", ipv4="1.5.1.10")
+    assert domain.additional_ipv4 == ["1.5.1.10/22"]
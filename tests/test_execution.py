@@ -0,0 +1,70 @@
+import asyncio
+import io
+import time
+
+import virt_lightning.execution as execution
+
+
+def run(targets, **kwargs):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(execution.run(targets, **kwargs))
+    finally:
+        loop.close()
+
+
+def test_run():
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    output = execution.PrefixedOutput(["a", "bb"], stdout=stdout, stderr=stderr)
+    results = run(
+        [
+            ("a", ["sh", "-c", "echo hello; echo oops >&2"]),
+            ("bb", ["sh", "-c", "echo world; exit 3"]),
+        ],
+        output=output,
+    )
+    assert [r.status for r in results] == [0, 3]
+    assert results[0].stdout == "hello"
+    assert results[0].stderr == "oops"
+    assert "a  | hello\n" in stdout.getvalue()
+    assert "bb | world\n" in stdout.getvalue()
+    assert stderr.getvalue() == "a  | oops\n"
+    assert not execution.succeeded(results)
+    assert execution.summary(results) == ["1/2 hosts succeeded", "  bb: exit code 3"]
+
+
+def test_timeout():
+    results = run([("a", ["sleep", "10"]), ("b", ["true"])], timeout=0.2)
+    assert results[0].timed_out
+    assert results[0].status is None
+    assert results[1].status == 0
+
+
+def test_spawn_error():
+    results = run([("a", ["/does/not/exist"]), ("b", ["true"])])
+    assert results[0].status is None
+    assert "/does/not/exist" in results[0].stderr
+    assert results[1].status == 0
+
+
+def test_long_line():
+    results = run(
+        [("a", ["sh", "-c", "head -c 200000 /dev/zero | tr '\\0' x; echo; echo end"])]
+    )
+    assert results[0].status == 0
+    assert results[0].stdout.split("\n") == ["x" * 200000, "end"]
+
+
+def test_concurrency():
+    start = time.monotonic()
+    results = run([(str(i), ["sleep", "0.2"]) for i in range(4)], concurrency=2)
+    assert all(r.status == 0 for r in results)
+    # Two batches of two
+    assert 0.4 <= time.monotonic() - start < 2
+
+
+def test_as_dict():
+    results = [execution.unreachable("a", "no IPv4 address")]
+    assert execution.as_dict(results)["hosts"]["a"]["stderr"] == "no IPv4 address"
+    assert execution.summary(results)[1] == "  a: no IPv4 address"
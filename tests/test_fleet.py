@@ -0,0 +1,53 @@
+from unittest.mock import Mock
+
+import virt_lightning.fleet as fleet
+
+
+def capacity(uri, memory, allocated=0, cpus=8):
+    return fleet.Capacity(
+        uri=uri,
+        cpus=cpus,
+        memory=memory,
+        free_memory=memory,
+        vcpus=0,
+        allocated=allocated,
+    )
+
+
+def test_schedule():
+    capacities = [capacity("test:///a", 4096), capacity("test:///b", 8192, 2048)]
+    hosts = [
+        {"name": "small", "distro": "centos-7"},
+        {"name": "big", "distro": "centos-7", "memory": 4096},
+        {"name": "medium", "distro": "centos-7", "memory": 2048},
+    ]
+    assignments = dict(
+        (host["name"], uri) for uri, host in fleet.schedule(hosts, capacities)
+    )
+    assert assignments == {
+        "big": "test:///b",
+        "medium": "test:///a",
+        "small": "test:///a",
+    }
+
+
+def test_schedule_pinned():
+    capacities = [capacity("test:///a", 1024), capacity("test:///b", 8192)]
+    hosts = [{"name": "a", "distro": "centos-7", "hypervisor": "test:///a"}]
+    assert fleet.schedule(hosts, capacities) == [("test:///a", hosts[0])]
+
+
+def test_fleet():
+    vm_a = Mock()
+    vm_b = Mock()
+    a = Mock()
+    a.list_domains.return_value = [vm_a]
+    a.get_domain_by_name.return_value = None
+    b = Mock()
+    b.list_domains.return_value = [vm_b]
+    b.get_domain_by_name.return_value = vm_b
+    nodes = fleet.Fleet([("test:///a", a), ("test:///b", b)])
+    assert list(nodes.list_domains()) == [vm_a, vm_b]
+    assert list(nodes.items()) == [(a, vm_a), (b, vm_b)]
+    assert vm_b.hypervisor_uri == "test:///b"
+    assert nodes.get_domain_by_name("vm-b") == vm_b
@@ -3,9 +3,13 @@ import virt_lightning
 import ipaddress
 import libvirt
 import pathlib
+import pytest
 from unittest.mock import call
 from unittest.mock import Mock
 from unittest.mock import patch
+import xml.etree.ElementTree as ET
+
+from virt_lightning.templates import DOMAIN_XML
 
 
 def test_arch(hv):
@@ -58,6 +62,44 @@ def test_get_free_ipv4(hv):
     assert str(ipv4_2) == "1.0.0.6/24"
 
 
+def test_get_free_ipv4_prefix(hv):
+    hv.init_network("my_large_network", "1.1.0.0/22")
+    hv._last_free_ipv4 = ipaddress.IPv4Interface("1.1.0.254/22")
+    ipv4_1 = hv.get_free_ipv4()
+    ipv4_2 = hv.get_free_ipv4()
+
+    assert str(ipv4_1) == "1.1.0.255/22"
+    assert str(ipv4_2) == "1.1.1.0/22"
+
+
+def test_get_free_ipv4_new_shard(hv):
+    hv.init_network("my_small_network", "1.2.0.0/29")
+    ipv4 = [hv.get_free_ipv4() for _ in range(3)]
+
+    assert [str(i) for i in ipv4] == ["1.2.0.5/29", "1.2.0.6/29", "1.2.0.13/29"]
+    assert [s.name for s in hv.shards] == ["my_small_network", "my_small_network-1"]
+    assert str(hv.shards[1].gateway) == "1.2.0.9/29"
+    assert hv.get_network_for_ip(ipv4[2]).name == "my_small_network-1"
+    assert hv.get_network_for_ip("1.2.0.5").name == "my_small_network"
+
+
+def test_new_shard_dns(hv):
+    hv.init_network("my_dns_network", "1.3.0.0/29")
+    hv.set_dns_entry(ipaddress.ip_interface("1.3.0.5/29"), ["a"])
+    shard = hv.add_network_shard()
+    root = ET.fromstring(shard.obj.XMLDesc(0))
+    assert root.find("./dns/host[@ip='1.3.0.5']/hostname").text == "a"
+
+
+def test_new_shard_race(hv):
+    hv.init_network("my_raced_network", "1.4.0.0/29")
+    # Created by another process since the last reload.
+    hv.create_network("my_raced_network-1", "1.4.0.8/29", bridge="raced-1")
+    shard = hv.add_network_shard()
+    assert shard.name == "my_raced_network-1"
+    assert [s.name for s in hv.shards] == ["my_raced_network", "my_raced_network-1"]
+
+
 def test_create_disk_with_options(hv):
     disk = hv.create_disk("foo_all", size=3, backing_on=True)
     assert isinstance(disk, libvirt.virStorageVol)
@@ -94,4 +136,141 @@ def test_remove_domain_from_network(hv, domain):
     hv.network_obj.XMLDesc = Mock(return_value=NET_XML)
     hv.network_obj.update = Mock()
     hv.remove_domain_from_network(domain)
-    hv.network_obj.update.call_count == 3
\ No newline at end of file
+    hv.network_obj.update.call_count == 3
+
+
+def test_create_disk_with_backing_file(hv):
+    base = hv.create_disk("base", size=3)
+    assert hv.get_disk_capacity(base.path()) == 3
+    disk = hv.create_disk("clone", size=3, backing_file=base.path())
+    assert isinstance(disk, libvirt.virStorageVol)
+
+
+def test_get_backing_chain(hv):
+    disk = hv.create_disk("standalone", size=1)
+    assert hv.get_backing_chain(disk.path()) == []
+    assert hv.get_backing_chain("/does/not/exist.qcow2") == []
+
+
+def test_snapshot_delete(hv):
+    domain = Mock()
+    domain.snapshot = {"base": "/pool/a.qcow2", "memory": None}
+    domain.get_root_disk.return_value = ("vda", "/pool/a-snap.qcow2")
+    domain.dom.isActive.return_value = True
+    domain.dom.blockJobInfo.side_effect = [
+        {"cur": 0, "end": 0},
+        {"cur": 5, "end": 10},
+        {"cur": 10, "end": 10},
+    ]
+    with patch.object(hv, "conn"), patch.object(hv, "refresh_storage_pools"):
+        hv.snapshot_delete(domain)
+    # The overlay is committed in the base of the snapshot, not in the
+    # upstream image at the bottom of the backing chain.
+    domain.dom.blockCommit.assert_called_once_with(
+        "vda", "/pool/a.qcow2", None, 0, libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
+    )
+    assert domain.dom.blockJobInfo.call_count == 3
+    domain.set_root_disk.assert_called_once_with("/pool/a.qcow2")
+    assert domain.snapshot is None
+
+
+def test_snapshot_revert_memory(hv):
+    domain = Mock()
+    domain.snapshot = {"base": "/pool/a.qcow2", "memory": "/pool/a-snap.mem"}
+    domain.get_root_disk.return_value = ("vda", "/pool/a-snap.qcow2")
+    saved_xml = """<domain>
+      <devices>
+        <disk type='file' device='disk'>
+          <source file='/pool/a.qcow2'/>
+          <backingStore type='file'><source file='/pool/upstream.qcow2'/></backingStore>
+        </disk>
+      </devices>
+    </domain>"""
+    with patch.object(hv, "conn") as conn, patch.object(
+        hv, "create_disk"
+    ), patch.object(hv, "get_volume_pool"), patch.object(hv, "get_disk_capacity"):
+        conn.saveImageGetXMLDesc.return_value = saved_xml
+        hv.snapshot_revert(domain)
+    memory, dxml, flags = conn.restoreFlags.call_args[0]
+    assert memory == "/pool/a-snap.mem"
+    disk = ET.fromstring(dxml).find("./devices/disk")
+    assert disk.find("./source").attrib["file"] == "/pool/a-snap.qcow2"
+    assert disk.find("./backingStore") is None
+
+
+def test_create_domain_headless(hv):
+    domain = hv.create_domain(name="headless", distro="b", machine_profile="headless")
+    assert domain.machine_profile == "headless"
+    assert "q35" in domain.machine
+
+
+def test_strip_desktop_devices(hv):
+    root = ET.fromstring(DOMAIN_XML)
+    hv.strip_desktop_devices(root)
+    assert root.find("./os/type").attrib["machine"] == "q35"
+    for tag in ("graphics", "video", "sound", "redirdev", "input"):
+        assert root.find("./devices/" + tag) is None
+    assert root.find("./devices/rng").attrib["model"] == "virtio"
+    assert root.find("./devices/memballoon/address") is None
+    assert root.find("./devices/serial") is not None
+
+    root = ET.fromstring(DOMAIN_XML)
+    hv.strip_desktop_devices(root, lean=True)
+    assert root.find("./devices/memballoon").attrib["model"] == "none"
+
+
+def test_extract_kernel(hv, tmpdir):
+    hv.storage_pool_obj = hv.create_storage_pool("foo", tmpdir)
+    upstream_d = tmpdir / "upstream"
+    upstream_d.mkdir()
+    (upstream_d / "distro_1.qcow2").write(b"a")
+    (upstream_d / "distro_1.yaml").write("username: root\n")
+
+    def get_kernel(command):
+        output = pathlib.PosixPath(command[command.index("-o") + 1])
+        (output / "vmlinuz").write_text("kernel")
+        (output / "initramfs.img").write_text("initrd")
+
+    with patch("subprocess.check_call", side_effect=get_kernel):
+        boot = hv.extract_kernel("distro_1", cmdline="root=/dev/vda1 ro")
+    assert boot == {
+        "kernel": "distro_1.vmlinuz",
+        "initrd": "distro_1.initrd",
+        "cmdline": "root=/dev/vda1 ro",
+    }
+    assert (upstream_d / "distro_1.vmlinuz").read() == "kernel"
+    config = hv.get_distro_configuration("distro_1")
+    assert config["username"] == "root"
+    assert config["kernel"] == "distro_1.vmlinuz"
+
+
+def test_find_orphan_volumes(hv, domain):
+    disk = hv.create_disk("gc-a", size=1, backing_on="centos-7")
+    domain.add_root_disk(disk)
+    orphan = hv.create_disk("gc-b", size=1, backing_on="centos-7")
+    seed = hv.create_disk("gc-b-cidata", size=1)
+    # Not created by virt-lightning.
+    other = hv.create_disk("gc-c", size=1)
+    orphans = [vol.path() for vol in hv.find_orphan_volumes(min_age=0)]
+    assert orphan.path() in orphans
+    assert seed.path() in orphans
+    assert disk.path() not in orphans
+    assert other.path() not in orphans
+
+
+def test_choose_storage_pool(hv, tmpdir):
+    data = hv.create_storage_pool("data", tmpdir)
+    data.create(0)
+    hv.data_pools = [data]
+    names = [hv.choose_storage_pool().name() for _ in range(3)]
+    assert names == ["foo_bar", "data", "foo_bar"]
+    assert hv.choose_storage_pool(name="data").name() == "data"
+    assert hv.choose_storage_pool("least-used").name() in ("foo_bar", "data")
+    with pytest.raises(ValueError):
+        hv.choose_storage_pool(name="unknown")
+
+
+def test_get_base_image(hv):
+    assert hv.get_base_image("centos-7", hv.storage_pool_obj) == (
+        hv.get_storage_dir() / "upstream" / "centos-7.qcow2"
+    )
@@ -0,0 +1,92 @@
+import time
+from unittest.mock import Mock
+
+import virt_lightning.inventory as inventory
+
+
+def test_build(hv):
+    web = hv.create_domain(name="web", distro="centos-7")
+    web.context = "default"
+    web.ipv4 = "1.0.0.10/24"
+    web.username = "vl"
+    web.groups = ["webservers"]
+    db = hv.create_domain(name="db", distro="centos-7")
+    db.context = "default"
+    db.ipv4 = "1.0.0.11/24"
+    other = hv.create_domain(name="other", distro="centos-7")
+    other.context = "other"
+    other.ipv4 = "1.0.0.12/24"
+
+    content = inventory.build(hv, "default")
+    assert sorted(content["_meta"]["hostvars"]) == ["db", "web"]
+    assert content["_meta"]["hostvars"]["web"]["ansible_host"] == "1.0.0.10"
+    assert content["_meta"]["hostvars"]["web"]["ansible_user"] == "vl"
+    assert content["webservers"] == {"hosts": ["web"]}
+    assert content["ungrouped"] == {"hosts": ["db"]}
+    assert content["all"]["children"] == ["ungrouped", "webservers"]
+
+
+def test_to_ini():
+    content = {
+        "_meta": {
+            "hostvars": {
+                "web": inventory.host_vars(
+                    {
+                        "ipv4": "1.0.0.10/24",
+                        "username": "vl",
+                        "python_interpreter": "/usr/bin/python3",
+                    }
+                )
+            }
+        },
+        "all": {"children": ["ungrouped", "webservers"]},
+        "ungrouped": {"hosts": []},
+        "webservers": {"hosts": ["web"]},
+    }
+    assert inventory.to_ini(content) == [
+        "web ansible_host=1.0.0.10 ansible_user=vl "
+        "ansible_python_interpreter=/usr/bin/python3 "
+        'ansible_ssh_common_args="-o UserKnownHostsFile=/dev/null '
+        '-o StrictHostKeyChecking=no"',
+        "\n[webservers]",
+        "web",
+    ]
+
+
+def test_cache(tmp_path, monkeypatch):
+    path = inventory.cache_path(tmp_path)
+    assert inventory.load(path, "default", 10) is None
+    inventory.save(path, "default", {"a": 1})
+    inventory.save(path, "other", {"b": 2})
+    assert inventory.load(path, "default", 10) == {"a": 1}
+    assert inventory.load(path, "other", 10) == {"b": 2}
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert inventory.load(path, "default", 10) is None
+    inventory.invalidate(path)
+    assert not path.exists()
+
+
+def test_host_vars_remote():
+    variables = inventory.host_vars(
+        {"ipv4": "1.0.0.10/24", "username": "vl"}, "qemu+ssh://root@node2/system"
+    )
+    assert variables["vl_hypervisor"] == "qemu+ssh://root@node2/system"
+    assert variables["ansible_ssh_common_args"].endswith(" -o ProxyJump=root@node2")
+
+
+def test_build_reserved_groups():
+    domain = Mock(hypervisor_uri=None)
+    domain.name = "web"
+    domain.get_all_metadata.return_value = {
+        "context": "default",
+        "ipv4": "1.0.0.10/24",
+        "groups": ["all", "_meta", "webservers"],
+    }
+    hv = Mock()
+    hv.list_domains.return_value = [domain]
+    content = inventory.build(hv, "default")
+    assert content["all"]["children"] == ["ungrouped", "webservers"]
+    assert content["webservers"] == {"hosts": ["web"]}
+    assert content["ungrouped"] == {"hosts": []}
+    assert list(content["_meta"]) == ["hostvars"]
@@ -0,0 +1,45 @@
+import libvirt
+import pytest
+
+import virt_lightning.latency as latency
+
+
+def test_parse_uri():
+    target, settings = latency.parse_uri(
+        "latency+qemu+ssh://host/system?latency=20ms&jitter=5ms&seed=4"
+        "&failure_rate=0.5&clock=virtual&keyfile=/a"
+    )
+    assert target == "qemu+ssh://host/system?keyfile=%2Fa"
+    assert settings == {
+        "latency": 0.02,
+        "jitter": 0.005,
+        "seed": "4",
+        "failure_rate": 0.5,
+        "virtual": True,
+    }
+    assert latency.parse_uri("latency+test:///default") == ("test:///default", {})
+
+
+def test_injector_is_deterministic():
+    a = latency.LatencyInjector(latency=0.02, jitter=0.01, seed=1, virtual=True)
+    b = latency.LatencyInjector(latency=0.02, jitter=0.01, seed=1, virtual=True)
+    for method in ["virDomain.metadata", "virDomain.XMLDesc"] * 5:
+        a.before(method)
+    for method in ["virDomain.XMLDesc"] * 5 + ["virDomain.metadata"] * 5:
+        b.before(method)
+    assert a.calls == 10
+    assert a.injected == pytest.approx(b.injected)
+    assert 0.1 <= a.injected <= 0.3
+
+
+def test_injected_failure():
+    injector = latency.LatencyInjector(failure_rate=1, virtual=True)
+    with pytest.raises(libvirt.libvirtError):
+        injector.before("virConnect.listAllDomains")
+    assert injector.failures == 1
+
+
+def test_connect(domain):
+    conn = latency.connect("latency+test:///default?latency=1ms&clock=virtual")
+    assert conn.lookupByName("a").name() == "a"
+    assert latency.injectors()[-1].calls == 1
@@ -0,0 +1,48 @@
+from unittest.mock import Mock
+
+import virt_lightning.memstat as memstat
+
+
+def fake_domain(name, context, profile="default"):
+    domain = Mock()
+    domain.name = name
+    domain.get_all_metadata.return_value = {
+        "context": context,
+        "memory_profile": profile,
+    }
+    return domain
+
+
+def test_ksm_savings():
+    parameters = {
+        "shm_pages_shared": 100,
+        "shm_pages_sharing": 1024,
+        "shm_pages_unshared": 10,
+        "shm_full_scans": 3,
+    }
+    ksm = memstat.ksm_savings(parameters, 4096)
+    assert ksm["saved"] == 4
+    assert ksm["pages_shared"] == 100
+    assert memstat.ksm_savings({}, 4096) is None
+
+
+def test_by_context():
+    usage = [
+        (fake_domain("b", "default"), 1024, 600),
+        (fake_domain("a", "default", "hugepages"), 2048, 2048),
+        (fake_domain("c", "ci"), 512, 100),
+    ]
+    contexts = memstat.by_context(usage)
+    assert [c.context for c in contexts] == ["default", "ci"]
+    assert contexts[0].domains == 2
+    assert contexts[0].allocated == 3072
+    assert contexts[0].rss == 2648
+    assert contexts[0].profiles == {"default", "hugepages"}
+
+
+def test_report():
+    contexts = [memstat.ContextUsage("default", 2, 3072, 2648, {"default"})]
+    lines = memstat.report(contexts, 2048, None)
+    assert lines[0].startswith("host: 2048 MiB, allocated: 3072 MiB (overcommit 1.50x)")
+    assert lines[1] == "ksm: not available"
+    assert lines[3].split()[:5] == ["default", "2", "3072", "2648", "1.50x"]
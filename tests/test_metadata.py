@@ -0,0 +1,72 @@
+import json
+import urllib.request
+
+import yaml
+
+import virt_lightning.metadata as metadata
+
+SEED = {
+    "name": "a",
+    "ipv4": "127.0.0.1",
+    "mac": "52:54:00:0f:91:5e",
+    "gateway": "127.0.0.1",
+    "meta_data": {
+        "hostname": "a.test",
+        "local-hostname": "a",
+        "public_keys": {"default": "ssh-rsa AAAA"},
+        "uuid": "4e8fb1c4-cf8d-4d5a-b0c1-d0f4c9a9e1b7",
+    },
+    "network_data": {"links": [], "networks": [], "services": []},
+    "user_data": "#cloud-config\nruncmd: []\n",
+}
+
+
+def test_payloads():
+    files = metadata.payloads(SEED)
+    meta_data = json.loads(files["openstack/latest/meta_data.json"])
+    assert meta_data["uuid"] == SEED["meta_data"]["uuid"]
+    assert files["latest/meta-data/local-ipv4"] == "127.0.0.1\n"
+    assert files["latest/meta-data/public-keys/0/openssh-key"] == "ssh-rsa AAAA\n"
+    nocloud = yaml.safe_load(files["nocloud/52-54-00-0f-91-5e/meta-data"])
+    assert nocloud["instance-id"] == SEED["meta_data"]["uuid"]
+    assert files["nocloud/52-54-00-0f-91-5e/user-data"] == SEED["user_data"]
+
+
+def test_respond():
+    service = metadata.MetadataService(8775)
+    service.files["192.168.123.5"] = metadata.payloads(SEED)
+    path = "/openstack/latest/user_data"
+    assert service.respond("GET", path, "192.168.123.5") == (
+        200,
+        SEED["user_data"].encode(),
+    )
+    assert service.respond("GET", path, "192.168.123.6") == (404, b"")
+    assert service.respond("POST", path, "192.168.123.5") == (405, b"")
+    assert service.respond("GET", "/openstack/foo", "192.168.123.5") == (404, b"")
+    # Not to another VM, even with the MAC address of the NoCloud URL.
+    status, _ = service.respond(
+        "GET", "/nocloud/52-54-00-0f-91-5e/meta-data", "192.168.123.6"
+    )
+    assert status == 404
+
+
+def test_unregister():
+    service = metadata.MetadataService(8775)
+    service.files["127.0.0.1"] = metadata.payloads(SEED)
+    service.addresses["a"] = "127.0.0.1"
+    service.unregister("a")
+    assert service.respond("GET", "/latest/user-data", "127.0.0.1") == (404, b"")
+    service.unregister("a")
+
+
+def test_service():
+    service = metadata.MetadataService(0)
+    service.start()
+    url = service.register(SEED)
+    assert url == "http://127.0.0.1:0/nocloud/52-54-00-0f-91-5e/"
+    port = service.servers["127.0.0.1"].sockets[0].getsockname()[1]
+    with urllib.request.urlopen(
+        "http://127.0.0.1:{port}/openstack/latest/user_data".format(port=port)
+    ) as response:
+        assert response.read().decode() == SEED["user_data"]
+    service.loop.call_soon_threadsafe(service.loop.stop)
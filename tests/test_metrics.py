@@ -0,0 +1,72 @@
+from unittest.mock import Mock
+
+import virt_lightning.metrics as metrics
+from virt_lightning.instrumentation import register_observer, stage
+from virt_lightning.instrumentation import unregister_observer
+
+
+def test_format_sample():
+    assert metrics.format_sample("a", {}, 1) == "a 1"
+    assert (
+        metrics.format_sample("a", {"b": 'c"d', "le": float("inf")}, 2)
+        == 'a{b="c\\"d",le="+Inf"} 2'
+    )
+
+
+def test_histogram():
+    h = metrics.Histogram(buckets=(1, 5, float("inf")))
+    h.observe(0.5)
+    h.observe(3)
+    h.observe(10)
+    assert h.counts == [1, 2, 3]
+    assert h.count == 3
+    assert h.sum == 13.5
+
+
+def test_provisioning_log(tmp_path):
+    path = tmp_path / "state" / "provisioning.log"
+    log = metrics.ProvisioningLog(path)
+    register_observer(log.observe)
+    try:
+        with stage("define", "vm1", distro="centos-7"):
+            pass
+        with stage("not-a-stage", "vm1", distro="centos-7"):
+            pass
+        try:
+            with stage("disk", "vm1", distro="centos-7"):
+                raise SystemExit(1)
+        except SystemExit:
+            pass
+    finally:
+        unregister_observer(log.observe)
+
+    stats = metrics.ProvisioningStats(path)
+    stats.update()
+    assert stats.counters == {
+        ("define", "centos-7", "success"): 1,
+        ("disk", "centos-7", "failure"): 1,
+    }
+    assert stats.histograms[("define", "centos-7")].count == 1
+    assert ("disk", "centos-7") not in stats.histograms
+
+    log.observe("boot", "vm1", 0, 2, {"distro": "centos-7"}, False)
+    stats.update()
+    assert stats.histograms[("boot", "centos-7")].sum == 2
+    assert stats.counters[("define", "centos-7", "success")] == 1
+    # The readiness through the guest agent.
+    log.observe("agent", "vm1", 2, 5, {"distro": "centos-7"}, False)
+    stats.update()
+    assert stats.histograms[("agent", "centos-7")].sum == 3
+
+
+def test_exporter_cache():
+    collector = Mock()
+    collector.families.return_value = []
+    provisioning_stats = Mock()
+    provisioning_stats.families.return_value = [
+        metrics.MetricFamily("vl_test", "gauge", "A test.")
+    ]
+    exporter = metrics.Exporter(collector, provisioning_stats, cache_ttl=60)
+    assert exporter.render() == "# HELP vl_test A test.\n# TYPE vl_test gauge\n"
+    exporter.render()
+    assert collector.families.call_count == 1
@@ -0,0 +1,70 @@
+import json
+
+import virt_lightning.placement as placement
+
+CAPABILITIES = """
+<capabilities>
+  <host>
+    <topology>
+      <cells num='2'>
+        <cell id='0'>
+          <memory unit='KiB'>4194304</memory>
+          <cpus num='2'>
+            <cpu id='0'/>
+            <cpu id='1'/>
+          </cpus>
+        </cell>
+        <cell id='1'>
+          <memory unit='KiB'>4194304</memory>
+          <cpus num='2'>
+            <cpu id='2'/>
+            <cpu id='3'/>
+          </cpus>
+        </cell>
+      </cells>
+    </topology>
+  </host>
+</capabilities>
+"""
+
+
+def test_topology():
+    nodes = placement.topology(CAPABILITIES)
+    assert nodes == [
+        placement.Node(id=0, cpus=(0, 1), memory=4096),
+        placement.Node(id=1, cpus=(2, 3), memory=4096),
+    ]
+
+
+def test_spread(tmp_path):
+    placer = placement.Placer(
+        placement.topology(CAPABILITIES), tmp_path / "placement.json"
+    )
+    first = placer.assign("uuid-a", "a", 1, 1024)
+    second = placer.assign("uuid-b", "b", 1, 1024)
+    assert (first.node, first.cpus, first.mode) == (0, [0], "strict")
+    assert (second.node, second.cpus) == (1, [2])
+    assert second.node_cpus == [2, 3]
+
+
+def test_pack(tmp_path):
+    placer = placement.Placer(
+        placement.topology(CAPABILITIES), tmp_path / "placement.json", strategy="pack"
+    )
+    assert placer.assign("uuid-a", "a", 1, 1024).cpus == [0]
+    assert placer.assign("uuid-b", "b", 1, 1024).cpus == [1]
+    assert placer.assign("uuid-c", "c", 2, 1024).cpus == [2, 3]
+    overcommit = placer.assign("uuid-d", "d", 1, 1024)
+    assert overcommit.mode == "preferred"
+
+
+def test_state(tmp_path):
+    path = tmp_path / "placement.json"
+    nodes = placement.topology(CAPABILITIES)
+    placer = placement.Placer(nodes, path)
+    placer.assign("uuid-a", "a", 2, 1024)
+    assert json.loads(path.read_text())["uuid-a"]["cpus"] == [0, 1]
+    assert placement.Placer(nodes, path).assign("uuid-b", "b", 1, 1024).node == 1
+    # uuid-a is gone, its CPU are free again.
+    placer = placement.Placer(nodes, path, defined={"uuid-b"})
+    assert list(placer.assignments) == ["uuid-b"]
@@ -0,0 +1,31 @@
+import libvirt
+
+import virt_lightning.profiling as profiling
+
+
+def test_payload_size():
+    assert profiling.payload_size(("ab", b"cde", None, [1, "f"])) == 6
+    assert profiling.payload_size({"a": "bc"}) == 3
+
+
+def test_rpc_stats(hv, domain):
+    stats = profiling.RPCStats("status")
+    conn = profiling.wrap(hv.conn, [stats])
+    dom = conn.lookupByName("a")
+    assert isinstance(dom, profiling.RPCProxy)
+    xml = dom.XMLDesc(0)
+    assert dom.name() == "a"
+
+    calls = stats.by_method("status")
+    assert calls["virConnect.lookupByName"][0] == 1
+    assert calls["virDomain.XMLDesc"][2] >= len(xml)
+    assert "virDomain.name" not in calls
+    assert stats.total == 2
+    assert stats.report()[0].startswith("libvirt RPC for status: 2 calls")
+
+
+def test_wrap_disabled(hv):
+    assert profiling.wrap(hv.conn) is hv.conn
+    wrapped = profiling.wrap([hv.conn], [profiling.RPCStats()])
+    assert isinstance(wrapped[0], profiling.RPCProxy)
+    assert isinstance(wrapped[0], libvirt.virConnect)
@@ -0,0 +1,26 @@
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ("asyncio", "libvirt", "urwid", "virt_lightning.virt_lightning", "yaml")
+
+
+def loaded_modules(*argv):
+    probe = (
+        "import json, sys\n"
+        "sys.argv = ['vl'] + sys.argv[1:]\n"
+        "from virt_lightning.shell import main\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(json.dumps([m for m in {heavy!r} if m in sys.modules]))\n"
+    ).format(heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", probe] + list(argv))
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def test_help_is_import_light():
+    assert loaded_modules("--help") == []
+    assert loaded_modules("status", "--help") == []
+    assert loaded_modules("up", "--help") == []
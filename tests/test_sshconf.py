@@ -0,0 +1,68 @@
+from virt_lightning.configuration import Configuration
+import virt_lightning.sshconf as sshconf
+
+
+def configuration(tmp_path):
+    configuration = Configuration()
+    configuration.data["main"]["ssh_key_file"] = "~/.ssh/id_ed25519.pub"
+    configuration.data["main"]["ssh_control_path"] = str(tmp_path / "ssh" / "%%C")
+    return configuration
+
+
+def test_command_options(tmp_path):
+    c = configuration(tmp_path)
+    assert sshconf.command_options(c) == [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        "ControlPersist=10m",
+        "-o",
+        "ControlPath={path}".format(path=tmp_path / "ssh" / "%C"),
+    ]
+    assert (tmp_path / "ssh").is_dir()
+    c.data["main"]["ssh_control_master"] = "no"
+    assert sshconf.command_options(c) == []
+
+
+def test_host_entry(domain, tmp_path):
+    domain.username = "vl"
+    domain.ipv4 = "1.0.0.10/24"
+    domain.context = "default"
+    entry = sshconf.host_entry(domain, configuration(tmp_path))
+    assert entry.uuid == domain.dom.UUIDString()
+    assert entry.context == "default"
+    assert "Host a\n" in entry.text
+    assert "IdentityFile ~/.ssh/id_ed25519\n" in entry.text
+    assert "ControlMaster auto\n" in entry.text
+
+
+def test_jump_host():
+    assert sshconf.jump_host("qemu+ssh://root@node2/system") == "root@node2"
+    assert sshconf.jump_host("qemu+ssh://node2:2222/system") == "node2:2222"
+    assert sshconf.jump_host("qemu:///system") is None
+    assert sshconf.jump_host(None) is None
+
+
+def test_update(tmp_path):
+    path = tmp_path / "ssh_config"
+    a = sshconf.Entry("uuid-a", "default", "Host a\n")
+    b = sshconf.Entry("uuid-b", "default", "Host b\n")
+    c = sshconf.Entry("uuid-c", "other", "Host c\n")
+    assert sshconf.update(path, "default", [a, b]) == {
+        "added": 2,
+        "updated": 0,
+        "removed": 0,
+    }
+    sshconf.update(path, "other", [c])
+    assert sshconf.parse(path.read_text()) == {e.uuid: e for e in (a, b, c)}
+
+    b = b._replace(text="Host b\n     Hostname 1.0.0.11\n")
+    assert sshconf.update(path, "default", [b]) == {
+        "added": 0,
+        "updated": 1,
+        "removed": 1,
+    }
+    assert path.read_text() == (
+        "# vl: uuid-b default\nHost b\n     Hostname 1.0.0.11\n"
+        "# vl: uuid-c other\nHost c\n"
+    )
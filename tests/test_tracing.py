@@ -0,0 +1,40 @@
+import json
+
+import virt_lightning.tracing as tracing
+
+
+def test_percentile():
+    assert tracing.percentile([3, 1, 2], 50) == 2
+    assert tracing.percentile([1], 95) == 1
+    assert tracing.percentile(list(range(1, 101)), 95) == 95
+
+
+def test_chrome_trace(tmp_path):
+    tracer = tracing.Tracer()
+    tracer.observe("define", "vm1", 10.0, 11.0, {}, False)
+    tracer.observe("defineXML", "vm1", 10.0, 10.5, {}, False)
+    tracer.observe("define", "vm2", 10.5, 12.0, {}, True)
+    trace_file = tmp_path / "out.json"
+    tracer.write(trace_file, process_name="vl up")
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    tracks = {e["tid"]: e["args"]["name"] for e in events if e["name"] == "thread_name"}
+    assert sorted(tracks.values()) == ["vm1", "vm2"]
+    spans = [e for e in events if e["ph"] == "X"]
+    assert len(spans) == 3
+    assert spans[2]["ts"] == 500000
+    assert spans[2]["dur"] == 1500000
+    assert spans[2]["args"]["failed"]
+
+
+def test_summary():
+    tracer = tracing.Tracer()
+    tracer.observe("define", "vm1", 0.0, 1.0, {}, False)
+    tracer.observe("ssh", "vm1", 1.0, 3.0, {}, False)
+    tracer.observe("define", "vm2", 0.0, 2.0, {}, False)
+    tracer.observe("ssh", "vm2", 2.0, 9.0, {}, False)
+    track, stages = tracer.critical_path()
+    assert track == "vm2"
+    assert [s.name for s in stages] == ["define", "ssh"]
+    summary = tracer.summary()
+    assert summary[1].split()[:2] == ["define", "2"]
+    assert summary[-1].startswith("critical path: vm2 (9.00s)")
@@ -0,0 +1,111 @@
+import asyncio
+import base64
+import json
+import logging
+import time
+
+import libvirt
+
+AGENT_TIMEOUT = 5
+POLL_INTERVAL = 1
+# The file written by cloud-init once the boot is done, when guest-exec is
+# not allowed by the agent.
+BOOT_FINISHED = "/var/lib/cloud/instance/boot-finished"
+CLOUD_INIT_STATUS = ["cloud-init", "status", "--wait"]
+# 2: done, with some recoverable errors.
+CLOUD_INIT_DONE = (0, 2)
+PROBES = ("agent", "cloud-init")
+
+logger = logging.getLogger("virt_lightning")
+
+
+class AgentError(Exception):
+    pass
+
+
+def command(dom, execute, arguments=None, timeout=AGENT_TIMEOUT):
+    import libvirt_qemu
+
+    payload = {"execute": execute}
+    if arguments:
+        payload["arguments"] = arguments
+    try:
+        response = libvirt_qemu.qemuAgentCommand(dom, json.dumps(payload), timeout, 0)
+    except libvirt.libvirtError as e:
+        raise AgentError(str(e))
+    return json.loads(response)["return"]
+
+
+def ping(dom):
+    try:
+        command(dom, "guest-ping")
+    except AgentError:
+        return False
+    return True
+
+
+def file_exists(dom, path):
+    try:
+        handle = command(dom, "guest-file-open", {"path": path, "mode": "r"})
+    except AgentError:
+        return False
+    try:
+        command(dom, "guest-file-close", {"handle": handle})
+    except AgentError:
+        pass
+    return True
+
+
+def exec_start(dom, args):
+    return command(
+        dom,
+        "guest-exec",
+        {"path": args[0], "arg": list(args[1:]), "capture-output": True},
+    )["pid"]
+
+
+def exec_status(dom, pid):
+    status = command(dom, "guest-exec-status", {"pid": pid})
+    if not status["exited"]:
+        return None
+    return (
+        status.get("exitcode", -1),
+        base64.b64decode(status.get("out-data", "")).decode(errors="replace"),
+        base64.b64decode(status.get("err-data", "")).decode(errors="replace"),
+    )
+
+
+def run(dom, args, timeout=None):
+    pid = exec_start(dom, args)
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        result = exec_status(dom, pid)
+        if result:
+            return result
+        if deadline and time.monotonic() > deadline:
+            raise AgentError("{args}: timeout".format(args=" ".join(args)))
+        time.sleep(POLL_INTERVAL)
+
+
+def probe(dom, readiness):
+    # True once the VM is ready, the agent commands are blocking.
+    if not ping(dom):
+        return False
+    if readiness == "agent":
+        return True
+    if readiness.startswith("file:"):
+        return file_exists(dom, readiness.partition(":")[2])
+    try:
+        exitcode, stdout, stderr = run(dom, CLOUD_INIT_STATUS)
+    except AgentError as e:
+        logger.debug("guest-exec: %s, waiting for %s", e, BOOT_FINISHED)
+        return file_exists(dom, BOOT_FINISHED)
+    if exitcode not in CLOUD_INIT_DONE:
+        logger.warning("cloud-init failed: %s", (stdout + stderr).strip())
+    return True
+
+
+async def wait_ready(domain, readiness):
+    loop = asyncio.get_event_loop()
+    while not await loop.run_in_executor(None, probe, domain.dom, readiness):
+        await asyncio.sleep(POLL_INTERVAL)
@@ -1,4 +1,5 @@
 import configparser
+import re
 from abc import ABCMeta, abstractproperty
 from pathlib import PosixPath
 
@@ -14,6 +15,16 @@ DEFAULT_CONFIGURATION = {
         "network_cidr": "192.168.123.0/24",
         "network_auto_clean_up": True,
         "ssh_key_file": "~/.ssh/id_rsa.pub",
+        "state_dir": "~/.local/share/virt-lightning",
+        "ssh_control_master": "auto",
+        "ssh_control_persist": "10m",
+        "ssh_control_path": "",
+        "memory_profile": "default",
+        "machine_profile": "default",
+        "storage_pools": "",
+        "storage_placement": "round-robin",
+        "metadata_service": False,
+        "metadata_service_port": 8775,
     }
 }
 
@@ -23,6 +34,10 @@ class AbstractConfiguration(metaclass=ABCMeta):
     def libvirt_uri(self):
         pass
 
+    @abstractproperty
+    def libvirt_uris(self):
+        pass
+
     @abstractproperty
     def network_name(self):
         pass
@@ -47,6 +62,46 @@ class AbstractConfiguration(metaclass=ABCMeta):
     def storage_pool(self):
         pass
 
+    @abstractproperty
+    def state_dir(self):
+        pass
+
+    @abstractproperty
+    def ssh_control_master(self):
+        pass
+
+    @abstractproperty
+    def ssh_control_persist(self):
+        pass
+
+    @abstractproperty
+    def ssh_control_path(self):
+        pass
+
+    @abstractproperty
+    def memory_profile(self):
+        pass
+
+    @abstractproperty
+    def machine_profile(self):
+        pass
+
+    @abstractproperty
+    def storage_pools(self):
+        pass
+
+    @abstractproperty
+    def storage_placement(self):
+        pass
+
+    @abstractproperty
+    def metadata_service(self):
+        pass
+
+    @abstractproperty
+    def metadata_service_port(self):
+        pass
+
     def __repr__(self):
         return "Configuration(libvirt_uri={uri}, username={username})".format(
             uri=self.libvirt_uri, username=self.username
@@ -65,7 +120,11 @@ class Configuration(AbstractConfiguration):
 
     @property
     def libvirt_uri(self):
-        return self.__get("libvirt_uri")
+        return self.libvirt_uris[0]
+
+    @property
+    def libvirt_uris(self):
+        return [uri for uri in re.split(r"[,\s]+", self.__get("libvirt_uri")) if uri]
 
     @property
     def network_name(self):
@@ -91,5 +150,49 @@ class Configuration(AbstractConfiguration):
     def storage_pool(self):
         return self.__get("storage_pool")
 
+    @property
+    def state_dir(self):
+        return self.__get("state_dir")
+
+    @property
+    def ssh_control_master(self):
+        return self.__get("ssh_control_master")
+
+    @property
+    def ssh_control_persist(self):
+        return self.__get("ssh_control_persist")
+
+    @property
+    def ssh_control_path(self):
+        return self.__get("ssh_control_path") or "{state_dir}/ssh/%C".format(
+            state_dir=self.state_dir
+        )
+
+    @property
+    def memory_profile(self):
+        return self.__get("memory_profile")
+
+    @property
+    def machine_profile(self):
+        return self.__get("machine_profile")
+
+    @property
+    def storage_pools(self):
+        return [
+            pool for pool in re.split(r"[,\s]+", self.__get("storage_pools")) if pool
+        ]
+
+    @property
+    def storage_placement(self):
+        return self.__get("storage_placement")
+
+    @property
+    def metadata_service(self):
+        return self.__get("metadata_service")
+
+    @property
+    def metadata_service_port(self):
+        return int(self.__get("metadata_service_port"))
+
     def load_file(self, config_file):
         self.data.read_string(config_file.read_text())
@@ -0,0 +1,131 @@
+import asyncio
+import collections
+import logging
+import pathlib
+import re
+
+import libvirt
+
+CONSOLE_DIR = "console"
+MAX_LOG_SIZE = 1024 * 1024
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 1.0
+TAIL_LINES = 50
+RECV_SIZE = 64 * 1024
+READINESS_PATTERNS = (
+    re.compile(r"Cloud-init v\. \S+ finished"),
+    re.compile(r"\slogin: $"),
+)
+
+logger = logging.getLogger("virt_lightning")
+
+
+def log_path(state_dir, name):
+    return pathlib.PosixPath(state_dir).expanduser() / CONSOLE_DIR / (name + ".log")
+
+
+class ConsoleCapture:
+    def __init__(self, name, path, patterns=READINESS_PATTERNS, echo=None, loop=None):
+        self.name = name
+        self.path = pathlib.PosixPath(path)
+        self.patterns = patterns
+        self.echo = echo
+        self.loop = loop or asyncio.get_event_loop()
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self.matched = None
+        self.done = asyncio.Event()
+        self.stream = None
+        self._line = ""
+        self._pending = bytearray()
+        self._flush_handle = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def feed(self, data):
+        self._pending += data
+        if len(self._pending) >= FLUSH_SIZE:
+            self.flush()
+        elif not self._flush_handle:
+            self._flush_handle = self.loop.call_later(FLUSH_INTERVAL, self.flush)
+
+        text = data.decode(errors="replace")
+        if self.echo:
+            self.echo(text)
+        lines = (self._line + text).replace("\r", "").split("\n")
+        self._line = lines.pop()
+        self.tail.extend(lines)
+        # The login prompt doesn't end with a new line.
+        for line in lines + [self._line]:
+            self._match(line)
+
+    def _match(self, line):
+        if self.matched:
+            return
+        for pattern in self.patterns:
+            if pattern.search(line):
+                self.matched = line.strip()
+                self.done.set()
+                return
+
+    def flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        # Keep the log file and one rotated copy, the log of an old boot
+        # doesn't need more.
+        if self.path.exists() and self.path.stat().st_size >= MAX_LOG_SIZE:
+            self.path.replace(self.path.with_suffix(".log.1"))
+        with self.path.open("ab") as fd:
+            fd.write(self._pending)
+        self._pending = bytearray()
+
+    def close(self):
+        if self.stream:
+            try:
+                self.stream.eventRemoveCallback()
+                self.stream.finish()
+            except Exception:  # noqa: B902
+                pass
+            self.stream = None
+        self.flush()
+        self.done.set()
+
+    def _stream_callback(self, stream, events, opaque):
+        if events & libvirt.VIR_STREAM_EVENT_READABLE:
+            while True:
+                try:
+                    data = stream.recv(RECV_SIZE)
+                except libvirt.libvirtError:
+                    data = b""
+                if data == -2:
+                    return
+                if not data:
+                    break
+                self.feed(data)
+        self.close()
+
+    def attach(self, conn, dom):
+        stream = conn.newStream(libvirt.VIR_STREAM_NONBLOCK)
+        dom.openConsole(None, stream, libvirt.VIR_DOMAIN_CONSOLE_FORCE)
+        events = sum(
+            (
+                libvirt.VIR_STREAM_EVENT_READABLE,
+                libvirt.VIR_STREAM_EVENT_ERROR,
+                libvirt.VIR_STREAM_EVENT_HANGUP,
+            )
+        )
+        stream.eventAddCallback(events, self._stream_callback, None)
+        self.stream = stream
+
+
+def capture(conn, domain, state_dir, echo=None, loop=None):
+    console = ConsoleCapture(
+        domain.name, log_path(state_dir, domain.name), echo=echo, loop=loop
+    )
+    try:
+        console.attach(conn, domain.dom)
+    except libvirt.libvirtError as e:
+        logger.warning("%s: cannot capture the console: %s", domain.name, e)
+        return None
+    return console
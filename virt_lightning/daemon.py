@@ -0,0 +1,260 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import pathlib
+import socket
+import socketserver
+import threading
+import time
+
+SOCKET_NAME = "vl.sock"
+# Read-only commands, their output is cached until a domain event arrives.
+FORWARDED_ACTIONS = (
+    "status",
+    "ssh_config",
+    "ansible_inventory",
+    "distro_list",
+    "storage_dir",
+)
+CONNECT_TIMEOUT = 1
+REQUEST_TIMEOUT = 120
+# An allocated IPv4 is kept aside until the client has recorded it in the
+# domain metadata.
+IPV4_RESERVATION = 300
+
+logger = logging.getLogger("virt_lightning")
+
+
+def socket_path(state_dir):
+    return pathlib.PosixPath(state_dir).expanduser() / SOCKET_NAME
+
+
+class Daemon:
+    def __init__(self, configuration, cache_ttl=30):
+        self.configuration = configuration
+        self.cache_ttl = cache_ttl
+        self.hv = None
+        self.metadata_service = None
+        self._cache = {}
+        self._reserved_ipv4 = {}
+        self._lock = threading.Lock()
+        self._command_lock = threading.Lock()
+        self._ipv4_lock = threading.Lock()
+
+    @property
+    def settings(self):
+        return dict(self.configuration.data["main"])
+
+    def _event_callback(self, *args):
+        self.invalidate()
+
+    def _lifecycle_callback(self, conn, dom, event, detail, opaque):
+        import libvirt
+
+        self.invalidate()
+        if self.metadata_service and event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.metadata_service.unregister(dom.name())
+
+    def _close_callback(self, conn, reason, opaque):
+        logger.warning("libvirt connection closed (reason: %s)", reason)
+        with self._lock:
+            self.hv = None
+            self._cache = {}
+
+    def hypervisor(self):
+        import libvirt
+
+        import virt_lightning.shell as shell
+        import virt_lightning.virt_lightning as vl
+
+        with self._lock:
+            if self.hv:
+                return self.hv
+            conn = shell._connect(self.configuration)
+            conn.setKeepAlive(5, 3)
+            conn.registerCloseCallback(self._close_callback, None)
+            conn.domainEventRegisterAny(
+                None,
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycle_callback,
+                None,
+            )
+            # Not available with the older libvirt.
+            if hasattr(libvirt, "VIR_DOMAIN_EVENT_ID_METADATA_CHANGE"):
+                conn.domainEventRegisterAny(
+                    None,
+                    libvirt.VIR_DOMAIN_EVENT_ID_METADATA_CHANGE,
+                    self._event_callback,
+                    None,
+                )
+            hv = vl.LibvirtHypervisor(conn)
+            hv.init_network(
+                self.configuration.network_name, self.configuration.network_cidr
+            )
+            hv.init_storage_pool(self.configuration.storage_pool)
+            shell._hypervisors[self.configuration.libvirt_uri] = hv
+            self.hv = hv
+            self._cache = {}
+            return hv
+
+    def invalidate(self):
+        with self._lock:
+            self._cache = {}
+
+    def run(self, action, arguments):
+        import virt_lightning.shell as shell
+
+        if action not in FORWARDED_ACTIONS:
+            return {"error": "unsupported action: {action}".format(action=action)}
+        self.hypervisor()
+        key = json.dumps([action, arguments], sort_keys=True)
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        stdout = io.StringIO()
+        status = 0
+        with self._command_lock, contextlib.redirect_stdout(stdout):
+            try:
+                getattr(shell, action)(configuration=self.configuration, **arguments)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+        response = {"status": status, "stdout": stdout.getvalue()}
+        if status == 0:
+            with self._lock:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, response)
+        return response
+
+    def allocate_ipv4(self):
+        hv = self.hypervisor()
+        with self._ipv4_lock:
+            now = time.monotonic()
+            self._reserved_ipv4 = {
+                ip: deadline
+                for ip, deadline in self._reserved_ipv4.items()
+                if deadline > now
+            }
+            ipv4 = hv.get_free_ipv4(reserved=self._reserved_ipv4)
+            if not ipv4:
+                return {"error": "no IPv4 left in the network"}
+            self._reserved_ipv4[str(ipv4)] = now + IPV4_RESERVATION
+            return {"ipv4": str(ipv4)}
+
+    def register_seed(self, seed):
+        if not self.metadata_service:
+            return {"error": "the metadata service is disabled"}
+        return {"url": self.metadata_service.register(seed)}
+
+    def handle(self, request):
+        if request.get("configuration") != self.settings:
+            return {"error": "configuration mismatch"}
+        if request.get("action") == "allocate_ipv4":
+            return self.allocate_ipv4()
+        if request.get("action") == "register_seed":
+            return self.register_seed(request.get("arguments", {}))
+        return self.run(request.get("action"), request.get("arguments", {}))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.daemon.handle(json.loads(line.decode()))
+            except Exception as e:  # noqa: B902
+                logger.exception(e)
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(daemon, path):
+    path = pathlib.PosixPath(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        if request(path, {}) is not None:
+            raise RuntimeError(
+                "A daemon is already listening on {path}".format(path=path)
+            )
+        path.unlink()
+    server = UnixServer(str(path), RequestHandler)
+    os.chmod(str(path), 0o600)
+    server.daemon = daemon
+    return server
+
+
+def run_event_loop():
+    import libvirt
+
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def serve(configuration, cache_ttl=30):
+    import libvirt
+
+    import virt_lightning.metadata as metadata
+    import virt_lightning.shell as shell
+
+    # The event implementation must be registered before the connection is
+    # opened.
+    libvirt.virEventRegisterDefaultImpl()
+    threading.Thread(target=run_event_loop, daemon=True).start()
+    daemon = Daemon(configuration, cache_ttl=cache_ttl)
+    daemon.hypervisor()
+    if shell._strtobool(configuration.metadata_service):
+        daemon.metadata_service = metadata.MetadataService(
+            configuration.metadata_service_port
+        )
+        daemon.metadata_service.start()
+    path = socket_path(configuration.state_dir)
+    server = make_server(daemon, path)
+    logger.info("Listening on %s", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        path.unlink()
+
+
+def request(path, payload, timeout=REQUEST_TIMEOUT):
+    # e.g: a PosixPath in the arguments of the command.
+    data = json.dumps(payload, default=str).encode() + b"\n"
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(str(path))
+            sock.settimeout(timeout)
+            sock.sendall(data)
+            with sock.makefile("rb") as fd:
+                line = fd.readline()
+    except OSError:
+        return None
+    if not line:
+        return None
+    return json.loads(line.decode())
+
+
+def call(configuration, action, arguments=None):
+    path = socket_path(configuration.state_dir)
+    if not path.exists():
+        return None
+    response = request(
+        path,
+        {
+            "action": action,
+            "arguments": arguments or {},
+            "configuration": dict(configuration.data["main"]),
+        },
+    )
+    if response and "error" in response:
+        logger.debug("vl daemon: %s", response["error"])
+        return None
+    return response
@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import sys
+import time
+
+READ_SIZE = 64 * 1024
+
+HostResult = collections.namedtuple(
+    "HostResult", ["name", "status", "duration", "timed_out", "stdout", "stderr"]
+)
+
+
+class PrefixedOutput:
+    def __init__(self, names, stdout=None, stderr=None):
+        self.width = max((len(name) for name in names), default=0)
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
+
+    def write(self, name, line, error=False):
+        fd = self.stderr if error else self.stdout
+        fd.write(
+            "{name:<{width}} | {line}\n".format(name=name, width=self.width, line=line)
+        )
+        fd.flush()
+
+
+def _emit(name, line, lines, output, error):
+    line = line.decode(errors="replace")
+    lines.append(line)
+    if output:
+        output.write(name, line, error=error)
+
+
+async def _read_lines(name, stream, lines, output, error):
+    # Not readline(), it fails on the lines longer than the limit of the
+    # stream.
+    pending = b""
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if not chunk:
+            break
+        *complete, pending = (pending + chunk).split(b"\n")
+        for line in complete:
+            _emit(name, line, lines, output, error)
+    if pending:
+        _emit(name, pending, lines, output, error)
+
+
+async def run_on_host(name, command, semaphore, timeout, output=None):
+    async with semaphore:
+        start = time.monotonic()
+        stdout, stderr = [], []
+        proc = None
+        timed_out = False
+        failed = False
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            await asyncio.wait_for(
+                asyncio.gather(
+                    _read_lines(name, proc.stdout, stdout, output, False),
+                    _read_lines(name, proc.stderr, stderr, output, True),
+                    proc.wait(),
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            timed_out = True
+        except Exception as e:  # noqa: B902
+            # Only this host fails, not the whole run, e.g: ssh isn't
+            # installed.
+            failed = True
+            stderr.append(str(e))
+        if proc and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        return HostResult(
+            name=name,
+            status=None if timed_out or failed else proc.returncode,
+            duration=time.monotonic() - start,
+            timed_out=timed_out,
+            stdout="\n".join(stdout),
+            stderr="\n".join(stderr),
+        )
+
+
+async def run(targets, concurrency=10, timeout=None, output=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *[
+            run_on_host(name, command, semaphore, timeout, output)
+            for name, command in targets
+        ]
+    )
+
+
+def succeeded(results):
+    return all(result.status == 0 for result in results)
+
+
+def _reason(result):
+    if result.timed_out:
+        return "timed out after {duration:.1f}s".format(duration=result.duration)
+    if result.status is None:
+        return result.stderr
+    return "exit code {status}".format(status=result.status)
+
+
+def unreachable(name, reason):
+    return HostResult(
+        name=name, status=None, duration=0.0, timed_out=False, stdout="", stderr=reason
+    )
+
+
+def summary(results):
+    failed = [r for r in results if r.status != 0]
+    lines = [
+        "{ok}/{total} hosts succeeded".format(
+            ok=len(results) - len(failed), total=len(results)
+        )
+    ]
+    for result in sorted(failed, key=lambda r: r.name):
+        lines.append(
+            "  {name}: {reason}".format(name=result.name, reason=_reason(result))
+        )
+    return lines
+
+
+def as_dict(results):
+    return {
+        "succeeded": succeeded(results),
+        "hosts": {result.name: result._asdict() for result in results},
+    }
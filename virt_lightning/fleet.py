@@ -0,0 +1,83 @@
+import collections
+import logging
+
+import libvirt
+
+DEFAULT_MEMORY = 768
+
+Capacity = collections.namedtuple(
+    "Capacity", ["uri", "cpus", "memory", "free_memory", "vcpus", "allocated"]
+)
+
+logger = logging.getLogger("virt_lightning")
+
+
+class Fleet:
+    def __init__(self, hypervisors):
+        # The hypervisors, indexed by their libvirt URI.
+        self.hypervisors = collections.OrderedDict(hypervisors)
+
+    def items(self):
+        for uri, hv in self.hypervisors.items():
+            for domain in hv.list_domains():
+                domain.hypervisor_uri = uri
+                yield hv, domain
+
+    def list_domains(self):
+        for _, domain in self.items():
+            yield domain
+
+    def get_domain_by_name(self, name):
+        for uri, hv in self.hypervisors.items():
+            domain = hv.get_domain_by_name(name)
+            if domain:
+                domain.hypervisor_uri = uri
+                return domain
+
+    def capacities(self):
+        return [capacity(uri, hv) for uri, hv in self.hypervisors.items()]
+
+
+def capacity(uri, hv):
+    _, memory, cpus, *_ = hv.conn.getInfo()
+    vcpus = 0
+    allocated = 0
+    # One call per hypervisor for all the running VM.
+    for _, stats in hv.conn.getAllDomainStats(
+        libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON,
+        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE,
+    ):
+        vcpus += stats.get("vcpu.current", 0)
+        allocated += stats.get("balloon.maximum", 0) // 1024
+    return Capacity(
+        uri=uri,
+        cpus=cpus,
+        memory=memory,
+        free_memory=hv.conn.getFreeMemory() // 1024**2,
+        vcpus=vcpus,
+        allocated=allocated,
+    )
+
+
+def schedule(hosts, capacities):
+    # The memory left once the running VM have all their memory, or the
+    # free memory of the host if it's lower.
+    memory = {c.uri: min(c.memory - c.allocated, c.free_memory) for c in capacities}
+    vcpus = {c.uri: c.cpus - c.vcpus for c in capacities}
+    order = [c.uri for c in capacities]
+    assignments = []
+    # The biggest VM first, they are the hardest to place.
+    for host in sorted(
+        hosts, key=lambda h: h.get("memory") or DEFAULT_MEMORY, reverse=True
+    ):
+        uri = host.get("hypervisor")
+        if uri not in memory:
+            if uri:
+                logger.warning(
+                    "%s: unknown hypervisor %s", host.get("name", host["distro"]), uri
+                )
+            uri = max(order, key=lambda u: (memory[u], vcpus[u], -order.index(u)))
+        memory[uri] -= host.get("memory") or DEFAULT_MEMORY
+        vcpus[uri] -= host.get("vcpus") or 1
+        assignments.append((uri, host))
+    return assignments
@@ -0,0 +1,32 @@
+import contextlib
+import time
+
+# The last stage is "ssh", "console" or "agent", depending on the readiness
+# check.
+PROVISIONING_STAGES = ("define", "disk", "seed", "boot", "ssh", "console", "agent")
+
+_observers = []
+
+
+def register_observer(observer):
+    _observers.append(observer)
+
+
+def unregister_observer(observer):
+    if observer in _observers:
+        _observers.remove(observer)
+
+
+@contextlib.contextmanager
+def stage(name, track, **labels):
+    start = time.time()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        end = time.time()
+        for observer in list(_observers):
+            observer(name, track, start, end, labels, failed)
@@ -0,0 +1,111 @@
+import ipaddress
+import json
+import logging
+import pathlib
+import time
+
+from virt_lightning.sshconf import jump_host
+
+INVENTORY_CACHE = "inventory.json"
+SSH_COMMON_ARGS = "-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
+# The keys of the inventory that aren't groups of VM.
+RESERVED_GROUPS = ("_meta", "all", "ungrouped")
+
+logger = logging.getLogger("virt_lightning")
+
+
+def cache_path(state_dir):
+    return pathlib.PosixPath(state_dir).expanduser() / INVENTORY_CACHE
+
+
+def host_vars(metadata, hypervisor_uri=None):
+    ssh_common_args = SSH_COMMON_ARGS
+    proxy_jump = jump_host(hypervisor_uri)
+    if proxy_jump:
+        ssh_common_args += " -o ProxyJump={proxy_jump}".format(proxy_jump=proxy_jump)
+    variables = {
+        "ansible_host": str(ipaddress.ip_interface(metadata["ipv4"]).ip),
+        "ansible_user": metadata.get("username"),
+        "ansible_python_interpreter": metadata.get("python_interpreter"),
+        "ansible_ssh_common_args": ssh_common_args,
+    }
+    if hypervisor_uri:
+        variables["vl_hypervisor"] = hypervisor_uri
+    return variables
+
+
+def build(hv, context):
+    inventory = {"_meta": {"hostvars": {}}, "all": {"children": ["ungrouped"]}}
+    ungrouped = []
+    for domain in sorted(hv.list_domains()):
+        metadata = domain.get_all_metadata()
+        if metadata.get("context") != context or not metadata.get("ipv4"):
+            continue
+        inventory["_meta"]["hostvars"][domain.name] = host_vars(
+            metadata, domain.hypervisor_uri
+        )
+        groups = []
+        for group in metadata.get("groups") or []:
+            if group in RESERVED_GROUPS:
+                logger.warning(
+                    "%s: %s is a reserved group name, ignored", domain.name, group
+                )
+                continue
+            groups.append(group)
+        for group in groups:
+            if group not in inventory:
+                inventory[group] = {"hosts": []}
+                inventory["all"]["children"].append(group)
+            inventory[group]["hosts"].append(domain.name)
+        if not groups:
+            ungrouped.append(domain.name)
+    inventory["ungrouped"] = {"hosts": ungrouped}
+    return inventory
+
+
+def load(path, context, ttl):
+    try:
+        cache = json.loads(pathlib.PosixPath(path).read_text())
+    except (OSError, ValueError):
+        return None
+    entry = cache.get(context)
+    if entry and time.time() - entry["time"] < ttl:
+        return entry["inventory"]
+    return None
+
+
+def save(path, context, inventory):
+    path = pathlib.PosixPath(path)
+    try:
+        cache = json.loads(path.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    cache[context] = {"time": time.time(), "inventory": inventory}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = path.with_suffix(".temp")
+    temp_file.write_text(json.dumps(cache))
+    temp_file.rename(path)
+
+
+def invalidate(path):
+    path = pathlib.PosixPath(path)
+    if path.exists():
+        path.unlink()
+
+
+def to_ini(inventory):
+    lines = []
+    for name, variables in inventory["_meta"]["hostvars"].items():
+        lines.append(
+            (
+                "{name} ansible_host={ansible_host} ansible_user={ansible_user} "
+                "ansible_python_interpreter={ansible_python_interpreter} "
+                'ansible_ssh_common_args="{ansible_ssh_common_args}"'
+            ).format(name=name, **variables)
+        )
+    for group in inventory["all"]["children"]:
+        if group == "ungrouped":
+            continue
+        lines.append("\n[{group}]".format(group=group))
+        lines += inventory[group]["hosts"]
+    return lines
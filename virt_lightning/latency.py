@@ -0,0 +1,113 @@
+import random
+import threading
+import time
+import urllib.parse
+
+import libvirt
+
+import virt_lightning.profiling as profiling
+
+SCHEME_PREFIX = "latency+"
+DURATION_UNITS = (("ms", 0.001), ("us", 0.000001), ("s", 1))
+
+_injectors = []
+
+
+def parse_duration(value):
+    for suffix, factor in DURATION_UNITS:
+        if value.endswith(suffix):
+            return float(value[: -len(suffix)]) * factor
+    return float(value)
+
+
+class LatencyInjector:
+    def __init__(
+        self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=0, virtual=False
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.virtual = virtual
+        self.injected = 0.0
+        self.calls = 0
+        self.failures = 0
+        self._sequence = {}
+        self._lock = threading.Lock()
+
+    def draw(self, method):
+        # One generator per call, seeded by the method and its rank, so the
+        # delays don't depend on how the threads interleave.
+        with self._lock:
+            rank = self._sequence.get(method, 0)
+            self._sequence[method] = rank + 1
+        rand = random.Random(
+            "{seed}:{method}:{rank}".format(seed=self.seed, method=method, rank=rank)
+        )
+        delay = max(self.latency + rand.uniform(-self.jitter, self.jitter), 0.0)
+        return delay, rand.random() < self.failure_rate
+
+    def before(self, method):
+        delay, fail = self.draw(method)
+        with self._lock:
+            self.calls += 1
+            self.injected += delay
+            if fail:
+                self.failures += 1
+        if not self.virtual:
+            time.sleep(delay)
+        if fail:
+            raise libvirt.libvirtError(
+                "Injected failure on {method}".format(method=method)
+            )
+
+    def after(self, method, duration, transferred):
+        pass
+
+    def summary(self):
+        return (
+            "latency injection: {calls} calls, {injected:.3f}s injected "
+            "({mode}), {failures} failures"
+        ).format(
+            calls=self.calls,
+            injected=self.injected,
+            mode="virtual" if self.virtual else "slept",
+            failures=self.failures,
+        )
+
+
+def is_latency_uri(uri):
+    return uri.startswith(SCHEME_PREFIX)
+
+
+def parse_uri(uri):
+    target, _, query_string = uri.replace(SCHEME_PREFIX, "", 1).partition("?")
+    settings = {}
+    query = []
+    for key, value in urllib.parse.parse_qsl(query_string):
+        if key in ("latency", "jitter"):
+            settings[key] = parse_duration(value)
+        elif key == "failure_rate":
+            settings[key] = float(value)
+        elif key == "seed":
+            settings[key] = value
+        elif key == "clock":
+            settings["virtual"] = value == "virtual"
+        else:
+            query.append((key, value))
+    if query:
+        target += "?" + urllib.parse.urlencode(query)
+    return target, settings
+
+
+def connect(uri):
+    if not is_latency_uri(uri):
+        return libvirt.open(uri)
+    target, settings = parse_uri(uri)
+    injector = LatencyInjector(**settings)
+    _injectors.append(injector)
+    return profiling.RPCProxy(libvirt.open(target), [injector])
+
+
+def injectors():
+    return list(_injectors)
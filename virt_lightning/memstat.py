@@ -0,0 +1,86 @@
+import collections
+
+ContextUsage = collections.namedtuple(
+    "ContextUsage", ["context", "domains", "allocated", "rss", "profiles"]
+)
+
+
+def ksm_savings(parameters, page_size):
+    # shm_pages_sharing counts the guest pages mapped on a merged page, each
+    # of them is a page saved.
+    if "shm_pages_sharing" not in parameters:
+        return None
+    return {
+        "pages_shared": parameters.get("shm_pages_shared", 0),
+        "pages_sharing": parameters["shm_pages_sharing"],
+        "pages_unshared": parameters.get("shm_pages_unshared", 0),
+        "full_scans": parameters.get("shm_full_scans", 0),
+        "saved": parameters["shm_pages_sharing"] * page_size // 1024**2,
+    }
+
+
+def by_context(usage):
+    contexts = collections.OrderedDict()
+    for domain, allocated, rss in sorted(usage, key=lambda u: u[0].name):
+        metadata = domain.get_all_metadata()
+        context = metadata.get("context", "default")
+        current = contexts.get(context, ContextUsage(context, 0, 0, 0, set()))
+        contexts[context] = current._replace(
+            domains=current.domains + 1,
+            allocated=current.allocated + allocated,
+            rss=current.rss + rss,
+            profiles=current.profiles | {metadata.get("memory_profile", "default")},
+        )
+    return list(contexts.values())
+
+
+def overcommit(allocated, host_memory):
+    if not host_memory:
+        return 0.0
+    return allocated / host_memory
+
+
+def report(contexts, host_memory, ksm):
+    allocated = sum(c.allocated for c in contexts)
+    rss = sum(c.rss for c in contexts)
+    lines = [
+        "host: {host_memory} MiB, allocated: {allocated} MiB "
+        "(overcommit {ratio:.2f}x), rss: {rss} MiB".format(
+            host_memory=host_memory,
+            allocated=allocated,
+            ratio=overcommit(allocated, host_memory),
+            rss=rss,
+        )
+    ]
+    if ksm is None:
+        lines.append("ksm: not available")
+    else:
+        lines.append(
+            "ksm: {saved} MiB saved ({pages_sharing} pages sharing "
+            "{pages_shared} pages, {full_scans} full scans)".format(**ksm)
+        )
+    template = (
+        "{context:<16} {domains:>4} {allocated:>10} {rss:>10} {ratio:>11} {profiles}"
+    )
+    lines.append(
+        template.format(
+            context="context",
+            domains="VM",
+            allocated="alloc MiB",
+            rss="rss MiB",
+            ratio="overcommit",
+            profiles="profiles",
+        )
+    )
+    for c in contexts:
+        lines.append(
+            template.format(
+                context=c.context,
+                domains=c.domains,
+                allocated=c.allocated,
+                rss=c.rss,
+                ratio="{ratio:.2f}x".format(ratio=overcommit(c.allocated, host_memory)),
+                profiles=", ".join(sorted(c.profiles)),
+            )
+        )
+    return lines
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+import threading
+
+import yaml
+
+REQUEST_TIMEOUT = 10
+MAX_HEADERS = 100
+REASONS = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}
+
+logger = logging.getLogger("virt_lightning")
+
+
+def nocloud_path(mac):
+    return "nocloud/{mac}/".format(mac=mac.replace(":", "-"))
+
+
+def payloads(seed):
+    meta_data = seed["meta_data"]
+    ssh_key = meta_data["public_keys"]["default"]
+    ec2 = {
+        "instance-id": meta_data["uuid"],
+        "hostname": meta_data["hostname"],
+        "local-hostname": meta_data["local-hostname"],
+        "local-ipv4": seed["ipv4"],
+        "mac": seed["mac"],
+    }
+    files = {
+        "openstack": "latest\n",
+        "openstack/latest": "meta_data.json\nnetwork_data.json\nuser_data\n",
+        "openstack/latest/meta_data.json": json.dumps(meta_data),
+        "openstack/latest/network_data.json": json.dumps(seed["network_data"]),
+        "openstack/latest/user_data": seed["user_data"],
+        "openstack/latest/vendor_data.json": "{}",
+        "latest/meta-data": "\n".join(sorted(ec2) + ["public-keys/"]) + "\n",
+        "latest/meta-data/public-keys": "0=default\n",
+        "latest/meta-data/public-keys/0": "openssh-key\n",
+        "latest/meta-data/public-keys/0/openssh-key": ssh_key + "\n",
+        "latest/user-data": seed["user_data"],
+    }
+    for key, value in ec2.items():
+        files["latest/meta-data/" + key] = value + "\n"
+    # The NoCloud layout, the URL of the seed is in the SMBIOS serial.
+    nocloud = nocloud_path(seed["mac"])
+    files[nocloud + "meta-data"] = yaml.dump(
+        {
+            "instance-id": meta_data["uuid"],
+            "local-hostname": meta_data["local-hostname"],
+        },
+        Dumper=yaml.Dumper,
+    )
+    files[nocloud + "user-data"] = seed["user_data"]
+    files[nocloud + "vendor-data"] = ""
+    return files
+
+
+class MetadataService:
+    def __init__(self, port):
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.servers = {}
+        # The payloads of a VM, by IPv4 address, and the IPv4 address by
+        # name of VM.
+        self.files = {}
+        self.addresses = {}
+        self._lock = threading.Lock()
+        self._listen_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def listen(self, host):
+        # One server per gateway, the service isn't reachable from the
+        # other networks of the host.
+        with self._listen_lock:
+            if host in self.servers:
+                return
+            future = asyncio.run_coroutine_threadsafe(
+                asyncio.start_server(self.handle, host=host, port=self.port),
+                self.loop,
+            )
+            self.servers[host] = future.result()
+        logger.info("Metadata service listening on %s:%d", host, self.port)
+
+    def url(self, seed):
+        return "http://{gateway}:{port}/{path}".format(
+            gateway=seed["gateway"], port=self.port, path=nocloud_path(seed["mac"])
+        )
+
+    def register(self, seed):
+        self.listen(seed["gateway"])
+        with self._lock:
+            self.files[seed["ipv4"]] = payloads(seed)
+            self.addresses[seed["name"]] = seed["ipv4"]
+        return self.url(seed)
+
+    def unregister(self, name):
+        # The seed has the admin password, it doesn't outlive the VM.
+        with self._lock:
+            ipv4 = self.addresses.pop(name, None)
+            if ipv4 and ipv4 not in self.addresses.values():
+                self.files.pop(ipv4, None)
+
+    def respond(self, method, path, peer):
+        if method not in ("GET", "HEAD"):
+            return 405, b""
+        path = path.partition("?")[0].strip("/")
+        # Only the address of the peer tells which VM it is, the MAC address
+        # of the NoCloud URL can be guessed.
+        with self._lock:
+            files = self.files.get(peer)
+        if files is None:
+            return 404, b""
+        content = files.get(path)
+        if content is None:
+            return 404, b""
+        return 200, content.encode()
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            for _ in range(MAX_HEADERS):
+                line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            method, path, _ = request.decode("latin-1").split(" ", 2)
+            status, body = self.respond(
+                method, path, writer.get_extra_info("peername")[0]
+            )
+            logger.debug("metadata: %s %s %s", method, path, status)
+            writer.write(
+                "HTTP/1.0 {status} {reason}\r\n"
+                "Content-Type: text/plain\r\n"
+                "Content-Length: {length}\r\n"
+                "Connection: close\r\n\r\n".format(
+                    status=status, reason=REASONS[status], length=len(body)
+                ).encode()
+            )
+            if method != "HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
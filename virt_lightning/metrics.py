@@ -0,0 +1,331 @@
+import http.server
+import json
+import logging
+import pathlib
+import socketserver
+import threading
+import time
+
+import libvirt
+
+from virt_lightning.instrumentation import PROVISIONING_STAGES
+import virt_lightning.virt_lightning as vl
+
+PROVISIONING_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, float("inf"))
+PROVISIONING_LOG = "provisioning.log"
+
+DOMAIN_STATS = sum(
+    (
+        libvirt.VIR_DOMAIN_STATS_STATE,
+        libvirt.VIR_DOMAIN_STATS_CPU_TOTAL,
+        libvirt.VIR_DOMAIN_STATS_BALLOON,
+        libvirt.VIR_DOMAIN_STATS_VCPU,
+        libvirt.VIR_DOMAIN_STATS_INTERFACE,
+        libvirt.VIR_DOMAIN_STATS_BLOCK,
+    )
+)
+
+logger = logging.getLogger("virt_lightning")
+
+
+def provisioning_log_path(state_dir):
+    return pathlib.PosixPath(state_dir).expanduser() / PROVISIONING_LOG
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return str(value)
+
+
+def escape_label_value(value):
+    return (
+        format_value(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name = "{name}{{{labels}}}".format(
+            name=name,
+            labels=",".join(
+                '{k}="{v}"'.format(k=k, v=escape_label_value(v))
+                for k, v in labels.items()
+            ),
+        )
+    return "{name} {value}".format(name=name, value=format_value(value))
+
+
+def sum_device_stats(record, device, field):
+    count = record.get("{device}.count".format(device=device), 0)
+    return sum(
+        record.get("{device}.{i}.{field}".format(device=device, i=i, field=field), 0)
+        for i in range(count)
+    )
+
+
+class MetricFamily:
+    def __init__(self, name, metric_type, description):
+        self.name = name
+        self.metric_type = metric_type
+        self.description = description
+        self.samples = []
+
+    def add(self, labels, value, suffix=""):
+        self.samples.append((self.name + suffix, labels, value))
+
+    def render(self):
+        lines = [
+            "# HELP {name} {description}".format(
+                name=self.name, description=self.description
+            ),
+            "# TYPE {name} {metric_type}".format(
+                name=self.name, metric_type=self.metric_type
+            ),
+        ]
+        for name, labels, value in self.samples:
+            lines.append(format_sample(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+class Histogram:
+    def __init__(self, buckets=PROVISIONING_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def add_to(self, family, labels):
+        for upper_bound, count in zip(self.buckets, self.counts):
+            bucket_labels = dict(labels)
+            bucket_labels["le"] = upper_bound
+            family.add(bucket_labels, count, suffix="_bucket")
+        family.add(labels, self.sum, suffix="_sum")
+        family.add(labels, self.count, suffix="_count")
+
+
+class ProvisioningLog:
+    def __init__(self, path):
+        self.path = pathlib.PosixPath(path)
+        self._lock = threading.Lock()
+
+    def observe(self, name, track, start, end, labels, failed):
+        if name not in PROVISIONING_STAGES:
+            return
+        entry = {
+            "stage": name,
+            "domain": track,
+            "distro": labels.get("distro") or "",
+            "start": start,
+            "duration": end - start,
+            "failed": failed,
+        }
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as fd:
+                fd.write(line)
+
+
+class ProvisioningStats:
+    def __init__(self, path):
+        self.path = pathlib.PosixPath(path)
+        self.reset()
+
+    def reset(self):
+        self._offset = 0
+        self.histograms = {}
+        self.counters = {}
+
+    def update(self):
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return
+        if size < self._offset:
+            self.reset()
+        with self.path.open("rb") as fd:
+            fd.seek(self._offset)
+            for line in fd:
+                if not line.endswith(b"\n"):
+                    break
+                self._offset += len(line)
+                try:
+                    entry = json.loads(line.decode())
+                except ValueError:
+                    logger.debug("Ignoring invalid provisioning entry: %s", line)
+                    continue
+                self.add(entry)
+
+    def add(self, entry):
+        result = "failure" if entry["failed"] else "success"
+        key = (entry["stage"], entry["distro"], result)
+        self.counters[key] = self.counters.get(key, 0) + 1
+        if entry["failed"]:
+            return
+        key = (entry["stage"], entry["distro"])
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(entry["duration"])
+
+    def families(self):
+        counter = MetricFamily(
+            "vl_provisioning_stage_total",
+            "counter",
+            "Number of provisioning stages run by vl up and vl start.",
+        )
+        for (stage, distro, result), value in sorted(self.counters.items()):
+            counter.add({"stage": stage, "distro": distro, "result": result}, value)
+        histogram = MetricFamily(
+            "vl_provisioning_stage_seconds",
+            "histogram",
+            "Duration of the successful provisioning stages.",
+        )
+        for (stage, distro), h in sorted(self.histograms.items()):
+            h.add_to(histogram, {"stage": stage, "distro": distro})
+        return [counter, histogram]
+
+
+class DomainCollector:
+    def __init__(self, conn):
+        self.conn = conn
+        self._labels = {}
+
+    def labels(self, dom):
+        uuid = dom.UUIDString()
+        if uuid not in self._labels:
+            domain = vl.LibvirtDomain(dom)
+            self._labels[uuid] = {
+                "name": dom.name(),
+                "context": domain.context or "",
+                "distro": domain.distro or "",
+                "groups": domain.groups,
+            }
+        return self._labels[uuid]
+
+    def families(self):
+        state = MetricFamily("vl_domain_state", "gauge", "libvirt state of the domain.")
+        cpu = MetricFamily(
+            "vl_domain_cpu_seconds_total", "counter", "CPU time used by the domain."
+        )
+        vcpus = MetricFamily("vl_domain_vcpus", "gauge", "Number of active vCPU.")
+        memory = MetricFamily(
+            "vl_domain_memory_bytes", "gauge", "Current memory of the domain."
+        )
+        block_read = MetricFamily(
+            "vl_domain_block_read_bytes_total", "counter", "Bytes read from disks."
+        )
+        block_write = MetricFamily(
+            "vl_domain_block_write_bytes_total", "counter", "Bytes written on disks."
+        )
+        net_rx = MetricFamily(
+            "vl_domain_network_receive_bytes_total", "counter", "Bytes received."
+        )
+        net_tx = MetricFamily(
+            "vl_domain_network_transmit_bytes_total", "counter", "Bytes transmitted."
+        )
+        group = MetricFamily(
+            "vl_domain_group", "gauge", "Ansible groups of the domain."
+        )
+        domains = MetricFamily(
+            "vl_domains", "gauge", "Number of domains per context and distro."
+        )
+
+        per_context = {}
+        seen = set()
+        for dom, record in self.conn.getAllDomainStats(DOMAIN_STATS, 0):
+            seen.add(dom.UUIDString())
+            info = self.labels(dom)
+            labels = {k: info[k] for k in ("name", "context", "distro")}
+            state.add(labels, record.get("state.state", 0))
+            cpu.add(labels, record.get("cpu.time", 0) / 1e9)
+            vcpus.add(labels, record.get("vcpu.current", 0))
+            memory.add(labels, record.get("balloon.current", 0) * 1024)
+            block_read.add(labels, sum_device_stats(record, "block", "rd.bytes"))
+            block_write.add(labels, sum_device_stats(record, "block", "wr.bytes"))
+            net_rx.add(labels, sum_device_stats(record, "net", "rx.bytes"))
+            net_tx.add(labels, sum_device_stats(record, "net", "tx.bytes"))
+            for group_name in info["groups"]:
+                group.add(
+                    {
+                        "name": info["name"],
+                        "context": info["context"],
+                        "group": group_name,
+                    },
+                    1,
+                )
+            key = (info["context"], info["distro"])
+            per_context[key] = per_context.get(key, 0) + 1
+
+        for (context, distro), count in sorted(per_context.items()):
+            domains.add({"context": context, "distro": distro}, count)
+
+        for uuid in set(self._labels) - seen:
+            del self._labels[uuid]
+
+        return [
+            domains,
+            state,
+            cpu,
+            vcpus,
+            memory,
+            block_read,
+            block_write,
+            net_rx,
+            net_tx,
+            group,
+        ]
+
+
+class Exporter:
+    def __init__(self, collector, provisioning_stats, cache_ttl=15):
+        self.collector = collector
+        self.provisioning_stats = provisioning_stats
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._cache = None
+        self._cache_time = 0
+
+    def render(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._cache is not None and now - self._cache_time < self.cache_ttl:
+                return self._cache
+            self.provisioning_stats.update()
+            families = self.collector.families() + self.provisioning_stats.families()
+            self._cache = "".join(f.render() for f in families)
+            self._cache_time = now
+            return self._cache
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def make_server(exporter, address, port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = exporter.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logger.debug(fmt, *args)
+
+    return ThreadingHTTPServer((address, port), MetricsHandler)
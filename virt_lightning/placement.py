@@ -0,0 +1,129 @@
+import collections
+import json
+import logging
+import pathlib
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+PLACEMENT_STATE = "placement.json"
+STRATEGIES = ("spread", "pack")
+
+Node = collections.namedtuple("Node", ["id", "cpus", "memory"])
+Assignment = collections.namedtuple(
+    "Assignment", ["node", "cpus", "node_cpus", "memory", "mode"]
+)
+
+logger = logging.getLogger("virt_lightning")
+
+
+def state_path(state_dir, uri=None):
+    path = pathlib.PosixPath(state_dir).expanduser() / PLACEMENT_STATE
+    if not uri:
+        return path
+    # One file per additional hypervisor.
+    return path.with_name(
+        "placement-{uri}.json".format(uri=re.sub(r"[^a-zA-Z0-9]+", "_", uri))
+    )
+
+
+def topology(capabilities):
+    root = ET.fromstring(capabilities)
+    nodes = []
+    for cell in root.findall("./host/topology/cells/cell"):
+        memory = cell.find("./memory")
+        nodes.append(
+            Node(
+                id=int(cell.attrib["id"]),
+                cpus=tuple(int(cpu.attrib["id"]) for cpu in cell.findall("./cpus/cpu")),
+                memory=int(memory.text) // 1024 if memory is not None else 0,
+            )
+        )
+    return [node for node in nodes if node.cpus]
+
+
+class Placer:
+    def __init__(self, nodes, path, strategy="spread", defined=None):
+        self.nodes = nodes
+        self.path = pathlib.PosixPath(path)
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self.assignments = self._load()
+        # The VM removed since the last run free their CPU.
+        if defined is not None:
+            self.assignments = {
+                uuid: assignment
+                for uuid, assignment in self.assignments.items()
+                if uuid in defined
+            }
+
+    def _load(self):
+        if not self.path.exists():
+            return {}
+        try:
+            return json.loads(self.path.read_text())
+        except ValueError:
+            logger.warning("Ignoring the corrupted placement state %s", self.path)
+            return {}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.path.with_suffix(".temp")
+        temp_file.write_text(json.dumps(self.assignments, indent=2, sort_keys=True))
+        temp_file.rename(self.path)
+
+    def usage(self):
+        cpu_load = collections.Counter()
+        memory = collections.Counter()
+        for assignment in self.assignments.values():
+            cpu_load.update(assignment["cpus"])
+            memory[assignment["node"]] += assignment["memory"]
+        return cpu_load, memory
+
+    def choose(self, vcpus, memory):
+        cpu_load, memory_used = self.usage()
+
+        def fits(node):
+            pinned = sum(cpu_load[cpu] for cpu in node.cpus)
+            if len(node.cpus) - pinned < vcpus:
+                return False
+            return node.memory - memory_used[node.id] >= memory
+
+        candidates = [node for node in self.nodes if fits(node)]
+        mode = "strict"
+        if not candidates:
+            # Overcommit, the memory may come from another node.
+            candidates = self.nodes
+            mode = "preferred"
+
+        def load(node):
+            pinned = sum(cpu_load[cpu] for cpu in node.cpus)
+            used = memory_used[node.id] / node.memory if node.memory else 0
+            return (pinned / len(node.cpus), used)
+
+        if self.strategy == "pack":
+            # Fill the busiest node first, the other ones stay free for the
+            # big VM.
+            node = max(candidates, key=lambda n: (load(n), -n.id))
+        else:
+            node = min(candidates, key=lambda n: (load(n), n.id))
+        cpus = sorted(node.cpus, key=lambda cpu: (cpu_load[cpu], cpu))
+        return Assignment(
+            node=node.id,
+            cpus=[cpus[i % len(cpus)] for i in range(vcpus)],
+            node_cpus=list(node.cpus),
+            memory=memory,
+            mode=mode,
+        )
+
+    def assign(self, uuid, name, vcpus, memory):
+        with self._lock:
+            assignment = self.choose(vcpus, memory)
+            self.assignments[uuid] = {
+                "name": name,
+                "node": assignment.node,
+                "cpus": assignment.cpus,
+                "memory": memory,
+            }
+            self.save()
+        return assignment
@@ -0,0 +1,153 @@
+import threading
+import time
+
+import libvirt
+
+LIBVIRT_CLASSES = (
+    libvirt.virConnect,
+    libvirt.virDomain,
+    libvirt.virNetwork,
+    libvirt.virStoragePool,
+    libvirt.virStorageVol,
+    libvirt.virStream,
+)
+# Served from the client side cache of the bindings, they never reach libvirtd.
+LOCAL_METHODS = ("name", "UUID", "UUIDString", "ID", "key", "connect")
+
+_hooks = []
+
+
+def payload_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in value.items())
+    return 0
+
+
+class RPCProxy:
+    def __init__(self, obj, hooks):
+        self._obj = obj
+        self._hooks = hooks
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        if name in LOCAL_METHODS:
+            return lambda *args, **kwargs: wrap(attr(*args, **kwargs), self._hooks)
+        method = "{cls}.{name}".format(cls=self._obj.__class__.__name__, name=name)
+
+        def call(*args, **kwargs):
+            for hook in self._hooks:
+                hook.before(method)
+            result = None
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                transferred = payload_size(args) + payload_size(result)
+                for hook in self._hooks:
+                    hook.after(method, duration, transferred)
+            return wrap(result, self._hooks)
+
+        return call
+
+    # Keep isinstance() working for the callers of the wrapped objects.
+    @property
+    def __class__(self):
+        return self._obj.__class__
+
+    def __repr__(self):
+        return "RPCProxy({obj!r})".format(obj=self._obj)
+
+
+def wrap(value, hooks=None):
+    if hooks is None:
+        hooks = _hooks
+    if not hooks:
+        return value
+    if isinstance(value, LIBVIRT_CLASSES):
+        return RPCProxy(value, hooks)
+    if isinstance(value, list):
+        return [wrap(v, hooks) for v in value]
+    if isinstance(value, tuple):
+        return tuple(wrap(v, hooks) for v in value)
+    return value
+
+
+class RPCStats:
+    def __init__(self, command=None):
+        self.command = command
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def before(self, method):
+        pass
+
+    def after(self, method, duration, transferred):
+        key = (self.command, method)
+        with self._lock:
+            count, total, size = self.calls.get(key, (0, 0.0, 0))
+            self.calls[key] = (count + 1, total + duration, size + transferred)
+
+    @property
+    def total(self):
+        return sum(count for count, _, _ in self.calls.values())
+
+    def by_method(self, command=None):
+        return {
+            method: value
+            for (cmd, method), value in self.calls.items()
+            if command is None or cmd == command
+        }
+
+    def report(self):
+        lines = []
+        for command in sorted({cmd for cmd, _ in self.calls}, key=str):
+            calls = self.by_method(command)
+            lines.append(
+                "libvirt RPC for {command}: {count} calls, {total:.1f} ms".format(
+                    command=command,
+                    count=sum(c for c, _, _ in calls.values()),
+                    total=sum(t for _, t, _ in calls.values()) * 1000,
+                )
+            )
+            lines.append(
+                "  {method:<40} {count:>7} {total:>11} {avg:>9} {size:>11}".format(
+                    method="method",
+                    count="calls",
+                    total="total ms",
+                    avg="avg ms",
+                    size="bytes",
+                )
+            )
+            for method, (count, total, size) in sorted(
+                calls.items(), key=lambda i: i[1][1], reverse=True
+            ):
+                lines.append(
+                    "  {method:<40} {count:>7} {total:>11.1f} {avg:>9.2f} {size:>11}".format(
+                        method=method,
+                        count=count,
+                        total=total * 1000,
+                        avg=total * 1000 / count,
+                        size=size,
+                    )
+                )
+        return lines
+
+
+def enable(command=None):
+    stats = RPCStats(command)
+    _hooks.append(stats)
+    return stats
+
+
+def disable(stats):
+    if stats in _hooks:
+        _hooks.remove(stats)
@@ -1,39 +1,113 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor
 import argparse
-import asyncio
 import logging
 import os
 import pathlib
 import re
-import urllib.request
 import sys
-import distutils.util
-
-import libvirt
-import yaml
 
 from virt_lightning.configuration import Configuration
+from virt_lightning.instrumentation import register_observer, stage
 from virt_lightning.symbols import get_symbols
-import virt_lightning.ui as ui
-import virt_lightning.virt_lightning as vl
+
+# The subcommand dependencies (libvirt, yaml, urwid...) are imported by the
+# commands themselves to keep the argument parsing fast.
 
 symbols = get_symbols()
 logger = logging.getLogger("virt_lightning")
-logger.setLevel(logging.INFO)
-ch = logging.StreamHandler()
-logger.addHandler(ch)
+
+BOOLEAN_TRUE = ("y", "yes", "t", "true", "on", "1")
+
+# Hypervisors kept open by vl daemon, indexed by libvirt URI.
+_hypervisors = {}
 
 
 def libvirt_callback(userdata, err):
     pass
 
 
-libvirt.registerErrorHandler(f=libvirt_callback, ctx=None)
+def _strtobool(value):
+    return str(value).lower() in BOOLEAN_TRUE
+
+
+def _connect(configuration, uri=None):
+    import libvirt
+    import virt_lightning.latency as latency
+    import virt_lightning.profiling as profiling
+
+    libvirt.registerErrorHandler(f=libvirt_callback, ctx=None)
+    return profiling.wrap(latency.connect(uri or configuration.libvirt_uri))
+
+
+def _hypervisor(configuration, uri=None):
+    import virt_lightning.virt_lightning as vl
+
+    uri = uri or configuration.libvirt_uri
+    if uri in _hypervisors:
+        return _hypervisors[uri]
+    return vl.LibvirtHypervisor(_connect(configuration, uri))
+
+
+def _fleet(configuration):
+    import virt_lightning.fleet as fleet
+
+    return fleet.Fleet(
+        (uri, _hypervisor(configuration, uri)) for uri in configuration.libvirt_uris
+    )
+
+
+def _allocate_ipv4(hv, configuration):
+    import virt_lightning.daemon as vl_daemon
+
+    # The daemon serialises the allocations of the concurrent vl processes,
+    # it only knows the first hypervisor.
+    if len(configuration.libvirt_uris) == 1:
+        response = vl_daemon.call(configuration, "allocate_ipv4")
+        if response:
+            return response["ipv4"]
+    return hv.get_free_ipv4()
+
 
+def _metadata_service(configuration):
+    import virt_lightning.daemon as vl_daemon
 
-def _start_domain(hv, host, context, configuration):
+    if not _strtobool(configuration.metadata_service):
+        return None
+    if len(configuration.libvirt_uris) > 1:
+        return None
+
+    def register(seed):
+        # Without the daemon, the seed goes on an ISO image.
+        response = vl_daemon.call(configuration, "register_seed", seed)
+        if response:
+            return response["url"]
+        logger.debug("%s: the metadata service is not available", seed["name"])
+
+    return register
+
+
+def _attach_network(hv, domain, configuration, network):
+    # The virt-lightning network is split in several libvirt networks, the
+    # IPv4 address tells which one.
+    ipv4 = network.get("ipv4")
+    if network.get("network") == configuration.network_name and ipv4 and ipv4 != "dhcp":
+        shard = hv.get_network_for_ip(ipv4)
+        network["network"] = shard.name
+        if "/" not in str(ipv4):
+            network["ipv4"] = "{ipv4}/{prefix}".format(
+                ipv4=ipv4, prefix=shard.network.prefixlen
+            )
+    domain.attachNetwork(**network)
+
+
+def _host_name(host):
+    if "name" not in host:
+        host["name"] = re.sub(r"[^a-zA-Z0-9-]+", "", host["distro"])
+    return host["name"]
+
+
+def _start_domain(hv, host, context, configuration, placer=None):
     if host["distro"] not in hv.distro_available():
         logger.error("distro not available: %s", host["distro"])
         logger.info(
@@ -41,10 +115,7 @@ def _start_domain(hv, host, context, configuration):
         )
         exit()
 
-    if "name" not in host:
-        host["name"] = re.sub(r"[^a-zA-Z0-9-]+", "", host["distro"])
-
-    if hv.get_domain_by_name(host["name"]):
+    if hv.get_domain_by_name(_host_name(host)):
         logger.info("Skipping {name}, already here.".format(**host))
         return
 
@@ -63,81 +134,309 @@ def _start_domain(hv, host, context, configuration):
         "fqdn": host.get("fqdn"),
         "default_nic_mode": host.get("default_nic_model"),
         "bootcmd": host.get("bootcmd"),
+        "memory_profile": host.get("memory_profile", configuration.memory_profile),
     }
-    domain = hv.create_domain(name=host["name"], distro=host["distro"])
-    hv.configure_domain(domain, user_config)
-    domain.context = context
-    root_disk_path = hv.create_disk(
-        name=host["name"],
-        backing_on=host["distro"],
-        size=host.get("root_disk_size", 15),
-    )
-    domain.add_root_disk(root_disk_path)
-    networks = host.get("networks", [{"network": configuration.network_name}])
-    for i, network in enumerate(networks):
-        if i == 0 and not network.get("ipv4"):
-            network["ipv4"] = hv.get_free_ipv4()
-        domain.attachNetwork(**network)
-    hv.start(domain, metadata_format=host.get("metadata_format", {}))
+    with stage("define", host["name"], distro=host["distro"]):
+        with stage("defineXML", host["name"]):
+            machine_profile = host.get(
+                "machine_profile",
+                hv.get_distro_configuration(host["distro"]).get(
+                    "machine_profile", configuration.machine_profile
+                ),
+            )
+            domain = hv.create_domain(
+                name=host["name"],
+                distro=host["distro"],
+                machine_profile=machine_profile,
+            )
+        with domain.batch_metadata():
+            with stage("configure", host["name"]):
+                hv.configure_domain(domain, user_config)
+                domain.context = context
+            if placer:
+                assignment = placer.assign(
+                    domain.dom.UUIDString(), domain.name, domain.vcpus, domain.memory
+                )
+                domain.set_placement(assignment)
+                logger.debug(
+                    "%s: NUMA node %s, CPU %s",
+                    domain.name,
+                    assignment.node,
+                    assignment.cpus,
+                )
+            with stage("attach_network", host["name"]):
+                networks = host.get(
+                    "networks", [{"network": configuration.network_name}]
+                )
+                for i, network in enumerate(networks):
+                    if i == 0 and not network.get("ipv4"):
+                        network["ipv4"] = _allocate_ipv4(hv, configuration)
+                    _attach_network(hv, domain, configuration, network)
+            for share in host.get("shares", []):
+                domain.attachShare(**share)
+    with stage("disk", host["name"], distro=host["distro"]):
+        with stage("create_disk", host["name"]):
+            root_disk_path = hv.create_disk(
+                name=host["name"],
+                backing_on=host["distro"],
+                size=host.get("root_disk_size", 15),
+                pool=hv.choose_storage_pool(
+                    configuration.storage_placement, host.get("storage_pool")
+                ),
+            )
+        domain.add_root_disk(root_disk_path)
+    hv.start(
+        domain,
+        metadata_format=host.get("metadata_format", {}),
+        metadata_service=_metadata_service(configuration),
+    )
+    _invalidate_inventory(configuration)
     return domain
 
 
-def up(virt_lightning_yaml, configuration, context, **kwargs):
-    def myDomainEventAgentLifecycleCallback(conn, dom, state, reason, opaque):
-        if state == 1:
-            logger.info("%s %s QEMU agent found", symbols.CUSTOMS.value, dom.name())
+def _placer(hv, configuration, strategy, uri=None):
+    import virt_lightning.placement as placement
+
+    if not strategy:
+        return None
+    nodes = hv.get_numa_topology()
+    if not nodes:
+        logger.warning("No NUMA topology found, the VM won't be pinned")
+        return None
+    if uri == configuration.libvirt_uri:
+        uri = None
+    return placement.Placer(
+        nodes,
+        placement.state_path(configuration.state_dir, uri),
+        strategy=strategy,
+        defined={d.dom.UUIDString() for d in hv.list_domains()},
+    )
+
+
+def _clone_domain(hv, source, name, backing_file, context, configuration):
+    logger.info(
+        "{lightning} {name} (clone of {source})".format(
+            lightning=symbols.LIGHTNING.value, name=name, source=source.name
+        )
+    )
+    user_config = {
+        "groups": source.groups,
+        "memory": source.memory,
+        "python_interpreter": source.python_interpreter,
+        "root_password": source.root_password,
+        "ssh_key_file": configuration.ssh_key_file,
+        "username": source.username,
+        "vcpus": source.vcpus,
+        "memory_profile": source.memory_profile,
+    }
+    with stage("define", name, distro=source.distro):
+        domain = hv.create_domain(
+            name=name, distro=source.distro, machine_profile=source.machine_profile
+        )
+        with domain.batch_metadata():
+            hv.configure_domain(domain, user_config)
+            domain.context = context
+            _attach_network(
+                hv,
+                domain,
+                configuration,
+                {
+                    "network": configuration.network_name,
+                    "ipv4": _allocate_ipv4(hv, configuration),
+                },
+            )
+    with stage("disk", name, distro=source.distro):
+        root_disk_path = hv.create_disk(
+            name=name,
+            backing_file=backing_file,
+            size=hv.get_disk_capacity(backing_file),
+        )
+        domain.add_root_disk(root_disk_path)
+    # The new instance id of the seed makes cloud-init set the hostname,
+    # the network and the SSH keys again.
+    hv.start(
+        domain, metadata_format={}, metadata_service=_metadata_service(configuration)
+    )
+    _invalidate_inventory(configuration)
+    return domain
+
+
+def _record_provisioning(configuration):
+    import virt_lightning.metrics as metrics
+    import virt_lightning.tracing as tracing
+
+    log = metrics.ProvisioningLog(
+        metrics.provisioning_log_path(configuration.state_dir)
+    )
+    register_observer(log.observe)
+    tracer = tracing.Tracer()
+    register_observer(tracer.observe)
+    return tracer
+
+
+def _report_provisioning(tracer, trace=None, process_name="vl"):
+    for line in tracer.summary():
+        logger.info(line)
+    if trace:
+        tracer.write(trace, process_name=process_name)
+        logger.info("Trace written in %s", trace)
+
+
+def _register_event_loop(loop):
+    import libvirt
 
-    loop = asyncio.get_event_loop()
     try:
         import libvirtaio
 
         libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+        return True
     except ImportError:
         libvirt.virEventRegisterDefaultImpl()
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+        return False
 
-    conn.setKeepAlive(5, 3)
-    conn.domainEventRegisterAny(
-        None,
-        libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE,
-        myDomainEventAgentLifecycleCallback,
-        None,
-    )
 
-    hv.init_network(configuration.network_name, configuration.network_cidr)
-    hv.init_storage_pool(configuration.storage_pool)
+async def _wait_ready(domain, capture, readiness):
+    import asyncio
+
+    import virt_lightning.agent as agent
+
+    if readiness in agent.PROBES or readiness.startswith("file:"):
+        # Through the QEMU guest agent, the VM doesn't need a network.
+        with stage("agent", domain.name, distro=domain.distro):
+            await agent.wait_ready(domain, readiness)
+        logger.info(
+            "%s %s is ready: %s", symbols.COMPUTER.value, domain.name, readiness
+        )
+        return
+
+    if readiness != "console" or not capture:
+        await domain.reachable()
+        return
+
+    # The first of the readiness pattern on the console or the SSH port, in
+    # case the image doesn't print anything on the serial console.
+    with stage("console", domain.name, distro=domain.distro):
+        ssh_probe = asyncio.ensure_future(domain.ssh_probe())
+        console = asyncio.ensure_future(capture.done.wait())
+        await asyncio.wait([ssh_probe, console], return_when=asyncio.FIRST_COMPLETED)
+        if capture.matched:
+            logger.info(
+                "%s %s is ready: %s",
+                symbols.COMPUTER.value,
+                domain.name,
+                capture.matched,
+            )
+        else:
+            await ssh_probe
+        ssh_probe.cancel()
+        console.cancel()
+
+
+def up(
+    virt_lightning_yaml,
+    configuration,
+    context,
+    trace=None,
+    readiness="ssh",
+    placement=None,
+    **kwargs
+):
+    def myDomainEventAgentLifecycleCallback(conn, dom, state, reason, opaque):
+        if state == 1:
+            logger.info("%s %s QEMU agent found", symbols.CUSTOMS.value, dom.name())
+
+    from concurrent.futures import ThreadPoolExecutor
+    import asyncio
+
+    import libvirt
+
+    import virt_lightning.console as console
+    import virt_lightning.fleet as fleet
+
+    loop = asyncio.get_event_loop()
+    capture_console = _register_event_loop(loop)
+    nodes = _fleet(configuration)
+    for hv in nodes.hypervisors.values():
+        hv.conn.setKeepAlive(5, 3)
+        hv.conn.domainEventRegisterAny(
+            None,
+            libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE,
+            myDomainEventAgentLifecycleCallback,
+            None,
+        )
+        hv.init_network(configuration.network_name, configuration.network_cidr)
+        hv.init_storage_pool(configuration.storage_pool)
+        hv.init_data_pools(configuration.storage_pools)
+    tracer = _record_provisioning(configuration)
+
+    if len(nodes.hypervisors) > 1:
+        hosts = []
+        for host in virt_lightning_yaml:
+            if nodes.get_domain_by_name(_host_name(host)):
+                logger.info("Skipping {name}, already here.".format(**host))
+            else:
+                hosts.append(host)
+        assignments = fleet.schedule(hosts, nodes.capacities())
+    else:
+        assignments = [
+            (configuration.libvirt_uri, host) for host in virt_lightning_yaml
+        ]
+    placers = {
+        uri: _placer(hv, configuration, placement, uri)
+        for uri, hv in nodes.hypervisors.items()
+    }
 
     pool = ThreadPoolExecutor(max_workers=10)
 
     async def deploy():
         futures = []
-        for host in virt_lightning_yaml:
-            futures.append(
-                loop.run_in_executor(
-                    pool, _start_domain, hv, host, context, configuration
-                )
+        for uri, host in assignments:
+            hv = nodes.hypervisors[uri]
+            if len(nodes.hypervisors) > 1:
+                logger.debug("%s goes on %s", host["name"], uri)
+            future = loop.run_in_executor(
+                pool, _start_domain, hv, host, context, configuration, placers[uri]
             )
+            futures.append((hv, future))
 
         domain_reachable_futures = []
-        for f in futures:
+        for hv, f in futures:
             await f
             domain = f.result()
             if domain:
-                domain_reachable_futures.append(domain.reachable())
+                capture = None
+                if capture_console:
+                    capture = console.capture(hv.conn, domain, configuration.state_dir)
+                    captures.append(capture)
+                domain_reachable_futures.append(_wait_ready(domain, capture, readiness))
         logger.info("%s ok Waiting...", symbols.HOURGLASS.value)
 
         await asyncio.gather(*domain_reachable_futures)
 
-    loop.run_until_complete(deploy())
+    captures = []
+    try:
+        loop.run_until_complete(deploy())
+    finally:
+        for capture in captures:
+            if capture:
+                capture.close()
+    _report_provisioning(tracer, trace, process_name="vl up")
     logger.info("%s You are all set", symbols.THUMBS_UP.value)
 
 
-def start(configuration, context, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+def start(configuration, context, trace=None, readiness="ssh", **kwargs):
+    import asyncio
+
+    import virt_lightning.console as console
+
+    loop = asyncio.get_event_loop()
+    capture_console = _register_event_loop(loop)
+    hv = _hypervisor(configuration)
+    conn = hv.conn
     hv.init_network(configuration.network_name, configuration.network_cidr)
     hv.init_storage_pool(configuration.storage_pool)
+    hv.init_data_pools(configuration.storage_pools)
+    tracer = _record_provisioning(configuration)
     host = {
         k: kwargs[k] for k in ["name", "distro", "memory", "vcpus"] if kwargs.get(k)
     }
@@ -145,30 +444,24 @@ def start(configuration, context, **kwargs):
     if not domain:
         return
 
-    loop = asyncio.get_event_loop()
-
-    if not kwargs["noconsole"]:
-        import time
-
-        time.sleep(4)
-        stream = conn.newStream(libvirt.VIR_STREAM_NONBLOCK)
-        console = domain.dom.openConsole(None, stream, 0)
-        import libvirtaio
-
-        libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+    def echo(text):
+        print("\033[0m", "\033[30m", text, end="")  # noqa: T001
 
-        def stream_callback(stream, events, _):
-            line = stream.recv(1024).decode()
-            print("\033[0m", "\033[30m", line, end="")  # noqa: T001
-
-        stream.eventAddCallback(
-            libvirt.VIR_STREAM_EVENT_READABLE, stream_callback, console
+    capture = None
+    if capture_console:
+        capture = console.capture(
+            conn,
+            domain,
+            configuration.state_dir,
+            echo=None if kwargs["noconsole"] else echo,
         )
-
-    async def deploy():
-        await domain.reachable()
-
-    loop.run_until_complete(deploy())
+    try:
+        loop.run_until_complete(_wait_ready(domain, capture, readiness))
+    finally:
+        if capture:
+            capture.close()
+    if trace:
+        tracer.write(trace, process_name="vl start")
     print(  # noqa: T001
         (
             "\033[0m\n**** System is online ****\n"
@@ -178,14 +471,16 @@ def start(configuration, context, **kwargs):
         ).format(name=domain.name)
     )
     if kwargs["ssh"]:
-        domain.exec_ssh()
+        import virt_lightning.sshconf as sshconf
+
+        domain.exec_ssh(options=sshconf.command_options(configuration))
 
 
 def stop(configuration, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    hv = _hypervisor(configuration)
     hv.init_network(configuration.network_name, configuration.network_cidr)
     hv.init_storage_pool(configuration.storage_pool)
+    hv.init_data_pools(configuration.storage_pools)
     domain = hv.get_domain_by_name(kwargs["name"])
     if not domain:
         vm_list = [d.name for d in hv.list_domains()]
@@ -196,80 +491,63 @@ def stop(configuration, **kwargs):
         )
         exit(1)
     hv.clean_up(domain)
+    _invalidate_inventory(configuration)
 
 
-def ansible_inventory(configuration, context, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-
-    ssh_cmd_template = (
-        "{name} ansible_host={ipv4} ansible_user={username} "
-        "ansible_python_interpreter={python_interpreter} "
-        'ansible_ssh_common_args="-o UserKnownHostsFile=/dev/null '
-        '-o StrictHostKeyChecking=no"'
-    )
-
-    groups = {}
-    for domain in hv.list_domains():
-        if domain.context != context:
-            continue
+def ansible_inventory(
+    configuration, context, list_hosts=False, host=None, cache_ttl=10, **kwargs
+):
+    import json
 
-        for group in domain.groups:
-            if group not in groups:
-                groups[group] = []
-            groups[group].append(domain)
+    import virt_lightning.inventory as inventory
 
-        template = ssh_cmd_template
+    path = inventory.cache_path(configuration.state_dir)
+    content = inventory.load(path, context, cache_ttl)
+    if content is None:
+        content = inventory.build(_fleet(configuration), context)
+        inventory.save(path, context, content)
 
+    if host:
         print(  # noqa: T001
-            template.format(
-                name=domain.name,
-                username=domain.username,
-                ipv4=domain.ipv4.ip,
-                python_interpreter=domain.python_interpreter,
-            )
-        )  # noqa: T001
+            json.dumps(content["_meta"]["hostvars"].get(host, {}), indent=2)
+        )
+    elif list_hosts:
+        print(json.dumps(content, indent=2))  # noqa: T001
+    else:
+        for line in inventory.to_ini(content):
+            print(line)  # noqa: T001
 
-    for group_name, domains in groups.items():
-        print("\n[{group_name}]".format(group_name=group_name))  # noqa: T001
-        for domain in domains:
-            print(domain.name)  # noqa: T001
 
+def _invalidate_inventory(configuration):
+    import virt_lightning.inventory as inventory
 
-def ssh_config(configuration, context, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    inventory.invalidate(inventory.cache_path(configuration.state_dir))
 
-    ssh_host_template = (
-        "Host {name}\n"
-        "     Hostname {ipv4}\n"
-        "     User {username}\n"
-        "     IdentityFile {ssh_key_file}\n"
-    )
 
-    groups = {}
-    for domain in hv.list_domains():
-        for group in domain.groups:
-            groups[group].append(domain)
+def ssh_config(configuration, context, write=None, **kwargs):
+    import virt_lightning.sshconf as sshconf
 
-        if domain.context != context:
-            continue
+    hv = _fleet(configuration)
 
-        template = ssh_host_template
+    entries = [
+        sshconf.host_entry(domain, configuration)
+        for domain in sorted(hv.list_domains())
+        if domain.context == context and domain.ipv4
+    ]
 
-        print(  # noqa: T001
-            template.format(
-                name=domain.name,
-                username=domain.username,
-                ipv4=domain.ipv4.ip,
-                ssh_key_file=domain.ssh_key,
-            )
-        )  # noqa: T001
+    if write:
+        changes = sshconf.update(write, context, entries)
+        logger.info(
+            "%s: %d added, %d updated, %d removed",
+            write,
+            changes["added"],
+            changes["updated"],
+            changes["removed"],
+        )
+        return
 
-    for group_name, domains in groups.items():
-        print("\n[{group_name}]".format(group_name=group_name))  # noqa: T001
-        for domain in domains:
-            print(domain.name)  # noqa: T001
+    for entry in entries:
+        print(entry.text)  # noqa: T001
 
 
 def get_status(hv, context):
@@ -284,14 +562,14 @@ def get_status(hv, context):
                 "ipv4": domain.ipv4 and str(domain.ipv4.ip),
                 "context": domain.context,
                 "username": domain.username,
+                "hypervisor": domain.hypervisor_uri,
             }
         )
     return status
 
 
 def status(configuration, context=None, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    hv = _fleet(configuration)
     results = {}
 
     for status in get_status(hv, context):
@@ -300,9 +578,13 @@ def status(configuration, context=None, **kwargs):
             "ipv4": status["ipv4"] or "waiting",
             "context": status["context"],
             "username": status["username"],
+            "hypervisor": status["hypervisor"],
         }
 
     output_template = "{computer} {name:<13}   {arrow}   {username}@{ipv4:>5}"
+    # The same IPv4 address can be used on several hypervisors.
+    if len(configuration.libvirt_uris) > 1:
+        output_template += "   ({hypervisor})"
     for _, v in sorted(results.items()):
         print(  # noqa: T001
             output_template.format(
@@ -311,22 +593,38 @@ def status(configuration, context=None, **kwargs):
         )
 
 
+def memstat(configuration, context=None, **kwargs):
+    import virt_lightning.memstat as memstat
+
+    hv = _hypervisor(configuration)
+    contexts = memstat.by_context(hv.get_memory_usage())
+    if context:
+        contexts = [c for c in contexts if c.context == context]
+    ksm = memstat.ksm_savings(hv.get_ksm_parameters(), hv.get_page_size())
+    for line in memstat.report(contexts, hv.get_host_memory(), ksm):
+        print(line)  # noqa: T001
+
+
 def ssh(configuration, name=None, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    import virt_lightning.sshconf as sshconf
+    import virt_lightning.ui as ui
+
+    hv = _hypervisor(configuration)
+    options = sshconf.command_options(configuration)
 
     def go_ssh(domain):
-        domain.exec_ssh()
+        domain.exec_ssh(options=options)
 
     if name:
-        hv.get_domain_by_name(name).exec_ssh()
+        go_ssh(hv.get_domain_by_name(name))
 
     ui.Selector(sorted(hv.list_domains()), go_ssh)
 
 
 def console(configuration, name=None, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    import virt_lightning.ui as ui
+
+    hv = _hypervisor(configuration)
 
     def go_console(domain):
         os.execlp(
@@ -340,8 +638,9 @@ def console(configuration, name=None, **kwargs):
 
 
 def viewer(configuration, name=None, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    import virt_lightning.ui as ui
+
+    hv = _hypervisor(configuration)
 
     def virt_viewer_binary():
         paths = [
@@ -375,39 +674,74 @@ def viewer(configuration, name=None, **kwargs):
     ui.Selector(sorted(hv.list_domains()), go_viewer)
 
 
-def down(configuration, context, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
-    hv.init_network(configuration.network_name, configuration.network_cidr)
-    hv.init_storage_pool(configuration.storage_pool)
-    for domain in hv.list_domains():
+def down(configuration, context, gc=False, **kwargs):
+    nodes = _fleet(configuration)
+    for hv in nodes.hypervisors.values():
+        hv.init_network(configuration.network_name, configuration.network_cidr)
+        hv.init_storage_pool(configuration.storage_pool)
+        hv.init_data_pools(configuration.storage_pools)
+    for hv, domain in list(nodes.items()):
         if context and domain.context != context:
             continue
         logger.info("%s purging %s", symbols.TRASHBIN.value, domain.name)
         hv.clean_up(domain)
+    _invalidate_inventory(configuration)
+
+    if _strtobool(configuration.network_auto_clean_up):
+        for hv in nodes.hypervisors.values():
+            for shard in hv.shards:
+                shard.obj.destroy()
+
+    if gc:
+        for hv in nodes.hypervisors.values():
+            _collect_garbage(hv)
+
+
+def _collect_garbage(hv, dry_run=False):
+    import concurrent.futures
+
+    orphans = hv.find_orphan_volumes()
+    if dry_run:
+        for vol in orphans:
+            print(vol.path())  # noqa: T001
+        return
 
-    if bool(distutils.util.strtobool(configuration.network_auto_clean_up)):
-        hv.network_obj.destroy()
+    def delete(vol):
+        logger.debug("Purge volume: %s", vol.path())
+        vol.delete()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        list(executor.map(delete, orphans))
+    logger.info(
+        "%s %d orphaned volume(s) removed", symbols.TRASHBIN.value, len(orphans)
+    )
+
+
+def gc(configuration, dry_run=False, **kwargs):
+    hv = _hypervisor(configuration)
+    hv.init_storage_pool(configuration.storage_pool)
+    hv.init_data_pools(configuration.storage_pools)
+    _collect_garbage(hv, dry_run=dry_run)
 
 
 def distro_list(configuration, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    hv = _hypervisor(configuration)
     hv.init_storage_pool(configuration.storage_pool)
     for distro in hv.distro_available():
         print("- distro: {distro}".format(distro=distro))  # noqa: T001
 
 
 def storage_dir(configuration, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    hv = _hypervisor(configuration)
     hv.init_storage_pool(configuration.storage_pool)
     print(hv.get_storage_dir())  # noqa: T001
 
 
 def fetch(configuration, **kwargs):
-    conn = libvirt.open(configuration.libvirt_uri)
-    hv = vl.LibvirtHypervisor(conn)
+    import urllib.error
+    import urllib.request
+
+    hv = _hypervisor(configuration)
     hv.init_storage_pool(configuration.storage_pool)
     storage_dir = hv.get_storage_dir()
     try:
@@ -461,6 +795,239 @@ def fetch(configuration, **kwargs):
     print("Image {distro} is ready!".format(**kwargs))  # noqa: T001
 
 
+def extract_kernel(configuration, distro, cmdline=None, **kwargs):
+    import subprocess
+
+    hv = _hypervisor(configuration)
+    hv.init_storage_pool(configuration.storage_pool)
+    if distro not in hv.distro_available():
+        logger.error("distro not available: %s", distro)
+        sys.exit(1)
+    try:
+        boot = hv.extract_kernel(distro, cmdline=cmdline)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error("Cannot extract the kernel of %s: %s", distro, e)
+        logger.info("virt-get-kernel and guestfish come with libguestfs")
+        sys.exit(1)
+    logger.info(
+        "%s %s boots %s with: %s",
+        symbols.CHECKMARK.value,
+        distro,
+        boot["kernel"],
+        boot["cmdline"],
+    )
+
+
+def clone(configuration, name, count, context=None, trace=None, **kwargs):
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    hv = _hypervisor(configuration)
+    hv.init_network(configuration.network_name, configuration.network_cidr)
+    hv.init_storage_pool(configuration.storage_pool)
+    hv.init_data_pools(configuration.storage_pools)
+    source = hv.get_domain_by_name(name)
+    if not source:
+        vm_list = [d.name for d in hv.list_domains()]
+        print(  # noqa: T001
+            "No VM called {name} in {vm_list}".format(name=name, vm_list=vm_list)
+        )
+        exit(1)
+    tracer = _record_provisioning(configuration)
+
+    backing_file = hv.freeze_root_disk(source)
+    logger.info("%s %s frozen as %s", symbols.CHECKMARK.value, name, backing_file)
+
+    clones = []
+    index = 1
+    for _ in range(count):
+        while hv.get_domain_by_name("{name}-{index}".format(name=name, index=index)):
+            index += 1
+        clones.append(
+            _clone_domain(
+                hv,
+                source,
+                "{name}-{index}".format(name=name, index=index),
+                backing_file,
+                context or source.context,
+                configuration,
+            )
+        )
+        index += 1
+
+    loop.run_until_complete(asyncio.gather(*[d.reachable() for d in clones]))
+    _report_provisioning(tracer, trace, process_name="vl clone")
+    logger.info("%s You are all set", symbols.THUMBS_UP.value)
+
+
+def snapshot(configuration, operation, context, memory=False, **kwargs):
+    import concurrent.futures
+
+    hv = _hypervisor(configuration)
+    hv.init_network(configuration.network_name, configuration.network_cidr)
+    hv.init_storage_pool(configuration.storage_pool)
+    hv.init_data_pools(configuration.storage_pools)
+    domains = [d for d in hv.list_domains() if d.context == context]
+    if operation != "create":
+        for domain in [d for d in domains if not d.snapshot]:
+            logger.warning("%s has no snapshot", domain.name)
+        domains = [d for d in domains if d.snapshot]
+    elif [d for d in domains if d.snapshot]:
+        logger.error("The context %s already has a snapshot", context)
+        sys.exit(1)
+    if not domains:
+        logger.error("No VM to %s in the context %s", operation, context)
+        sys.exit(1)
+
+    action = getattr(hv, "snapshot_" + operation)
+    arguments = {"memory": memory} if operation == "create" else {}
+    # The VM are paused during the snapshot so they are all taken at the
+    # same point in time.
+    paused = []
+    if operation == "create":
+        paused = [d for d in domains if d.dom.isActive()]
+    try:
+        for domain in paused:
+            domain.dom.suspend()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            futures = {
+                executor.submit(action, domain, **arguments): domain
+                for domain in domains
+            }
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                logger.info(
+                    "%s %s: %s done",
+                    symbols.CHECKMARK.value,
+                    futures[future].name,
+                    operation,
+                )
+    finally:
+        for domain in paused:
+            if domain.dom.isActive():
+                domain.dom.resume()
+    _invalidate_inventory(configuration)
+
+
+def agent_exec(configuration, name, command, timeout=None, **kwargs):
+    import virt_lightning.agent as agent
+
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        logger.error("No command to run")
+        sys.exit(1)
+
+    hv = _hypervisor(configuration)
+    domain = hv.get_domain_by_name(name)
+    if not domain:
+        logger.error("Domain not found: %s", name)
+        sys.exit(1)
+    try:
+        exitcode, stdout, stderr = agent.run(domain.dom, command, timeout=timeout)
+    except agent.AgentError as e:
+        logger.error("%s: %s", name, e)
+        sys.exit(1)
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(exitcode)
+
+
+def exec_(
+    configuration, context, group, concurrency, timeout, json_output, command, **kwargs
+):
+    import asyncio
+    import json
+
+    import virt_lightning.execution as execution
+    import virt_lightning.sshconf as sshconf
+
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        logger.error("No command to run")
+        sys.exit(1)
+
+    hv = _hypervisor(configuration)
+    # Nobody is there to type a password or to wait for a dead VM.
+    options = sshconf.command_options(configuration) + sshconf.BATCH_OPTIONS
+    targets = []
+    results = []
+    for domain in sorted(hv.list_domains()):
+        if domain.context != context:
+            continue
+        if group and group not in domain.groups:
+            continue
+        if not domain.ipv4:
+            results.append(execution.unreachable(domain.name, "no IPv4 address"))
+            continue
+        targets.append((domain.name, domain.ssh_command(*command, options=options)))
+
+    output = None
+    if not json_output:
+        output = execution.PrefixedOutput([name for name, _ in targets])
+    loop = asyncio.get_event_loop()
+    results += loop.run_until_complete(
+        execution.run(targets, concurrency=concurrency, timeout=timeout, output=output)
+    )
+
+    for line in execution.summary(results):
+        logger.info(line)
+    if json_output:
+        print(json.dumps(execution.as_dict(results), indent=2))  # noqa: T001
+    if not execution.succeeded(results):
+        sys.exit(1)
+
+
+def exporter(configuration, address, port, cache_ttl, **kwargs):
+    import virt_lightning.metrics as metrics
+
+    conn = _connect(configuration)
+    prometheus_exporter = metrics.Exporter(
+        metrics.DomainCollector(conn),
+        metrics.ProvisioningStats(
+            metrics.provisioning_log_path(configuration.state_dir)
+        ),
+        cache_ttl=cache_ttl,
+    )
+    server = metrics.make_server(prometheus_exporter, address, port)
+    logger.info(
+        "%s Serving metrics on http://%s:%d/metrics",
+        symbols.LIGHTNING.value,
+        address,
+        port,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def daemon(configuration, cache_ttl, **kwargs):
+    import virt_lightning.daemon as vl_daemon
+
+    vl_daemon.serve(configuration, cache_ttl=cache_ttl)
+
+
+def _forward(configuration, args):
+    import virt_lightning.daemon as vl_daemon
+
+    if args.action not in vl_daemon.FORWARDED_ACTIONS:
+        return None
+    # The daemon only watches the first hypervisor.
+    if len(configuration.libvirt_uris) > 1:
+        return None
+    # The file must be written by the caller.
+    if getattr(args, "write", None):
+        return None
+    arguments = {
+        k: v
+        for k, v in vars(args).items()
+        if k not in ("action", "config", "debug", "profile", "cprofile", "no_daemon")
+    }
+    return vl_daemon.call(configuration, args.action, arguments)
+
+
 def main():
 
     title = "{lightning} Virt-Lightning {lightning}".format(
@@ -468,8 +1035,8 @@ def main():
     )
 
     usage = """
-usage: vl [--debug DEBUG] [--config CONFIG]
-          {up,down,start,distro_list,storage_dir,ansible_inventory,ssh_config,console,viewer} ..."""
+usage: vl [--debug DEBUG] [--profile] [--cprofile FILE] [--no-daemon] [--config CONFIG]
+          {up,down,gc,start,clone,snapshot,distro_list,extract_kernel,storage_dir,ansible_inventory,ssh_config,memstat,console,viewer,exec,agent_exec,daemon} ..."""
     example = """
 Example:
 
@@ -486,6 +1053,8 @@ Example:
    $ ansible all -m ping -i inventory"""
 
     def list_from_yaml_file(value):
+        import yaml
+
         file_path = pathlib.PosixPath(value)
         if not file_path.exists():
             raise argparse.ArgumentTypeError(
@@ -512,6 +1081,35 @@ Example:
         "dest": "context",
     }
 
+    trace_args = {
+        "help": "write a Chrome/Perfetto trace of the provisioning in this JSON file",
+        "dest": "trace",
+        "type": pathlib.PosixPath,
+    }
+
+    def readiness_type(value):
+        if value in ("ssh", "console", "agent", "cloud-init"):
+            return value
+        if value.startswith("file:/"):
+            return value
+        raise argparse.ArgumentTypeError(
+            "{value}: expected ssh, console, agent, cloud-init or file:PATH".format(
+                value=value
+            )
+        )
+
+    readiness_args = {
+        "help": (
+            "wait for the SSH port, for the cloud-init or login prompt on the "
+            "console, or through the QEMU guest agent: agent (the agent answers), "
+            "cloud-init (cloud-init is done) or file:PATH (the file exists) "
+            "(default: %(default)s)"
+        ),
+        "type": readiness_type,
+        "default": "ssh",
+        "dest": "readiness",
+    }
+
     parent_parser = argparse.ArgumentParser(add_help=False)
     main_parser = argparse.ArgumentParser()
     main_parser.add_argument(
@@ -520,6 +1118,24 @@ Example:
         default=False,
         help="Print extra information (default: %(default)s)",
     )
+    main_parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Report the libvirt calls done by the action (default: %(default)s)",
+    )
+    main_parser.add_argument(
+        "--cprofile",
+        help="Write the cProfile statistics of the action in this file",
+        type=pathlib.PosixPath,
+    )
+    main_parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        default=False,
+        dest="no_daemon",
+        help="Don't forward the action to vl daemon (default: %(default)s)",
+    )
     main_parser.add_argument(
         "--config",
         help="path to configuration file",
@@ -536,6 +1152,13 @@ Example:
     )
     up_parser.add_argument("--virt-lightning-yaml", **vl_lightning_yaml_args)
     up_parser.add_argument("--context", **context_args)
+    up_parser.add_argument("--trace", **trace_args)
+    up_parser.add_argument("--readiness", **readiness_args)
+    up_parser.add_argument(
+        "--placement",
+        choices=["spread", "pack"],
+        help="Pin the VM on the NUMA nodes of the host, spread them or pack them",
+    )
 
     down_parser = action_subparsers.add_parser(
         "down",
@@ -543,6 +1166,22 @@ Example:
         parents=[parent_parser],
     )
     down_parser.add_argument("--context", **context_args)
+    down_parser.add_argument(
+        "--gc",
+        action="store_true",
+        help="Also remove the volumes that no VM uses",
+    )
+
+    gc_parser = action_subparsers.add_parser(
+        "gc",
+        help="Remove the volumes of the storage pools that no VM uses",
+        parents=[parent_parser],
+    )
+    gc_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only list the volumes",
+    )
 
     start_parser = action_subparsers.add_parser(
         "start", help="Start a new VM", parents=[parent_parser]
@@ -557,6 +1196,8 @@ Example:
     start_parser.add_argument("--memory", help="Memory in MB", type=int)
     start_parser.add_argument("--vcpus", help="Number of VCPUS", type=int)
     start_parser.add_argument("--context", **context_args)
+    start_parser.add_argument("--trace", **trace_args)
+    start_parser.add_argument("--readiness", **readiness_args)
     start_parser.add_argument(
         "--noconsole",
         help="Suppress console output during VM creation",
@@ -575,6 +1216,13 @@ Example:
     )
     status_parser.add_argument("--context", **context_args)
 
+    memstat_parser = action_subparsers.add_parser(
+        "memstat",
+        help="Report the memory overcommit and the KSM savings",
+        parents=[parent_parser],
+    )
+    memstat_parser.add_argument("--context", help="Only this context")
+
     action_subparsers.add_parser(
         "distro_list",
         help="List all the images available locally",
@@ -590,6 +1238,24 @@ Example:
         parents=[parent_parser],
     )
     ansible_inventory_parser.add_argument("--context", **context_args)
+    ansible_inventory_mode = ansible_inventory_parser.add_mutually_exclusive_group()
+    ansible_inventory_mode.add_argument(
+        "--list",
+        help="Print the inventory in the JSON format of the dynamic inventories",
+        action="store_true",
+        default=False,
+        dest="list_hosts",
+    )
+    ansible_inventory_mode.add_argument(
+        "--host", help="Print the variables of a host in the JSON format"
+    )
+    ansible_inventory_parser.add_argument(
+        "--cache-ttl",
+        help="Seconds during which the inventory is reused (default: %(default)s)",
+        default=10,
+        type=float,
+        dest="cache_ttl",
+    )
 
     ssh_config_parser = action_subparsers.add_parser(
         "ssh_config",
@@ -597,6 +1263,16 @@ Example:
         parents=[parent_parser],
     )
     ssh_config_parser.add_argument("--context", **context_args)
+    ssh_config_parser.add_argument(
+        "--write",
+        help=(
+            "Update the VM of the context in an includable ssh config file "
+            "(default: state_dir/ssh_config)"
+        ),
+        nargs="?",
+        const=True,
+        dest="write",
+    )
 
     ssh_parser = action_subparsers.add_parser(
         "ssh", help="SSH to a given host", parents=[parent_parser]
@@ -620,6 +1296,129 @@ Example:
     )
     fetch_parser.add_argument("distro", help="Name of the VM image", type=str)
 
+    extract_kernel_parser = action_subparsers.add_parser(
+        "extract_kernel",
+        help="Extract the kernel of an image to boot it without bootloader",
+        parents=[parent_parser],
+    )
+    extract_kernel_parser.add_argument("distro", help="Name of the VM image", type=str)
+    extract_kernel_parser.add_argument(
+        "--cmdline", help="Kernel command line (default: the root of the image)"
+    )
+
+    clone_parser = action_subparsers.add_parser(
+        "clone",
+        help="Create linked clones of a VM",
+        parents=[parent_parser],
+    )
+    clone_parser.add_argument("name", help="Name of the VM to clone", type=str)
+    clone_parser.add_argument(
+        "--count",
+        help="Number of clones (default: %(default)s)",
+        default=1,
+        type=int,
+    )
+    clone_parser.add_argument(
+        "--context", help="Context of the clones (default: the one of the VM)"
+    )
+    clone_parser.add_argument("--trace", **trace_args)
+
+    snapshot_parser = action_subparsers.add_parser(
+        "snapshot",
+        help="Snapshot or revert all the VM of a context",
+        parents=[parent_parser],
+    )
+    snapshot_parser.add_argument(
+        "operation", choices=["create", "revert", "delete"], help="Operation"
+    )
+    snapshot_parser.add_argument("--context", **context_args)
+    snapshot_parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Also save the memory of the running VM",
+    )
+
+    exec_parser = action_subparsers.add_parser(
+        "exec",
+        help="Run a command on all the VM of a context",
+        parents=[parent_parser],
+    )
+    exec_parser.set_defaults(func=exec_)
+    exec_parser.add_argument("--context", **context_args)
+    exec_parser.add_argument("--group", help="Only the VM of this group")
+    exec_parser.add_argument(
+        "--concurrency",
+        help="Maximum number of parallel SSH connections (default: %(default)s)",
+        default=10,
+        type=int,
+    )
+    exec_parser.add_argument(
+        "--timeout",
+        help="Per host timeout in seconds (default: %(default)s)",
+        default=300,
+        type=float,
+    )
+    exec_parser.add_argument(
+        "--json",
+        help="Print the results as JSON (default: %(default)s)",
+        action="store_true",
+        default=False,
+        dest="json_output",
+    )
+    exec_parser.add_argument(
+        "command", help="Command to run, after --", nargs=argparse.REMAINDER
+    )
+
+    agent_exec_parser = action_subparsers.add_parser(
+        "agent_exec",
+        help="Run a command on a VM through the QEMU guest agent",
+        parents=[parent_parser],
+    )
+    agent_exec_parser.add_argument("name", help="Name of the VM")
+    agent_exec_parser.add_argument(
+        "--timeout", help="Timeout in seconds", type=float, default=None
+    )
+    agent_exec_parser.add_argument(
+        "command", help="Command to run, after --", nargs=argparse.REMAINDER
+    )
+
+    exporter_parser = action_subparsers.add_parser(
+        "exporter",
+        help="Serve the VM and provisioning metrics in the Prometheus format",
+        parents=[parent_parser],
+    )
+    exporter_parser.add_argument(
+        "--address",
+        help="Address to listen on (default: %(default)s)",
+        default="127.0.0.1",
+    )
+    exporter_parser.add_argument(
+        "--port",
+        help="Port to listen on (default: %(default)s)",
+        default=9177,
+        type=int,
+    )
+    exporter_parser.add_argument(
+        "--cache-ttl",
+        help="Seconds during which a scrape result is reused (default: %(default)s)",
+        default=15,
+        type=float,
+        dest="cache_ttl",
+    )
+
+    daemon_parser = action_subparsers.add_parser(
+        "daemon",
+        help="Keep the libvirt connection open and serve the vl commands",
+        parents=[parent_parser],
+    )
+    daemon_parser.add_argument(
+        "--cache-ttl",
+        help="Seconds during which a command output is reused (default: %(default)s)",
+        default=30,
+        type=float,
+        dest="cache_ttl",
+    )
+
     args = main_parser.parse_args()
     if not args.action:
         print(title)  # noqa: T001
@@ -631,7 +1430,43 @@ Example:
     if args.config:
         configuration.load_file(args.config)
 
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    if getattr(args, "write", None) is True:
+        import virt_lightning.sshconf as sshconf
+
+        args.write = str(sshconf.ssh_config_path(configuration.state_dir))
 
-    globals()[args.action](configuration=configuration, **vars(args))
+    if not (args.no_daemon or args.profile or args.cprofile):
+        response = _forward(configuration, args)
+        if response:
+            print(response["stdout"], end="")  # noqa: T001
+            sys.exit(response["status"])
+
+    rpc_stats = None
+    if args.profile:
+        import virt_lightning.profiling as profiling
+
+        rpc_stats = profiling.enable(args.action)
+    profiler = None
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            profiler.enable()
+        action = getattr(args, "func", None) or globals()[args.action]
+        action(configuration=configuration, **vars(args))
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(str(args.cprofile))
+        if rpc_stats:
+            import virt_lightning.latency as latency
+
+            for line in rpc_stats.report():
+                print(line, file=sys.stderr)  # noqa: T001
+            for injector in latency.injectors():
+                print(injector.summary(), file=sys.stderr)  # noqa: T001
@@ -0,0 +1,131 @@
+import collections
+import pathlib
+import urllib.parse
+
+MARKER = "# vl:"
+SSH_CONFIG = "ssh_config"
+CONNECT_TIMEOUT = 10
+# For the commands run without a terminal, e.g: vl exec.
+BATCH_OPTIONS = [
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ConnectTimeout={timeout}".format(timeout=CONNECT_TIMEOUT),
+]
+
+HOST_TEMPLATE = (
+    "Host {name}\n"
+    "     Hostname {ipv4}\n"
+    "     User {username}\n"
+    "     IdentityFile {identity_file}\n"
+)
+
+Entry = collections.namedtuple("Entry", ["uuid", "context", "text"])
+
+
+def ssh_config_path(state_dir):
+    return pathlib.PosixPath(state_dir).expanduser() / SSH_CONFIG
+
+
+def identity_file(configuration):
+    public_key = configuration.ssh_key_file
+    if public_key.endswith(".pub"):
+        return public_key[:-4]
+    return public_key
+
+
+def jump_host(uri):
+    # The VM of a remote hypervisor are behind its NAT, e.g:
+    # qemu+ssh://root@node2/system
+    if not uri:
+        return None
+    url = urllib.parse.urlparse(uri)
+    if not url.scheme.endswith("+ssh") or not url.hostname:
+        return None
+    return url.netloc
+
+
+def control_options(configuration):
+    if configuration.ssh_control_master == "no":
+        return []
+    # ssh doesn't create the directory of the control sockets.
+    pathlib.PosixPath(configuration.ssh_control_path).expanduser().parent.mkdir(
+        parents=True, exist_ok=True
+    )
+    return [
+        ("ControlMaster", configuration.ssh_control_master),
+        ("ControlPersist", configuration.ssh_control_persist),
+        ("ControlPath", configuration.ssh_control_path),
+    ]
+
+
+def command_options(configuration):
+    options = []
+    for key, value in control_options(configuration):
+        options += ["-o", "{key}={value}".format(key=key, value=value)]
+    return options
+
+
+def host_entry(domain, configuration):
+    text = HOST_TEMPLATE.format(
+        name=domain.name,
+        ipv4=domain.ipv4.ip,
+        username=domain.username,
+        identity_file=identity_file(configuration),
+    )
+    proxy_jump = jump_host(domain.hypervisor_uri)
+    if proxy_jump:
+        text += "     ProxyJump {proxy_jump}\n".format(proxy_jump=proxy_jump)
+    for key, value in control_options(configuration):
+        text += "     {key} {value}\n".format(key=key, value=value)
+    return Entry(domain.dom.UUIDString(), domain.context, text)
+
+
+def parse(content):
+    entries = collections.OrderedDict()
+    uuid = None
+    for line in content.splitlines(keepends=True):
+        if line.startswith(MARKER):
+            uuid, _, context = line.replace(MARKER, "", 1).strip().partition(" ")
+            entries[uuid] = Entry(uuid, context, "")
+        elif uuid:
+            entry = entries[uuid]
+            entries[uuid] = entry._replace(text=entry.text + line)
+    return entries
+
+
+def render(entries):
+    return "".join(
+        "{marker} {uuid} {context}\n{text}".format(
+            marker=MARKER, uuid=e.uuid, context=e.context, text=e.text
+        )
+        for e in entries.values()
+    )
+
+
+def update(path, context, entries):
+    path = pathlib.PosixPath(path)
+    current = parse(path.read_text()) if path.exists() else collections.OrderedDict()
+    entries = collections.OrderedDict((entry.uuid, entry) for entry in entries)
+    # Keep the order of the file, the new hosts go at the end.
+    new = collections.OrderedDict()
+    for uuid, entry in current.items():
+        if uuid in entries:
+            new[uuid] = entries[uuid]
+        elif entry.context != context:
+            new[uuid] = entry
+    for uuid, entry in entries.items():
+        new.setdefault(uuid, entry)
+    changes = {
+        "added": len([uuid for uuid in entries if uuid not in current]),
+        "updated": len(
+            [uuid for uuid in entries if uuid in current and current[uuid] != new[uuid]]
+        ),
+        "removed": len([uuid for uuid in current if uuid not in new]),
+    }
+    if new != current:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = path.with_suffix(".temp")
+        temp_file.write_text(render(new))
+        temp_file.rename(path)
+    return changes
@@ -102,6 +102,14 @@ DOMAIN_XML = """
 </domain>
 """  # NOQA
 
+FILESYSTEM_XML = """
+    <filesystem type='mount' accessmode='passthrough'>
+      <driver type='virtiofs'/>
+      <source />
+      <target />
+    </filesystem>
+"""
+
 BRIDGE_XML = """
 <interface type='network'>
   <source network='virt-lightning'/>
@@ -139,7 +147,7 @@ network-interfaces: |
    iface eth0 inet static
    address {ipv4}
    network {network}
-   netmask 255.255.255.0
+   netmask {netmask}
    gateway {gateway}
 """
 
@@ -173,3 +181,10 @@ You need root privilege to create the storage pool, please do:
   sudo chmod 775 /var/lib/virt-lightning
   sudo chmod 775 {storage_dir} {storage_dir}/upstream
 """
+
+SNAPSHOT_XML = """
+<domainsnapshot>
+  <name></name>
+  <disks/>
+</domainsnapshot>
+"""
@@ -0,0 +1,139 @@
+import collections
+import json
+import math
+import pathlib
+import threading
+
+from virt_lightning.instrumentation import PROVISIONING_STAGES
+
+Span = collections.namedtuple("Span", ["name", "track", "start", "end", "failed"])
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    rank = max(int(math.ceil(p / 100.0 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+
+class Tracer:
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def observe(self, name, track, start, end, labels, failed):
+        with self._lock:
+            self.spans.append(Span(name, track, start, end, failed))
+
+    @property
+    def origin(self):
+        return min(span.start for span in self.spans)
+
+    def tracks(self):
+        tracks = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            if span.track not in tracks:
+                tracks.append(span.track)
+        return tracks
+
+    def chrome_trace(self, process_name="vl"):
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": 1,
+                "args": {"name": process_name},
+            }
+        ]
+        if not self.spans:
+            return {"traceEvents": events, "displayTimeUnit": "ms"}
+        origin = self.origin
+        tids = {}
+        for tid, track in enumerate(self.tracks(), start=1):
+            tids[track] = tid
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": track},
+                }
+            )
+        for span in self.spans:
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": "stage" if span.name in PROVISIONING_STAGES else "step",
+                    "ph": "X",
+                    "ts": int((span.start - origin) * 1e6),
+                    "dur": int((span.end - span.start) * 1e6),
+                    "pid": 1,
+                    "tid": tids[span.track],
+                    "args": {"failed": span.failed},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path, process_name="vl"):
+        with pathlib.PosixPath(path).open("w") as fd:
+            json.dump(self.chrome_trace(process_name), fd)
+
+    def durations(self):
+        durations = collections.OrderedDict()
+        for span in sorted(self.spans, key=lambda s: s.start):
+            durations.setdefault(span.name, []).append(span.end - span.start)
+        return durations
+
+    def critical_path(self):
+        if not self.spans:
+            return None, []
+        last = max(self.spans, key=lambda s: s.end)
+        stages = sorted(
+            (
+                span
+                for span in self.spans
+                if span.track == last.track and span.name in PROVISIONING_STAGES
+            ),
+            key=lambda s: s.start,
+        )
+        return last.track, stages
+
+    def summary(self):
+        if not self.spans:
+            return []
+        lines = [
+            "{stage:<16} {count:>5} {p50:>9} {p95:>9}".format(
+                stage="stage", count="count", p50="p50", p95="p95"
+            )
+        ]
+        for name, values in self.durations().items():
+            indent = "" if name in PROVISIONING_STAGES else "  "
+            lines.append(
+                "{stage:<16} {count:>5} {p50:>8.2f}s {p95:>8.2f}s".format(
+                    stage=indent + name,
+                    count=len(values),
+                    p50=percentile(values, 50),
+                    p95=percentile(values, 95),
+                )
+            )
+        track, stages = self.critical_path()
+        origin = self.origin
+        steps = []
+        if stages:
+            steps.append(
+                "queued {duration:.2f}s".format(duration=stages[0].start - origin)
+            )
+        steps += [
+            "{name} {duration:.2f}s".format(
+                name=span.name, duration=span.end - span.start
+            )
+            for span in stages
+        ]
+        lines.append(
+            "critical path: {track} ({total:.2f}s): {steps}".format(
+                track=track,
+                total=max(span.end for span in self.spans) - origin,
+                steps=" -> ".join(steps),
+            )
+        )
+        return lines
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
+import collections
+import contextlib
 import ipaddress
 import getpass
 import logging
+import math
 import os
 import pathlib
 import re
+import shlex
 import string
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import typing
 import uuid
 import xml.etree.ElementTree as ET
@@ -21,6 +27,8 @@ import yaml
 
 import asyncio
 
+import virt_lightning.placement as placement
+from virt_lightning.instrumentation import stage
 from virt_lightning.symbols import get_symbols
 
 from .templates import (
@@ -29,8 +37,10 @@ from .templates import (
     NETWORK_DHCP_ENTRY,
     DISK_XML,
     DOMAIN_XML,
+    FILESYSTEM_XML,
     NETWORK_HOST_ENTRY,
     NETWORK_XML,
+    SNAPSHOT_XML,
     STORAGE_POOL_XML,
     STORAGE_VOLUME_XML,
     USER_CREATE_STORAGE_POOL_DIR,
@@ -48,9 +58,69 @@ ISO_BINARIES = (
     "genisoimage",
     "mkisofs",
 )
+# The <memoryBacking> elements of the memory profiles.
+MEMORY_PROFILES = {
+    # KSM can merge the identical pages of the guests, the best density
+    # with guests started from the same image.
+    "default": (),
+    # No KSM, a write never waits for the copy of a merged page.
+    "nosharepages": (("nosharepages", {}),),
+    "hugepages": (("hugepages", {}), ("nosharepages", {})),
+    "locked": (("nosharepages", {}), ("locked", {})),
+    # Shared memory, required by vhost-user and virtiofs.
+    "memfd": (("source", {"type": "memfd"}), ("access", {"mode": "shared"})),
+}
+MACHINE_PROFILES = ("default", "headless", "microvm")
+# The devices of a desktop VM, a headless VM doesn't need them.
+DESKTOP_DEVICES = ("controller", "graphics", "input", "redirdev", "sound", "video")
+DEFAULT_KERNEL_CMDLINE = "root={root} ro console=tty0 console=ttyS0,115200n8"
+# The QEMU process needs some memory on top of the guest RAM, the hard limit
+# of a VM with locked memory must cover it.
+LOCKED_MEMORY_OVERHEAD = 512
+STORAGE_PLACEMENTS = ("round-robin", "least-used")
+# The copy of an upstream image in another storage pool.
+REPLICA_PREFIX = "upstream_"
+REPLICA_NAME = REPLICA_PREFIX + "{distro}.qcow2"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+BLOCK_JOB_TIMEOUT = 600
+# A younger volume may belong to a VM being created.
+GC_MIN_AGE = 600
+# The volumes virt-lightning creates without a backing file.
+CIDATA_SUFFIX = "-cidata.qcow2"
+SNAPSHOT_MEMORY = re.compile(r"-snap-\d{14}\.mem$")
+# The prefix of an IPv4 address outside of the known networks.
+DEFAULT_IPV4_PREFIX = 24
+# The first addresses of a network are kept for the host.
+RESERVED_IPV4 = 5
+# A Linux interface name is limited to 15 characters.
+BRIDGE_NAME_MAX = 15
+
+# The metadata of a VM, a single JSON document.
+METADATA_URI = "https://github.com/virt-lightning/virt-lightning/metadata"
+METADATA_VERSION = 1
+# The keys of the previous layout, one metadata element per key.
+LEGACY_METADATA = (
+    "context",
+    "distro",
+    "fqdn",
+    "groups",
+    "ipv4",
+    "machine_profile",
+    "memory_profile",
+    "python_interpreter",
+    "root_password",
+    "snapshot",
+    "username",
+)
+
+# A network of virt-lightning, a new one is created once the previous ones
+# are full.
+Shard = collections.namedtuple("Shard", ["name", "obj", "gateway", "network"])
 
 logger = logging.getLogger("virt_lightning")
 
+ET.register_namespace("vl", METADATA_URI)
+
 symbols = get_symbols()
 
 
@@ -63,6 +133,43 @@ def run_cmd(cmd, cwd=None):
         raise Exception("A command has failed: ", outs, errs)
 
 
+def metadata_document(metadata):
+    document = ET.Element("instance", version=str(METADATA_VERSION))
+    document.text = json.dumps(metadata, sort_keys=True)
+    return document
+
+
+def fstab_escape(path):
+    # The fields of fstab are separated by whitespaces.
+    return "".join(
+        "\\{code:03o}".format(code=ord(c)) if c in " \t\n\\" else c for c in path
+    )
+
+
+def is_upstream_image(path):
+    return path.parent.name == "upstream" or path.name.startswith(REPLICA_PREFIX)
+
+
+def set_root_disk_source(root, path):
+    disk = root.find("./devices/disk[@device='disk']")
+    disk.find("./source").attrib["file"] = str(path)
+    for backing in disk.findall("./backingStore"):
+        disk.remove(backing)
+
+
+def parse_legacy_metadata(root):
+    metadata = {}
+    for elt in root.findall("./metadata/*"):
+        key = elt.tag.partition("}")[0].lstrip("{")
+        if key in LEGACY_METADATA:
+            metadata[key] = elt.attrib.get("name")
+    if metadata.get("groups") is not None:
+        metadata["groups"] = [g for g in metadata["groups"].split(",") if g]
+    if metadata.get("snapshot"):
+        metadata["snapshot"] = json.loads(metadata["snapshot"])
+    return metadata
+
+
 class LibvirtHypervisor:
     def __init__(self, conn):
         if conn is None:
@@ -72,10 +179,16 @@ class LibvirtHypervisor:
         self.conn = conn
         self._last_free_ipv4 = None
         self.storage_pool_obj = None
+        self.data_pools = []
+        self._next_pool = 0
+        self._pool_lock = threading.Lock()
+        self._replica_lock = threading.Lock()
         self.network_obj = None
         self.gateway = None
         self.dns = None
         self.network = None
+        self.shards = []
+        self._network_lock = threading.Lock()
 
     @property
     def arch(self):
@@ -97,20 +210,56 @@ class LibvirtHypervisor:
         # Sorted to get kvm before qemu, assume there is no other type
         return sorted(available)[0]
 
-    def create_domain(self, name=None, distro=None):
+    def create_domain(self, name=None, distro=None, machine_profile="default"):
         if not name:
             name = uuid.uuid4().hex[0:10]
+        if machine_profile not in MACHINE_PROFILES:
+            raise ValueError(
+                "Unknown machine profile {value}, expected one of: {profiles}".format(
+                    value=machine_profile, profiles=", ".join(MACHINE_PROFILES)
+                )
+            )
         root = ET.fromstring(DOMAIN_XML)
         root.attrib["type"] = self.domain_type
         root.find("./name").text = name
         root.find("./vcpu").text = str(self.conn.getInfo()[2])
         root.find("./devices/emulator").text = str(self.kvm_binary)
         root.find("./os/type").attrib["arch"] = self.arch
+        if machine_profile != "default":
+            self.strip_desktop_devices(root, lean=machine_profile == "microvm")
+        metadata = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "distro": distro,
+            "machine_profile": machine_profile,
+        }
+        # The metadata come with the definition, no extra call.
+        document = metadata_document(metadata)
+        document.tag = "{{{uri}}}{tag}".format(uri=METADATA_URI, tag=document.tag)
+        ET.SubElement(root, "metadata").append(document)
         dom = self.conn.defineXML(ET.tostring(root).decode())
         domain = LibvirtDomain(dom)
-        domain.distro = distro
+        domain._metadata = metadata
         return domain
 
+    def strip_desktop_devices(self, root, lean=False):
+        root.find("./os/type").attrib["machine"] = "q35"
+        devices = root.find("./devices")
+        for device in list(devices):
+            if device.tag in DESKTOP_DEVICES or device.get("type") == "spicevmc":
+                devices.remove(device)
+            elif lean and device.tag == "memballoon":
+                devices.remove(device)
+            else:
+                # The PCI addresses of the pc machine, libvirt picks new ones.
+                for address in device.findall("./address[@type='pci']"):
+                    device.remove(address)
+        ET.SubElement(devices, "controller", type="usb", model="none")
+        rng = ET.SubElement(devices, "rng", model="virtio")
+        ET.SubElement(rng, "backend", model="random").text = "/dev/urandom"
+        if lean:
+            ET.SubElement(devices, "memballoon", model="none")
+            root.remove(root.find("./pm"))
+
     def configure_domain(self, domain, user_config):
         config = {
             "groups": [],
@@ -121,6 +270,7 @@ class LibvirtHypervisor:
             "vcpus": 1,
             "default_nic_model": "virtio",
             "bootcmd": [],
+            "memory_profile": "default",
         }
         for k, v in self.get_distro_configuration(domain.distro).items():
             if v:
@@ -128,17 +278,63 @@ class LibvirtHypervisor:
         for k, v in user_config.items():
             if v:
                 config[k] = v
-        domain.groups = config["groups"]
-        domain.load_ssh_key_file(config["ssh_key_file"])
-        domain.memory = config["memory"]
-        domain.python_interpreter = config["python_interpreter"]
-        domain.root_password = config["root_password"]
-        domain.username = config["username"]
-        domain.vcpus = config["vcpus"]
-        domain.default_nic_model = config["default_nic_model"]
-        domain.bootcmd = config["bootcmd"]
-        if "fqdn" in config:
-            domain.fqdn = config["fqdn"]
+        with domain.batch_metadata():
+            domain.groups = config["groups"]
+            domain.load_ssh_key_file(config["ssh_key_file"])
+            domain.memory = config["memory"]
+            domain.python_interpreter = config["python_interpreter"]
+            domain.root_password = config["root_password"]
+            domain.username = config["username"]
+            domain.vcpus = config["vcpus"]
+            domain.default_nic_model = config["default_nic_model"]
+            domain.bootcmd = config["bootcmd"]
+            domain.memory_profile = config["memory_profile"]
+            if config.get("kernel"):
+                # The files are next to the image of the distro.
+                upstream = self.get_storage_dir() / "upstream"
+                domain.set_kernel(
+                    upstream / config["kernel"],
+                    upstream / config["initrd"] if config.get("initrd") else None,
+                    config.get("cmdline"),
+                )
+            if "fqdn" in config:
+                domain.fqdn = config["fqdn"]
+
+    def get_memory_usage(self):
+        # The allocated memory and the RSS of the running VM, in MiB.
+        usage = []
+        for dom, stats in self.conn.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_BALLOON,
+            libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE,
+        ):
+            usage.append(
+                (
+                    LibvirtDomain(dom),
+                    stats.get("balloon.maximum", 0) // 1024,
+                    stats.get("balloon.rss", 0) // 1024,
+                )
+            )
+        return usage
+
+    def get_host_memory(self):
+        return self.conn.getInfo()[1]
+
+    def get_page_size(self):
+        caps = ET.fromstring(self.conn.getCapabilities())
+        pages = caps.find("./host/cpu/pages")
+        if pages is None:
+            return 4096
+        return int(pages.attrib["size"]) * 1024
+
+    def get_ksm_parameters(self):
+        try:
+            return self.conn.getMemoryParameters(0)
+        except libvirt.libvirtError as e:
+            logger.debug("Cannot read the KSM parameters: %s", e)
+            return {}
+
+    def get_numa_topology(self):
+        return placement.topology(self.conn.getCapabilities())
 
     def get_distro_configuration(self, distro) -> typing.Dict:
         distro_configuration_file = pathlib.PosixPath(
@@ -167,39 +363,140 @@ class LibvirtHypervisor:
             else:
                 raise
 
-    def get_free_ipv4(self):
-        used_ips = [self.gateway]
+    def get_free_ipv4(self, reserved=None):
+        used_ips = {shard.gateway.ip for shard in self.shards}
+        # The caller keeps track of its own allocations.
+        if reserved is not None:
+            used_ips |= {ipaddress.ip_interface(ip).ip for ip in reserved}
         for dom in self.list_domains():
             ipstr = dom.get_metadata("ipv4")
             if not ipstr:
                 continue
-            interface = ipaddress.ip_interface(ipstr)
-            used_ips.append(interface)
-
-        for ip in self.network:
-            cidr_ip = "{ip}/24".format(ip=ip)
-            interface = ipaddress.IPv4Interface(cidr_ip)
-            if int(interface.ip.exploded.split(".")[3]) < 5:
-                continue
-            if self._last_free_ipv4 and self._last_free_ipv4 >= interface:
+            used_ips.add(ipaddress.ip_interface(ipstr).ip)
+
+        with self._network_lock:
+            # Another process may have added or removed a shard.
+            self.load_network_shards()
+            for shard in self.shards:
+                interface = self._get_free_ipv4_in(shard, used_ips, reserved)
+                if interface:
+                    return interface
+            shard = self.add_network_shard()
+            return self._get_free_ipv4_in(shard, used_ips, reserved)
+
+    def _get_free_ipv4_in(self, shard, used_ips, reserved):
+        first = int(shard.network.network_address) + RESERVED_IPV4
+        for ip in shard.network.hosts():
+            if int(ip) < first or ip in used_ips:
                 continue
-            if interface.ip not in [i.ip for i in used_ips]:
+            interface = ipaddress.IPv4Interface((ip, shard.network.prefixlen))
+            # The shards follow each other in the address space.
+            if reserved is None and self._last_free_ipv4:
+                if self._last_free_ipv4.ip >= interface.ip:
+                    continue
+            if reserved is None:
                 self._last_free_ipv4 = interface
-                return interface
+            return interface
+
+    def get_network_for_ip(self, ipv4):
+        ip = ipaddress.ip_interface(str(ipv4)).ip
+        for retry in (False, True):
+            # Another process may have added a shard.
+            if retry:
+                self.load_network_shards()
+            for shard in self.shards:
+                if ip in shard.network:
+                    return shard
+        return self.shards[0]
 
     def get_storage_dir(self):
-        xml = self.storage_pool_obj.XMLDesc(0)
+        return self.get_pool_dir(self.storage_pool_obj)
+
+    def get_pool_dir(self, pool):
+        xml = pool.XMLDesc(0)
         root = ET.fromstring(xml)
         disk_source = root.find("./target/path")
         return pathlib.PosixPath(disk_source.text)
 
-    def create_disk(self, name, size=None, backing_on=None):
+    def get_storage_pools(self):
+        return [self.storage_pool_obj] + self.data_pools
+
+    def get_volume_pool(self, path):
+        return self.conn.storageVolLookupByPath(str(path)).storagePoolLookupByVolume()
+
+    def refresh_storage_pools(self):
+        for pool in self.get_storage_pools():
+            pool.refresh()
+
+    def choose_storage_pool(self, placement="round-robin", name=None):
+        pools = self.get_storage_pools()
+        if name:
+            for pool in pools:
+                if pool.name() == name:
+                    return pool
+            raise ValueError("Unknown storage pool: {name}".format(name=name))
+        if placement not in STORAGE_PLACEMENTS:
+            raise ValueError(
+                "Unknown storage placement {placement}, expected one of: {choices}".format(
+                    placement=placement, choices=", ".join(STORAGE_PLACEMENTS)
+                )
+            )
+        if placement == "least-used":
+            self.refresh_storage_pools()
+            return max(pools, key=lambda pool: pool.info()[3])
+        with self._pool_lock:
+            pool = pools[self._next_pool % len(pools)]
+            self._next_pool += 1
+        return pool
+
+    def get_base_image(self, distro, pool):
+        upstream = (
+            self.get_storage_dir() / "upstream" / "{distro}.qcow2".format(distro=distro)
+        )
+        if pool.name() == self.storage_pool_obj.name():
+            return upstream
+        # The overlay and its backing file stay on the same disk.
+        name = REPLICA_NAME.format(distro=distro)
+        with self._replica_lock:
+            try:
+                pool.storageVolLookupByName(name)
+                return self.get_pool_dir(pool) / name
+            except libvirt.libvirtError:
+                pass
+            logger.info("Copying %s in the storage pool %s", distro, pool.name())
+            return pathlib.PosixPath(self.replicate_image(upstream, pool, name).path())
+
+    def replicate_image(self, image, pool, name):
+        size = image.stat().st_size
+        root = ET.fromstring(STORAGE_VOLUME_XML)
+        root.find("./name").text = name
+        root.find("./capacity").attrib["unit"] = "bytes"
+        root.find("./capacity").text = str(size)
+        root.find("./target/format").attrib["type"] = "raw"
+        root.find("./target/path").text = str(self.get_pool_dir(pool) / name)
+        vol = pool.createXML(ET.tostring(root).decode())
+        try:
+            with image.open("rb") as fd:
+                st = self.conn.newStream(0)
+                vol.upload(st, 0, size)
+                st.sendAll(lambda stream, nbytes, fd: fd.read(UPLOAD_CHUNK_SIZE), fd)
+                st.finish()
+        except (OSError, libvirt.libvirtError):
+            vol.delete()
+            raise
+        return vol
+
+    def create_disk(
+        self, name, size=None, backing_on=None, backing_file=None, pool=None
+    ):
         if "/" in name:
             raise TypeError
         if not size:
             size = 20
+        if not pool:
+            pool = self.storage_pool_obj
         disk_path = pathlib.PosixPath(
-            "{path}/{name}.qcow2".format(path=self.get_storage_dir(), name=name)
+            "{path}/{name}.qcow2".format(path=self.get_pool_dir(pool), name=name)
         )
         logger.debug("create_disk: %s (%dGB)", str(disk_path), size)
         root = ET.fromstring(STORAGE_VOLUME_XML)
@@ -208,18 +505,15 @@ class LibvirtHypervisor:
         root.find("./target/path").text = str(disk_path)
 
         if backing_on:
-            backing_file = pathlib.PosixPath(
-                "{path}/upstream/{backing_on}.qcow2".format(
-                    path=self.get_storage_dir(), backing_on=backing_on
-                )
-            )
+            backing_file = self.get_base_image(backing_on, pool)
+        if backing_file:
             backing = ET.SubElement(root, "backingStore")
             ET.SubElement(backing, "path").text = str(backing_file)
             ET.SubElement(backing, "format").attrib = {"type": "qcow2"}
 
         xml = ET.tostring(root).decode()
         try:
-            return self.storage_pool_obj.createXML(xml)
+            return pool.createXML(xml)
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_STORAGE_VOL_EXIST:
                 logger.error(
@@ -229,12 +523,205 @@ class LibvirtHypervisor:
                         "command:\n"
                         "  sudo virsh vol-delete --pool "
                         "{pool_name} {vol_name}.qcow2"
-                    ).format(pool_name=self.storage_pool_obj.name(), vol_name=name)
+                    ).format(pool_name=pool.name(), vol_name=name)
                 )
                 sys.exit(1)
             raise
 
+    def get_disk_capacity(self, path):
+        capacity = self.conn.storageVolLookupByPath(str(path)).info()[1]
+        return int(math.ceil(capacity / 1024**3))
+
+    def freeze_root_disk(self, domain, name=None, memory_file=None):
+        # An external snapshot: the VM goes on writing in a new overlay and
+        # its current disk becomes a read-only backing file.
+        target, path = domain.get_root_disk()
+        if not name:
+            name = "{name}-{timestamp}".format(
+                name=domain.name, timestamp=time.strftime("%Y%m%d%H%M%S")
+            )
+        root = ET.fromstring(SNAPSHOT_XML)
+        root.find("./name").text = name
+        disks = root.find("./disks")
+        for device in domain.get_disk_targets():
+            disk = ET.SubElement(disks, "disk", name=device)
+            if device != target:
+                disk.attrib["snapshot"] = "no"
+                continue
+            disk.attrib["snapshot"] = "external"
+            ET.SubElement(disk, "driver", type="qcow2")
+            ET.SubElement(
+                disk,
+                "source",
+                file="{path}/{name}.qcow2".format(
+                    path=pathlib.PosixPath(path).parent, name=name
+                ),
+            )
+        flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA
+        flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+        if memory_file:
+            ET.SubElement(root, "memory", snapshot="external", file=str(memory_file))
+        else:
+            flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
+        domain.dom.snapshotCreateXML(ET.tostring(root).decode(), flags)
+        self.refresh_storage_pools()
+        return pathlib.PosixPath(path)
+
+    def snapshot_create(self, domain, memory=False):
+        name = "{name}-snap-{timestamp}".format(
+            name=domain.name, timestamp=time.strftime("%Y%m%d%H%M%S")
+        )
+        memory_file = None
+        if memory and domain.dom.isActive():
+            memory_file = self.get_storage_dir() / (name + ".mem")
+        base_file = self.freeze_root_disk(domain, name=name, memory_file=memory_file)
+        domain.snapshot = {
+            "base": str(base_file),
+            "memory": str(memory_file) if memory_file else None,
+        }
+
+    def snapshot_revert(self, domain):
+        snapshot = domain.snapshot
+        running = domain.dom.isActive()
+        if running:
+            domain.dom.destroy()
+        # Discard what has been written since the snapshot, the definition
+        # of the VM (metadata, MAC address...) doesn't change.
+        _, overlay = domain.get_root_disk()
+        pool = self.get_volume_pool(overlay)
+        self.conn.storageVolLookupByPath(overlay).delete()
+        self.create_disk(
+            name=pathlib.PosixPath(overlay).stem,
+            backing_file=snapshot["base"],
+            size=self.get_disk_capacity(snapshot["base"]),
+            pool=pool,
+        )
+        if snapshot["memory"]:
+            # The XML saved with the memory still uses the base disk.
+            root = ET.fromstring(self.conn.saveImageGetXMLDesc(snapshot["memory"], 0))
+            set_root_disk_source(root, overlay)
+            self.conn.restoreFlags(
+                snapshot["memory"],
+                ET.tostring(root).decode(),
+                libvirt.VIR_DOMAIN_SAVE_RUNNING,
+            )
+        elif running:
+            domain.dom.create()
+
+    def snapshot_delete(self, domain):
+        snapshot = domain.snapshot
+        target, overlay = domain.get_root_disk()
+        # The overlay is merged in the base disk with an active block commit,
+        # it needs a running QEMU.
+        running = domain.dom.isActive()
+        if not running:
+            domain.dom.createWithFlags(libvirt.VIR_DOMAIN_START_PAUSED)
+        try:
+            # Only down to the base of the snapshot, the upstream image is
+            # shared with the other VMs.
+            domain.dom.blockCommit(
+                target,
+                snapshot["base"],
+                None,
+                0,
+                libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE,
+            )
+            deadline = time.monotonic() + BLOCK_JOB_TIMEOUT
+            while True:
+                info = domain.dom.blockJobInfo(target, 0)
+                # A job that just started may report 0/0.
+                if info and info["end"] > 0 and info["cur"] == info["end"]:
+                    break
+                if time.monotonic() > deadline:
+                    domain.dom.blockJobAbort(target, 0)
+                    raise Exception(
+                        "{name}: the block commit of {target} has stalled".format(
+                            name=domain.name, target=target
+                        )
+                    )
+                time.sleep(0.1)
+            domain.dom.blockJobAbort(target, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+        finally:
+            if not running:
+                domain.dom.destroy()
+        domain.set_root_disk(snapshot["base"])
+        self.refresh_storage_pools()
+        self.conn.storageVolLookupByPath(overlay).delete()
+        if snapshot["memory"]:
+            self.conn.storageVolLookupByPath(snapshot["memory"]).delete()
+        domain.snapshot = None
+
+    def get_backing_chain(self, path):
+        # The backing files of a disk that belong to the pools, the upstream
+        # images and their copies excepted.
+        chain = []
+        pool_dirs = [self.get_pool_dir(pool) for pool in self.get_storage_pools()]
+        while True:
+            try:
+                vol = self.conn.storageVolLookupByPath(str(path))
+            except libvirt.libvirtError:
+                return chain
+            backing = ET.fromstring(vol.XMLDesc(0)).find("./backingStore/path")
+            if backing is None:
+                return chain
+            path = pathlib.PosixPath(backing.text)
+            if path.parent not in pool_dirs or path.name.startswith(REPLICA_PREFIX):
+                return chain
+            chain.append(path)
+
+    def find_orphan_volumes(self, min_age=GC_MIN_AGE):
+        self.refresh_storage_pools()
+        # One XMLDesc per volume and per domain, the backing chains are
+        # followed in memory.
+        volumes = {}
+        for pool in self.get_storage_pools():
+            for vol in pool.listAllVolumes():
+                volumes[vol.path()] = (vol, ET.fromstring(vol.XMLDesc(0)))
+
+        def backing_chain(path):
+            chain = []
+            while path in volumes and path not in chain:
+                backing = volumes[path][1].find("./backingStore/path")
+                if backing is None:
+                    break
+                path = backing.text
+                chain.append(path)
+            return chain
+
+        used = set()
+        for dom in self.conn.listAllDomains():
+            root = ET.fromstring(dom.XMLDesc(0))
+            for source in root.findall("./devices/disk/source[@file]"):
+                used.add(source.attrib["file"])
+                used.update(backing_chain(source.attrib["file"]))
+        # The memory of a snapshot has the name of its overlay.
+        used_stems = {pathlib.PosixPath(path).stem for path in used}
+
+        orphans = []
+        now = time.time()
+        for path, (vol, root) in volumes.items():
+            path = pathlib.PosixPath(path)
+            if str(path) in used or root.get("type") == "dir":
+                continue
+            if is_upstream_image(path):
+                continue
+            if SNAPSHOT_MEMORY.search(path.name):
+                if path.stem in used_stems:
+                    continue
+            elif not path.name.endswith(CIDATA_SUFFIX):
+                # Only the disks of virt-lightning, their backing chain ends
+                # on an upstream image, not the other volumes of the pool.
+                chain = backing_chain(str(path))
+                if not chain or not is_upstream_image(pathlib.PosixPath(chain[-1])):
+                    continue
+            mtime = root.find("./target/timestamps/mtime")
+            if mtime is not None and now - float(mtime.text) < min_age:
+                continue
+            orphans.append(vol)
+        return orphans
+
     def generate_openstack_network_config(self, domain):
+        shard = self.get_network_for_ip(domain.ipv4)
         links = []
         additional_networks = []
         for i, addr in enumerate(domain.mac_addresses):
@@ -257,7 +744,9 @@ class LibvirtHypervisor:
                 additional_networks.append(net)
             else:
                 if "/" not in ipv4:
-                    ipv4 += "/24"
+                    ipv4 += "/{prefix}".format(
+                        prefix=self.get_network_for_ip(ipv4).network.prefixlen
+                    )
                 domain_ip = ipaddress.IPv4Interface(ipv4)
                 net = {
                     "id": "private-ipv4-" + str(i),
@@ -277,24 +766,24 @@ class LibvirtHypervisor:
                     "type": "ipv4",
                     "link": "interface0",
                     "ip_address": str(domain.ipv4.ip),
-                    "netmask": str(self.network.netmask.exploded),
+                    "netmask": str(shard.network.netmask.exploded),
                     "routes": [
                         {
                             "network": "0.0.0.0",
                             "netmask": "0.0.0.0",
-                            "gateway": str(self.gateway.ip),
+                            "gateway": str(shard.gateway.ip),
                         }
                     ],
                     "network_id": "da5bb487-5193-4a65-a3df-4a0055a8c0d7",
                 }
             ],
-            "services": [{"type": "dns", "address": str(self.dns.ip)}],
+            "services": [{"type": "dns", "address": str(shard.gateway.ip)}],
         }
         openstack_network_data["networks"] += additional_networks
         return openstack_network_data
 
-    def prepare_cloud_init_openstack_iso(self, domain):
-        openstack_meta_data = {
+    def generate_openstack_meta_data(self, domain):
+        return {
             "availability_zone": "nova",
             "files": [],
             "hostname": domain.fqdn or domain.name,
@@ -306,6 +795,25 @@ class LibvirtHypervisor:
             "uuid": domain.dom.UUIDString(),
             "admin_pass": domain.root_password,
         }
+
+    def generate_user_data(self, domain):
+        return "#cloud-config\n" + yaml.dump(domain.user_data, Dumper=yaml.Dumper)
+
+    def get_seed(self, domain):
+        # What the metadata service needs to configure the VM.
+        shard = self.get_network_for_ip(domain.ipv4)
+        return {
+            "name": domain.name,
+            "ipv4": str(domain.ipv4.ip),
+            "mac": domain.mac_addresses[0],
+            "gateway": str(shard.gateway.ip),
+            "meta_data": self.generate_openstack_meta_data(domain),
+            "network_data": self.generate_openstack_network_config(domain),
+            "user_data": self.generate_user_data(domain),
+        }
+
+    def prepare_cloud_init_openstack_iso(self, domain):
+        openstack_meta_data = self.generate_openstack_meta_data(domain)
         with tempfile.TemporaryDirectory() as base_temp_dir:
             temp_dir = pathlib.Path(base_temp_dir)
             cd_dir = temp_dir / "cd_dir"
@@ -321,40 +829,46 @@ class LibvirtHypervisor:
                 fd.write(json.dumps(openstack_network_data))
             openstack_userdata_file = openstack_dir / "user_data"
             with openstack_userdata_file.open("w") as fd:
-                fd.write("#cloud-config\n")
-                fd.write(yaml.dump(domain.user_data, Dumper=yaml.Dumper))
+                fd.write(self.generate_user_data(domain))
             cidata_file = temp_dir / "{name}-cidata.iso".format(name=domain.name)
-            run_cmd(
-                [
-                    str(self.iso_binary),
-                    "-output",
-                    cidata_file.name,
-                    "-ldots",
-                    "-allow-lowercase",
-                    "-allow-multidot",
-                    "-l",
-                    "-publisher",
-                    "virt-lighting",
-                    "-quiet",
-                    "-J",
-                    "-r",
-                    "-V",
-                    "config-2",
-                    str(cd_dir),
-                ],
-                cwd=str(temp_dir),
-            )
+            with stage("genisoimage", domain.name):
+                run_cmd(
+                    [
+                        str(self.iso_binary),
+                        "-output",
+                        cidata_file.name,
+                        "-ldots",
+                        "-allow-lowercase",
+                        "-allow-multidot",
+                        "-l",
+                        "-publisher",
+                        "virt-lighting",
+                        "-quiet",
+                        "-J",
+                        "-r",
+                        "-V",
+                        "config-2",
+                        str(cd_dir),
+                    ],
+                    cwd=str(temp_dir),
+                )
 
-            cdrom = self.create_disk(name=cidata_file.stem, size=1)
-            with cidata_file.open("br") as fd:
-                st = self.conn.newStream(0)
-                cdrom.upload(st, 0, 1024 * 1024)
-                st.send(fd.read())
-                st.finish()
+            with stage("upload", domain.name):
+                cdrom = self.create_disk(
+                    name=cidata_file.stem,
+                    size=1,
+                    pool=self.get_volume_pool(domain.get_root_disk()[1]),
+                )
+                with cidata_file.open("br") as fd:
+                    st = self.conn.newStream(0)
+                    cdrom.upload(st, 0, 1024 * 1024)
+                    st.send(fd.read())
+                    st.finish()
             return cdrom
 
     def prepare_cloud_init_nocloud_iso(self, domain):
         primary_mac_addr = domain.mac_addresses[0]
+        shard = self.get_network_for_ip(domain.ipv4)
         self._network_meta = {"config": "disabled"}
         domain._network_meta = {
             "version": 1,
@@ -367,8 +881,8 @@ class LibvirtHypervisor:
                         {
                             "type": "static",
                             "address": str(domain.ipv4),
-                            "gateway": str(self.gateway.ip),
-                            "dns_nameservers": [str(self.dns.ip)],
+                            "gateway": str(shard.gateway.ip),
+                            "dns_nameservers": [str(shard.gateway.ip)],
                         }
                     ],
                 }
@@ -389,8 +903,9 @@ class LibvirtHypervisor:
                     META_DATA_ENI.format(
                         name=domain.name,
                         ipv4=str(domain.ipv4.ip),
-                        gateway=str(self.gateway.ip),
-                        network=str(self.network),
+                        gateway=str(shard.gateway.ip),
+                        network=str(shard.network.network_address),
+                        netmask=str(shard.network.netmask),
                     )
                 )
             network_config_file = cd_dir / "network-config"
@@ -398,56 +913,86 @@ class LibvirtHypervisor:
                 fd.write(yaml.dump(domain._network_meta, Dumper=yaml.Dumper))
 
             cidata_file = temp_dir / "{name}-cidata.iso".format(name=domain.name)
-            run_cmd(
-                [
-                    str(self.iso_binary),
-                    "-output",
-                    cidata_file.name,
-                    "-volid",
-                    "cidata",
-                    "-joliet",
-                    "-R",
-                    str(cd_dir),
-                ],
-                cwd=str(temp_dir),
-            )
+            with stage("genisoimage", domain.name):
+                run_cmd(
+                    [
+                        str(self.iso_binary),
+                        "-output",
+                        cidata_file.name,
+                        "-volid",
+                        "cidata",
+                        "-joliet",
+                        "-R",
+                        str(cd_dir),
+                    ],
+                    cwd=str(temp_dir),
+                )
 
-            cdrom = self.create_disk(name=cidata_file.stem, size=1)
-            with cidata_file.open("br") as fd:
-                st = self.conn.newStream(0)
-                cdrom.upload(st, 0, 1024 * 1024)
-                st.send(fd.read())
-                st.finish()
+            with stage("upload", domain.name):
+                cdrom = self.create_disk(
+                    name=cidata_file.stem,
+                    size=1,
+                    pool=self.get_volume_pool(domain.get_root_disk()[1]),
+                )
+                with cidata_file.open("br") as fd:
+                    st = self.conn.newStream(0)
+                    cdrom.upload(st, 0, 1024 * 1024)
+                    st.send(fd.read())
+                    st.finish()
             return cdrom
 
-    def start(self, domain, metadata_format):
-        if metadata_format.get("provider", "") == "nocloud":
-            cloud_init_iso = self.prepare_cloud_init_nocloud_iso(domain)
-        elif domain.distro.startswith("rhel-6.") or domain.distro.startswith(
-            "centos-6."
-        ):
-            cloud_init_iso = self.prepare_cloud_init_nocloud_iso(domain)
-        else:  # OpenStack format is the default
-            cloud_init_iso = self.prepare_cloud_init_openstack_iso(domain)
-
-        domain.attachDisk(cloud_init_iso, device="cdrom", disk_type="raw")
-        domain.dom.create()
-        self.remove_domain_from_network(domain)
-        self.add_domain_to_network(domain)
+    def start(self, domain, metadata_format, metadata_service=None):
+        distro = domain.distro
+        with stage("seed", domain.name, distro=distro):
+            url = None
+            # The service can't configure the static IPv4 of the additional
+            # interfaces, DHCP only gives the address of the first one.
+            static = [ip for ip in domain.additional_ipv4 if ip and ip != "dhcp"]
+            if metadata_service and not static:
+                url = metadata_service(self.get_seed(domain))
+            if url:
+                domain.set_smbios_serial("ds=nocloud-net;s={url}".format(url=url))
+            elif metadata_format.get("provider", "") == "nocloud":
+                cloud_init_iso = self.prepare_cloud_init_nocloud_iso(domain)
+            elif distro.startswith("rhel-6.") or distro.startswith("centos-6."):
+                cloud_init_iso = self.prepare_cloud_init_nocloud_iso(domain)
+            else:  # OpenStack format is the default
+                cloud_init_iso = self.prepare_cloud_init_openstack_iso(domain)
+            if not url:
+                domain.attachDisk(cloud_init_iso, device="cdrom", disk_type="raw")
+
+        with stage("boot", domain.name, distro=distro):
+            with stage("create", domain.name):
+                domain.dom.create()
+            # Only for the first boot, the seed is gone once the daemon
+            # restarts and cloud-init would wait for the URL at each boot.
+            if url:
+                domain.set_smbios_serial(None)
+            with stage("network_update", domain.name):
+                self.remove_domain_from_network(domain)
+                self.add_domain_to_network(domain)
 
     def add_domain_to_network(self, domain):
-        self.set_dns_entry(domain.ipv4, [domain.name, domain.fqdn])
-        self.set_dhcp_entry(domain.ipv4, domain.mac_addresses[0])
+        shard = self.get_network_for_ip(domain.ipv4)
+        # The VM of all the shards can resolve the name, even if the
+        # firewall of libvirt doesn't route between the shards.
+        for other in self.shards:
+            self.set_dns_entry(domain.ipv4, [domain.name, domain.fqdn], other.obj)
+        self.set_dhcp_entry(domain.ipv4, domain.mac_addresses[0], shard.obj)
 
     def remove_domain_from_network(self, domain):
-        root = ET.fromstring(self.network_obj.XMLDesc(0))
         if not domain.ipv4:
             return
+        for shard in self.shards:
+            self._remove_domain_from_shard(domain, shard.obj)
+
+    def _remove_domain_from_shard(self, domain, network_obj):
+        root = ET.fromstring(network_obj.XMLDesc(0))
         for host in root.findall("./dns/host[@ip]"):
             if host.attrib["ip"] != str(domain.ipv4.ip):
                 continue
             xml = ET.tostring(host, encoding="unicode")
-            self.network_obj.update(
+            network_obj.update(
                 libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
                 libvirt.VIR_NETWORK_SECTION_DNS_HOST,
                 0,
@@ -455,12 +1000,12 @@ class LibvirtHypervisor:
                 libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
             )
 
-        root = ET.fromstring(self.network_obj.XMLDesc(0))
+        root = ET.fromstring(network_obj.XMLDesc(0))
         for host in root.findall("./ip/dhcp/host[@ip]"):
             if host.attrib["ip"] != str(domain.ipv4.ip):
                 continue
             xml = ET.tostring(host, encoding="unicode")
-            self.network_obj.update(
+            network_obj.update(
                 libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
                 libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
                 0,
@@ -468,12 +1013,12 @@ class LibvirtHypervisor:
                 libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
             )
 
-        root = ET.fromstring(self.network_obj.XMLDesc(0))
+        root = ET.fromstring(network_obj.XMLDesc(0))
         for host in root.findall("./ip/dhcp/host[@mac]"):
             if host.attrib["mac"] not in domain.mac_addresses:
                 continue
             xml = ET.tostring(host, encoding="unicode")
-            self.network_obj.update(
+            network_obj.update(
                 libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
                 libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
                 0,
@@ -483,6 +1028,7 @@ class LibvirtHypervisor:
 
     def clean_up(self, domain):
         self.remove_domain_from_network(domain)
+        snapshot = domain.snapshot
         xml = domain.dom.XMLDesc(0)
         state, _ = domain.dom.state()
         if state != libvirt.VIR_DOMAIN_SHUTOFF:
@@ -491,14 +1037,33 @@ class LibvirtHypervisor:
         flag |= libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA
         domain.dom.undefineFlags(flag)
 
-        self.storage_pool_obj.refresh()
+        self.refresh_storage_pools()
         root = ET.fromstring(xml)
+        filepaths = []
+        chain = []
         for disk in root.findall("./devices/disk[@type='file']/source[@file]"):
-            filepath = pathlib.PosixPath(disk.attrib["file"])
-            if filepath.exists():
-                logger.debug("Purge volume: %s", str(filepath))
-                vol = self.storage_pool_obj.storageVolLookupByName(filepath.name)
-                vol.delete()
+            filepaths.append(pathlib.PosixPath(disk.attrib["file"]))
+            chain += self.get_backing_chain(disk.attrib["file"])
+        if snapshot and snapshot["memory"]:
+            filepaths.append(pathlib.PosixPath(snapshot["memory"]))
+        # The frozen disks of the snapshots and the clones may still be
+        # used by other VM.
+        if chain:
+            used = set()
+            for other in self.list_domains():
+                for _, path in other.get_disks():
+                    used.add(pathlib.PosixPath(path))
+                    used.update(self.get_backing_chain(path))
+            filepaths += [path for path in chain if path not in used]
+        for filepath in filepaths:
+            # Through libvirt, the volume may be on a remote hypervisor or
+            # in another pool.
+            try:
+                vol = self.conn.storageVolLookupByPath(str(filepath))
+            except libvirt.libvirtError:
+                continue
+            logger.debug("Purge volume: %s", str(filepath))
+            vol.delete()
 
     @property
     def kvm_binary(self):
@@ -519,6 +1084,9 @@ class LibvirtHypervisor:
         raise Exception("Failed to find %s in %s", ":".join(ISO_BINARIES), paths)
 
     def init_network(self, network_name, network_cidr):
+        # Not the network of a previous call.
+        self.network_obj = None
+        self._last_free_ipv4 = None
         try:
             self.network_obj = self.conn.networkLookupByName(network_name)
         except libvirt.libvirtError as e:
@@ -531,28 +1099,116 @@ class LibvirtHypervisor:
         if not self.network_obj.isActive():
             self.network_obj.create()
 
-        xml = self.network_obj.XMLDesc(0)
-        root = ET.fromstring(xml)
+        shard = self._shard(self.network_obj)
+        self.gateway = shard.gateway
+        self.dns = self.gateway
+        self.network = shard.network
+        self.load_network_shards()
+
+    def _shard(self, network_obj):
+        root = ET.fromstring(network_obj.XMLDesc(0))
         ip = root.find("./ip")
+        gateway = ipaddress.IPv4Interface("{address}/{netmask}".format(**ip.attrib))
+        return Shard(network_obj.name(), network_obj, gateway, gateway.network)
+
+    def load_network_shards(self):
+        primary = self.network_obj.name()
+        pattern = re.compile(re.escape(primary) + r"-(\d+)$")
+        shards = {}
+        for network_obj in self.conn.listAllNetworks():
+            match = pattern.match(network_obj.name())
+            if match and network_obj.isActive():
+                shards[int(match.group(1))] = self._shard(network_obj)
+        self.shards = [self._shard(self.network_obj)] + [
+            shards[index] for index in sorted(shards)
+        ]
+
+    def get_used_networks(self):
+        networks = []
+        for network_obj in self.conn.listAllNetworks():
+            root = ET.fromstring(network_obj.XMLDesc(0))
+            for ip in root.findall("./ip[@address]"):
+                if "netmask" in ip.attrib:
+                    prefix = ip.attrib["netmask"]
+                elif "prefix" in ip.attrib:
+                    prefix = ip.attrib["prefix"]
+                else:
+                    continue
+                networks.append(
+                    ipaddress.ip_interface(
+                        "{address}/{prefix}".format(
+                            address=ip.attrib["address"], prefix=prefix
+                        )
+                    ).network
+                )
+        return networks
 
-        self.gateway = ipaddress.IPv4Interface(
-            "{address}/{netmask}".format(**ip.attrib)
+    def add_network_shard(self):
+        last = self.shards[-1]
+        name = "{primary}-{index}".format(
+            primary=self.shards[0].name, index=len(self.shards)
         )
-        self.dns = self.gateway
-        self.network = self.gateway.network
+        used = self.get_used_networks()
+        candidate = last.network
+        # The next network of the same size that no other network uses.
+        while True:
+            address = int(candidate.network_address) + candidate.num_addresses
+            candidate = ipaddress.IPv4Network((address, candidate.prefixlen))
+            if not any(candidate.overlaps(network) for network in used):
+                break
+        logger.info("The network %s is full, creating %s", last.name, name)
+        suffix = "-{index}".format(index=len(self.shards))
+        bridge = self.shards[0].name[: BRIDGE_NAME_MAX - len(suffix)] + suffix
+        # The names of the VM of the other shards.
+        dns = ET.fromstring(self.shards[0].obj.XMLDesc(0)).find("./dns")
+        try:
+            network_obj = self.create_network(
+                name, str(candidate), bridge=bridge, dns=dns
+            )
+        except libvirt.libvirtError as e:
+            if e.get_error_code() not in (
+                libvirt.VIR_ERR_NETWORK_EXIST,
+                libvirt.VIR_ERR_OPERATION_FAILED,
+            ):
+                raise
+            # Another vl process has just created it.
+            self.load_network_shards()
+            for shard in self.shards:
+                if shard.name == name:
+                    return shard
+            raise
+        shard = self._shard(network_obj)
+        self.shards.append(shard)
+        return shard
 
-    def create_network(self, network_name, network_cidr):
+    def create_network(self, network_name, network_cidr, bridge=None, dns=None):
         network = ipaddress.ip_network(network_cidr)
         root = ET.fromstring(NETWORK_XML)
         root.find("./name").text = network_name
-        root.find("./bridge").attrib["name"] = network_name
+        root.find("./bridge").attrib["name"] = bridge or network_name
         root.find("./ip").attrib = {
             "address": network[1].exploded,
             "netmask": network.netmask.exploded,
         }
+        if dns is not None:
+            root.append(dns)
         xml = ET.tostring(root).decode()
         return self.conn.networkCreateXML(xml)
 
+    def init_data_pools(self, names):
+        self.data_pools = []
+        for name in names:
+            try:
+                pool = self.conn.storagePoolLookupByName(name)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_POOL:
+                    raise (e)
+                logger.error("Storage pool %s not found", name)
+                exit(1)
+            if not pool.isActive():
+                pool.create(0)
+            self.data_pools.append(pool)
+
     def init_storage_pool(self, storage_pool):
         try:
             self.storage_pool_obj = self.conn.storagePoolLookupByName(storage_pool)
@@ -596,18 +1252,66 @@ class LibvirtHypervisor:
             raise Exception("Failed to create pool:", name, xml)
         return pool
 
+    def get_image_root(self, image):
+        root = subprocess.check_output(
+            ["guestfish", "--ro", "-a", str(image), "-i", "inspect-get-roots"]
+        )
+        root = root.decode().split()[0]
+        fs_uuid = subprocess.check_output(
+            ["guestfish", "--ro", "-a", str(image), "run", ":", "vfs-uuid", root]
+        )
+        if fs_uuid.strip():
+            return "UUID=" + fs_uuid.decode().strip()
+        # The appliance sees the disk as /dev/sda, the VM as /dev/vda.
+        return re.sub(r"^/dev/sd", "/dev/vd", root)
+
+    def extract_kernel(self, distro, cmdline=None):
+        upstream = self.get_storage_dir() / "upstream"
+        image = upstream / "{distro}.qcow2".format(distro=distro)
+        if not cmdline:
+            cmdline = DEFAULT_KERNEL_CMDLINE.format(root=self.get_image_root(image))
+        boot = {}
+        with tempfile.TemporaryDirectory(dir=str(upstream)) as temp_dir:
+            subprocess.check_call(
+                [
+                    "virt-get-kernel",
+                    "--unversioned-names",
+                    "-a",
+                    str(image),
+                    "-o",
+                    temp_dir,
+                ]
+            )
+            for path in pathlib.PosixPath(temp_dir).iterdir():
+                key = "kernel" if path.name.startswith("vmlinuz") else "initrd"
+                target = upstream / "{distro}.{suffix}".format(
+                    distro=distro, suffix="vmlinuz" if key == "kernel" else "initrd"
+                )
+                path.rename(target)
+                boot[key] = target.name
+        if "kernel" not in boot:
+            raise Exception("No kernel found in {image}".format(image=image))
+        boot["cmdline"] = cmdline
+
+        config = self.get_distro_configuration(distro)
+        config.update(boot)
+        config_file = image.with_suffix(".yaml")
+        config_file.write_text(yaml.dump(config, default_flow_style=False))
+        self.storage_pool_obj.refresh()
+        return boot
+
     def distro_available(self):
         path = self.get_storage_dir() / "upstream"
         return [path.stem for path in sorted(path.glob("*.qcow2"))]
 
-    def set_dns_entry(self, ipv4, names=None):
+    def set_dns_entry(self, ipv4, names=None, network_obj=None):
         root = ET.fromstring(NETWORK_HOST_ENTRY)
         for name in names:
             if name:
                 ET.SubElement(root, "hostname").text = name
         root.attrib["ip"] = str(ipv4.ip)
         xml = ET.tostring(root).decode()
-        self.network_obj.update(
+        (network_obj or self.network_obj).update(
             libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_FIRST,
             libvirt.VIR_NETWORK_SECTION_DNS_HOST,
             0,
@@ -615,12 +1319,12 @@ class LibvirtHypervisor:
             libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE,
         )
 
-    def set_dhcp_entry(self, ipv4, mac=None):
+    def set_dhcp_entry(self, ipv4, mac=None, network_obj=None):
         root = ET.fromstring(NETWORK_DHCP_ENTRY)
         root.attrib["mac"] = mac
         root.attrib["ip"] = str(ipv4.ip)
         xml = ET.tostring(root).decode()
-        self.network_obj.update(
+        (network_obj or self.network_obj).update(
             libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_FIRST,
             libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
             0,
@@ -639,8 +1343,14 @@ class LibvirtDomain:
             "runcmd": [],
         }
         self._ssh_key = None
+        self._metadata = None
+        self._metadata_batch = 0
+        self._metadata_dirty = False
         self.default_nic_model = None
         self.additional_ipv4 = []
+        # Set by the Fleet, the VM of several hypervisors can have the same
+        # IPv4 address.
+        self.hypervisor_uri = None
 
     @property
     def root_password(self):
@@ -750,8 +1460,82 @@ class LibvirtDomain:
 
     @vcpus.setter
     def vcpus(self, value=1):
+        self.dom.setVcpusFlags(
+            value, libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_VCPU_MAXIMUM
+        )
         self.dom.setVcpusFlags(value, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
 
+    def set_kernel(self, kernel, initrd=None, cmdline=None):
+        root = ET.fromstring(self.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        os_elt = root.find("./os")
+        for tag in ("kernel", "initrd", "cmdline"):
+            for elt in os_elt.findall(tag):
+                os_elt.remove(elt)
+        ET.SubElement(os_elt, "kernel").text = str(kernel)
+        if initrd:
+            ET.SubElement(os_elt, "initrd").text = str(initrd)
+        if cmdline:
+            ET.SubElement(os_elt, "cmdline").text = cmdline
+        self.dom.connect().defineXML(ET.tostring(root).decode())
+
+    def set_smbios_serial(self, serial):
+        # cloud-init reads its datasource in the serial number of the system.
+        root = ET.fromstring(self.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        for elt in root.findall("./sysinfo") + root.findall("./os/smbios"):
+            (root if elt.tag == "sysinfo" else root.find("./os")).remove(elt)
+        if serial is None:
+            self.dom.connect().defineXML(ET.tostring(root).decode())
+            return
+        ET.SubElement(root.find("./os"), "smbios", mode="sysinfo")
+        system = ET.SubElement(ET.SubElement(root, "sysinfo", type="smbios"), "system")
+        ET.SubElement(system, "entry", name="serial").text = serial
+        self.dom.connect().defineXML(ET.tostring(root).decode())
+
+    def set_placement(self, assignment):
+        root = ET.fromstring(self.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        for elt in root.findall("./cputune") + root.findall("./numatune"):
+            root.remove(elt)
+        cputune = ET.SubElement(root, "cputune")
+        for vcpu, cpu in enumerate(assignment.cpus):
+            ET.SubElement(cputune, "vcpupin", vcpu=str(vcpu), cpuset=str(cpu))
+        ET.SubElement(
+            cputune,
+            "emulatorpin",
+            cpuset=",".join(str(cpu) for cpu in assignment.node_cpus),
+        )
+        numatune = ET.SubElement(root, "numatune")
+        ET.SubElement(
+            numatune, "memory", mode=assignment.mode, nodeset=str(assignment.node)
+        )
+        self.dom.connect().defineXML(ET.tostring(root).decode())
+
+    @property
+    def memory_profile(self):
+        return self.get_metadata("memory_profile") or "default"
+
+    @memory_profile.setter
+    def memory_profile(self, value):
+        if value not in MEMORY_PROFILES:
+            raise ValueError(
+                "Unknown memory profile {value}, expected one of: {profiles}".format(
+                    value=value, profiles=", ".join(sorted(MEMORY_PROFILES))
+                )
+            )
+        root = ET.fromstring(self.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        for elt in root.findall("./memoryBacking") + root.findall("./memtune"):
+            root.remove(elt)
+        if MEMORY_PROFILES[value]:
+            backing = ET.SubElement(root, "memoryBacking")
+            for tag, attrib in MEMORY_PROFILES[value]:
+                ET.SubElement(backing, tag, attrib)
+        if value == "locked":
+            memtune = ET.SubElement(root, "memtune")
+            ET.SubElement(memtune, "hard_limit", unit="MiB").text = str(
+                self.memory + LOCKED_MEMORY_OVERHEAD
+            )
+        self.dom.connect().defineXML(ET.tostring(root).decode())
+        self.record_metadata("memory_profile", value)
+
     @property
     def memory(self):
         xml = self.dom.XMLDesc(0)
@@ -784,25 +1568,129 @@ class LibvirtDomain:
             self.blockdev.reverse()
         return "vd{block}".format(block=self.blockdev.pop())
 
-    def record_metadata(self, k, v):
-        meta = "<{k} name='{v}' />".format(k=k, v=v)
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = self._load_metadata()
+        return self._metadata
+
+    def _load_metadata(self):
+        try:
+            xml = self.dom.metadata(
+                libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                METADATA_URI,
+                libvirt.VIR_DOMAIN_AFFECT_CONFIG,
+            )
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+                raise (e)
+            return self._migrate_metadata()
+        document = ET.fromstring(xml)
+        if int(document.get("version", METADATA_VERSION)) > METADATA_VERSION:
+            logger.warning(
+                "%s: metadata from a newer virt-lightning (version %s)",
+                self.name,
+                document.get("version"),
+            )
+        return json.loads(document.text or "{}")
+
+    def _migrate_metadata(self):
+        root = ET.fromstring(self.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        metadata = parse_legacy_metadata(root)
+        if not metadata:
+            return {}
+        logger.debug("%s: migrating the metadata", self.name)
+        self._metadata = metadata
+        self._metadata_dirty = True
+        try:
+            self.save_metadata()
+            for k in metadata:
+                self.dom.setMetadata(
+                    libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                    None,
+                    None,
+                    k,
+                    libvirt.VIR_DOMAIN_AFFECT_CONFIG,
+                )
+        except libvirt.libvirtError as e:
+            # e.g: a read-only connection, the next call will try again.
+            logger.debug("%s: cannot migrate the metadata: %s", self.name, e)
+        return metadata
+
+    def save_metadata(self):
+        if self._metadata_batch or not self._metadata_dirty:
+            return
         self.dom.setMetadata(
             libvirt.VIR_DOMAIN_METADATA_ELEMENT,
-            meta,
+            ET.tostring(metadata_document(self.metadata)).decode(),
             "vl",
-            k,
+            METADATA_URI,
             libvirt.VIR_DOMAIN_AFFECT_CONFIG,
         )
+        self._metadata_dirty = False
 
-    def get_metadata(self, k):
+    @contextlib.contextmanager
+    def batch_metadata(self):
+        # The metadata are written once, at the end of the block.
+        self._metadata_batch += 1
         try:
-            xml = self.dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, k)
-        except libvirt.libvirtError as e:
-            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
-                return None
-            raise (e)
-        elt = ET.fromstring(xml)
-        return elt.attrib["name"]
+            yield
+        finally:
+            self._metadata_batch -= 1
+            self.save_metadata()
+
+    def record_metadata(self, k, v):
+        if v is not None and not isinstance(v, (dict, list)):
+            v = str(v)
+        self.metadata[k] = v
+        self._metadata_dirty = True
+        self.save_metadata()
+
+    def remove_metadata(self, k):
+        if self.metadata.pop(k, None) is not None:
+            self._metadata_dirty = True
+            self.save_metadata()
+
+    def get_metadata(self, k):
+        return self.metadata.get(k)
+
+    def get_all_metadata(self):
+        return dict(self.metadata)
+
+    def get_root_disk(self):
+        root = ET.fromstring(self.dom.XMLDesc(0))
+        disk = root.find("./devices/disk[@device='disk']")
+        return disk.find("./target").attrib["dev"], disk.find("./source").attrib["file"]
+
+    def get_disks(self):
+        root = ET.fromstring(self.dom.XMLDesc(0))
+        return [
+            (disk.find("./target").attrib["dev"], disk.find("./source").attrib["file"])
+            for disk in root.findall("./devices/disk[@type='file']")
+            if disk.find("./source") is not None
+        ]
+
+    def set_root_disk(self, path):
+        root = ET.fromstring(self.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        set_root_disk_source(root, path)
+        self.dom.connect().defineXML(ET.tostring(root).decode())
+
+    @property
+    def snapshot(self):
+        return self.get_metadata("snapshot")
+
+    @snapshot.setter
+    def snapshot(self, value):
+        if value is None:
+            self.remove_metadata("snapshot")
+        else:
+            self.record_metadata("snapshot", value)
+
+    def get_disk_targets(self):
+        root = ET.fromstring(self.dom.XMLDesc(0))
+        return [
+            target.attrib["dev"] for target in root.findall("./devices/disk/target")
+        ]
 
     @property
     def context(self):
@@ -812,19 +1700,31 @@ class LibvirtDomain:
     def context(self, value):
         self.record_metadata("context", value)
 
+    @property
+    def machine_profile(self):
+        return self.get_metadata("machine_profile") or "default"
+
+    @machine_profile.setter
+    def machine_profile(self, value):
+        self.record_metadata("machine_profile", value)
+
+    @property
+    def machine(self):
+        root = ET.fromstring(self.dom.XMLDesc(0))
+        return root.find("./os/type").get("machine", "")
+
     @property
     def groups(self):
-        value = self.get_metadata("groups")
-        if not value:
-            return []
-        return value.split(",")
+        return self.get_metadata("groups") or []
 
     @groups.setter
     def groups(self, value):
-        self.record_metadata("groups", ",".join(value))
+        self.record_metadata("groups", list(value))
 
     def attachDisk(self, volume, device="disk", disk_type="qcow2"):
-        if device == "cdrom":
+        if device == "cdrom" and "q35" in self.machine:
+            bus = "sata"
+        elif device == "cdrom":
             bus = "ide"
         elif self.distro.startswith("esxi"):
             bus = "sata"
@@ -840,6 +1740,54 @@ class LibvirtDomain:
         self.dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
         return device_name
 
+    def share_memory(self):
+        # virtiofsd reads the guest memory, it must be shared.
+        if self.memory_profile == "default":
+            self.memory_profile = "memfd"
+            return
+        root = ET.fromstring(self.dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        backing = root.find("./memoryBacking")
+        if backing.find("./access") is not None:
+            return
+        if backing.find("./hugepages") is None and backing.find("./source") is None:
+            ET.SubElement(backing, "source", type="memfd")
+        ET.SubElement(backing, "access", mode="shared")
+        self.dom.connect().defineXML(ET.tostring(root).decode())
+
+    def attachShare(self, source, target=None, tag=None, readonly=False):
+        source = str(pathlib.PosixPath(source).expanduser().resolve())
+        if not target:
+            target = source
+        if not tag:
+            root = ET.fromstring(self.dom.XMLDesc(0))
+            tag = "share{index}".format(index=len(root.findall("./devices/filesystem")))
+        self.share_memory()
+        fs_root = ET.fromstring(FILESYSTEM_XML)
+        fs_root.find("./source").attrib = {"dir": source}
+        fs_root.find("./target").attrib = {"dir": tag}
+        if readonly:
+            # Enforced on the host, the ro mount option can be changed
+            # from the VM.
+            ET.SubElement(fs_root, "readonly")
+        self.dom.attachDeviceFlags(
+            ET.tostring(fs_root).decode(), libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        )
+        # A clone boots on the disk of its source, the entry may already be in
+        # its fstab.
+        entry = "{tag} {target} virtiofs {options} 0 0".format(
+            tag=tag,
+            target=fstab_escape(target),
+            options="ro,nofail" if readonly else "nofail",
+        )
+        self.user_data["runcmd"].append(
+            "mkdir -p {target} && "
+            "(grep -q '^{tag} ' /etc/fstab || printf '%s\\n' {entry} >> /etc/fstab) && "
+            "mount {target}".format(
+                target=shlex.quote(target), tag=tag, entry=shlex.quote(entry)
+            )
+        )
+        return tag
+
     def attachNetwork(self, network=None, nic_model=None, ipv4=None):
         if not nic_model:
             nic_model = self.default_nic_model
@@ -852,18 +1800,36 @@ class LibvirtDomain:
             if ipv4 == "dhcp":
                 add_ip = "dhcp"
             elif ipv4:
-                add_ip = ipv4
+                add_ip = str(self._network_interface(network, ipv4))
             self.additional_ipv4.append(add_ip)
-        elif isinstance(ipv4, ipaddress.IPv4Interface):
-            self.ipv4 = ipv4
-        elif ipv4 and "/" not in ipv4:
-            self.ipv4 = ipaddress.IPv4Interface(ipv4 + "/24")
         elif ipv4:
-            self.ipv4 = ipaddress.IPv4Interface(ipv4)
+            self.ipv4 = self._network_interface(network, ipv4)
 
         xml = ET.tostring(disk_root).decode()
         self.dom.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
 
+    def _network_interface(self, network, ipv4):
+        if isinstance(ipv4, ipaddress.IPv4Interface) or "/" in ipv4:
+            return ipaddress.IPv4Interface(ipv4)
+        # Without a prefix, the one of the libvirt network, e.g: a shard.
+        prefix = None
+        try:
+            if network:
+                root = ET.fromstring(
+                    self.dom.connect().networkLookupByName(network).XMLDesc(0)
+                )
+                ip = root.find("./ip")
+                if ip is not None:
+                    prefix = ip.attrib.get("netmask") or ip.attrib.get("prefix")
+        except libvirt.libvirtError:
+            pass
+        # An unknown network.
+        if not prefix:
+            prefix = DEFAULT_IPV4_PREFIX
+        return ipaddress.IPv4Interface(
+            "{ipv4}/{prefix}".format(ipv4=ipv4, prefix=prefix)
+        )
+
     def add_root_disk(self, root_disk_path):
         self.attachDisk(root_disk_path)
 
@@ -902,7 +1868,7 @@ class LibvirtDomain:
     def __lt__(self, other):
         return self.name < other.name
 
-    async def reachable(self):
+    async def ssh_probe(self):
         while True:
             try:
                 reader, _ = await asyncio.open_connection(str(self.ipv4.ip), 22)
@@ -919,13 +1885,18 @@ class LibvirtDomain:
             except (OSError, ConnectionRefusedError):
                 pass
 
-    def exec_ssh(self):
-        os.execlp(
-            "ssh",
-            "ssh",
-            "-o",
-            "StrictHostKeyChecking=no",
-            "-o",
-            "UserKnownHostsFile=/dev/null",
-            "{username}@{ipv4}".format(username=self.username, ipv4=self.ipv4.ip),
+    async def reachable(self):
+        with stage("ssh", self.name, distro=self.distro):
+            await self.ssh_probe()
+
+    def ssh_command(self, *args, options=()):
+        command = ["ssh", "-o", "StrictHostKeyChecking=no"]
+        command += ["-o", "UserKnownHostsFile=/dev/null"]
+        command += list(options)
+        command.append(
+            "{username}@{ipv4}".format(username=self.username, ipv4=self.ipv4.ip)
         )
+        return command + list(args)
+
+    def exec_ssh(self, options=()):
+        os.execlp("ssh", *self.ssh_command(options=options))